@@ -0,0 +1,180 @@
+"""Decode-once audio store shared by every stage of the pipeline.
+
+Each source file is decoded a single time at its native sample rate and
+channel layout. Resampled or downmixed views are derived from that decode
+only when a stage asks for them, and every array is memoized under
+(path, mtime, sr, mono). Entries are evicted least-recently-used first once
+the store goes over its memory budget.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import librosa
+import numpy as np
+
+# budget can be overridden without touching code, e.g. REMIXAI_AUDIO_CACHE_MB=4096
+DEFAULT_MEMORY_BUDGET = int(os.environ.get("REMIXAI_AUDIO_CACHE_MB", "1024")) * 1024 * 1024
+
+
+class AudioStore:
+    """LRU cache of decoded audio arrays bounded by max_bytes"""
+
+    def __init__(self, max_bytes=DEFAULT_MEMORY_BUDGET):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (array, sr), oldest first
+        self._native_sr = {}  # (path, mtime) -> native sample rate of the decode
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path, sr=22050, mono=True):
+        """Drop-in replacement for librosa.load(path, sr=sr, mono=mono)
+
+        Returns (y, sr). The array is shared with other callers, so it is
+        read-only: copy it before modifying it in place.
+        """
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            key = self._canonical_key(path, mtime, sr, mono)
+            cached = self._get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+            native, native_sr = self._native(path, mtime)
+            y = native
+            if mono and y.ndim > 1:
+                y = librosa.to_mono(y)
+            if sr is not None and sr != native_sr:
+                y = librosa.resample(y, orig_sr=native_sr, target_sr=sr)
+            else:
+                sr = native_sr
+            y = np.ascontiguousarray(y, dtype=np.float32)
+            y.setflags(write=False)
+            self._put(self._canonical_key(path, mtime, sr, mono), (y, sr))
+            return y, sr
+
+    def put(self, path, y, sr):
+        """Register audio that was just written to path so nobody decodes it again"""
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        y = np.ascontiguousarray(y, dtype=np.float32)
+        y.setflags(write=False)
+        with self._lock:
+            self._native_sr[(path, mtime)] = sr
+            self._put((path, mtime, None, False), (y, sr))
+
+    def holds(self, path):
+        """True if the current contents of path are decoded already, in any view"""
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            return any(key[:2] == (path, mtime) for key in self._entries)
+
+    def invalidate(self, path):
+        """Forget every view of path (all mtimes, rates and layouts)"""
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == path]:
+                self._drop(key)
+            for key in [k for k in self._native_sr if k[0] == path]:
+                del self._native_sr[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._native_sr.clear()
+            self._bytes = 0
+
+    def set_memory_budget(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _native(self, path, mtime):
+        # the native decode is itself a cache entry, so it can be evicted like any view
+        native_key = (path, mtime, None, False)
+        cached = self._get(native_key)
+        if cached is not None:
+            return cached
+        y, native_sr = librosa.load(path, sr=None, mono=False)
+        y = np.ascontiguousarray(y, dtype=np.float32)
+        y.setflags(write=False)
+        self._native_sr[(path, mtime)] = native_sr
+        self._put(native_key, (y, native_sr))
+        return y, native_sr
+
+    def _canonical_key(self, path, mtime, sr, mono):
+        # views identical to the native decode share its entry instead of being stored twice
+        native_sr = self._native_sr.get((path, mtime))
+        if native_sr is not None and sr == native_sr:
+            sr = None
+        if mono:
+            native = self._entries.get((path, mtime, None, False))
+            if native is not None and native[0].ndim == 1:
+                mono = False
+        return (path, mtime, sr, mono)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key, entry):
+        if key in self._entries:
+            self._drop(key)
+        size = entry[0].nbytes
+        if size > self.max_bytes:
+            return  # too big to ever fit, hand it out uncached
+        self._entries[key] = entry
+        self._bytes += size
+        self._evict()
+
+    def _drop(self, key):
+        y, _ = self._entries.pop(key)
+        self._bytes -= y.nbytes
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+
+
+default_store = AudioStore()
+
+# (path, mtime, size) -> sha256 of the file, so a process hashes each file once
+_file_hashes = {}
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """sha256 of the file contents, the key of everything cached by content (separations, tempo maps, keys)"""
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    if memo_key not in _file_hashes:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+        _file_hashes[memo_key] = h.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def load(path, sr=22050, mono=True):
+    """librosa.load through the shared process-wide store"""
+    return default_store.load(path, sr=sr, mono=mono)
@@ -0,0 +1,482 @@
+"""Offline benchmarks of every pipeline stage on synthetic audio: no GPU, no network, no model download.
+
+    python benchmark.py                          # run and compare with benchmarks/baseline.json (if there is one)
+    python benchmark.py --save-baseline          # run and keep the result as the new baseline
+    python benchmark.py --durations 10 60 --repeat 5 --only get_tempo wav_to_drum_midi
+    python benchmark.py --backend onnx --only separate_stems    # separation on a CPU backend
+
+The inputs are generated on every run from fixed seeds, at each of --durations:
+
+    click    drum kit at a known tempo (kick on the beats, snare on 2 and 4, eighth hi-hats)
+    harmonic several voices of a chord progression, on the preview synth voices
+    sparse   the harmonic mix with long silences (gating / slicing paths)
+    song     click + harmonic mixed, the input of the tempo and separation stages
+
+plus the MIDIs of the same notes (one per stem and drums). Demucs is replaced by
+a stand-in so nothing has to be downloaded: --separator htdemucs (default) is
+the htdemucs_6s architecture with random weights (same compute as the real
+model, garbage stems), and --separator passthrough only scales the mix (to time
+the code around the model).
+
+Every benchmark runs in a scratch directory with the caches emptied before
+each repeat (audio store, tempo maps, separation cache off), and the best of
+--repeat runs is kept. The run is written to benchmarks/last_run.json. A
+benchmark regresses when it is more than --threshold times slower than the
+baseline (and slower by more than --min-seconds); any regression makes the
+exit status 1, and so does a benchmark that raised or a failed output check (on the click track,
+wav_to_drum_midi must find the same hits per drum as the old per-sample
+detection, and the streaming transcriber the same as wav_to_drum_midi).
+Baselines only make sense on the machine that recorded them.
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+import separation_backends
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(REPO_DIR, "benchmarks", "baseline.json")
+DEFAULT_OUTPUT = os.path.join(REPO_DIR, "benchmarks", "last_run.json")
+SAMPLE_RATE = 44100
+BENCH_BPM = 120
+DEFAULT_DURATIONS = (10, 30)
+DEFAULT_THRESHOLD = 1.25
+# differences smaller than this are noise, whatever the ratio
+DEFAULT_MIN_SECONDS = 0.02
+# stem: (GM program, MIDI pitch range) of the synthetic harmonic voices
+VOICE_STEMS = {'bass': (33, (28, 43)), 'piano': (0, (48, 72)), 'guitar': (25, (52, 76)), 'other': (48, (60, 84))}
+
+
+# synthetic inputs
+
+def click_notes(duration, bpm=BENCH_BPM):
+    """NoteTable of a plain rock beat: the known drum hits of the click track"""
+    import drumtest_1_1
+    from note_table import NoteTable, instrument_info
+
+    eighth = 30.0 / bpm
+    times = np.arange(0, duration - 0.5, eighth)
+    hits = [(t, drumtest_1_1.HIHAT, 70) for t in times]
+    hits += [(t, drumtest_1_1.KICK, 110) for t in times[0::2]]
+    hits += [(t, drumtest_1_1.SNARE, 100) for t in times[2::4]]
+    hits.sort()
+    start = np.array([t for t, _, _ in hits])
+    return NoteTable([p for _, p, _ in hits], start, start + 0.1, [v for _, _, v in hits], np.zeros(len(hits)),
+                     [instrument_info(0, True, 'drums')])
+
+
+def harmonic_notes(duration, bpm=BENCH_BPM, seed=0):
+    """{stem: NoteTable}: a I-V-vi-IV progression, one chord per bar, on every voice of VOICE_STEMS"""
+    from note_table import NoteTable, instrument_info
+
+    rng = np.random.default_rng(seed)
+    bar = 240.0 / bpm
+    chords = [[0, 4, 7], [7, 11, 14], [9, 12, 16], [5, 9, 12]]  # C G Am F
+    tables = {}
+    for stem, (program, (low, high)) in VOICE_STEMS.items():
+        pitch, start, end, velocity = [], [], [], []
+        for index, bar_start in enumerate(np.arange(0, duration - bar / 2, bar)):
+            chord = chords[index % len(chords)]
+            if stem == 'bass':
+                # root on every beat
+                for beat in range(4):
+                    pitch.append(low + (chord[0] % 12))
+                    start.append(bar_start + beat * bar / 4)
+                    end.append(bar_start + (beat + 0.9) * bar / 4)
+            else:
+                # arpeggio in eighths across the voice's range
+                for step in range(8):
+                    octave = low + 12 * ((step // 3) % max(1, (high - low) // 12))
+                    pitch.append(min(high, octave + chord[step % 3]))
+                    start.append(bar_start + step * bar / 8)
+                    end.append(bar_start + (step + 1) * bar / 8)
+            velocity.extend(rng.integers(70, 110, len(pitch) - len(velocity)))
+        tables[stem] = NoteTable(pitch, start, end, velocity, np.zeros(len(pitch)),
+                                 [instrument_info(program, False, stem)])
+    return tables
+
+
+def render(table, sr=SAMPLE_RATE):
+    import preview_synth
+
+    return preview_synth.render_preview(table, sr, tail=0.0)
+
+
+def fit(audio, duration, sr=SAMPLE_RATE):
+    """[2, duration * sr]: cut or zero-padded"""
+    out = np.zeros((2, int(duration * sr)), dtype=np.float32)
+    length = min(out.shape[1], audio.shape[1])
+    out[:, :length] = audio[:, :length]
+    return out
+
+
+def generate_inputs(duration, folder, sr=SAMPLE_RATE):
+    """Write the synthetic wavs and MIDIs of one duration to folder; returns {name: path} and the known values"""
+    import soundfile as sf
+    from note_table import NoteTable
+
+    os.makedirs(folder, exist_ok=True)
+    tag = f"bench{int(duration)}s"
+    drums = click_notes(duration)
+    voices = harmonic_notes(duration)
+    click = fit(render(drums, sr), duration, sr)
+    harmonic = fit(sum(fit(render(table, sr), duration, sr) for table in voices.values()), duration, sr)
+    # silent except for two short passages
+    gate = np.zeros(click.shape[1], dtype=np.float32)
+    for begin, length in ((0.1, 0.1), (0.6, 0.1)):
+        gate[int(begin * len(gate)):int((begin + length) * len(gate))] = 1.0
+    audio = {
+        'click': click,
+        'harmonic': harmonic,
+        'sparse': harmonic * gate,
+        'song': 0.5 * (click + harmonic),
+    }
+    paths = {}
+    for name, y in audio.items():
+        # <song>_<stem>.wav names, so the stems are routed like separated ones (drums -> drum transcriber)
+        stem = {'click': 'drums', 'harmonic': 'piano', 'sparse': 'other', 'song': None}[name]
+        file_name = f"{tag}_{name}_{stem}.wav" if stem else f"{tag}_{name}.wav"
+        paths[name] = os.path.join(folder, file_name)
+        sf.write(paths[name], np.clip(y, -1, 1).T, sr, subtype='PCM_16')
+    midi_paths = []
+    for stem, table in dict(voices, drums=drums).items():
+        midi_path = os.path.join(folder, f"{tag}_{stem}.mid")
+        table.write_midi(midi_path, tempo=BENCH_BPM)
+        midi_paths.append(midi_path)
+    paths['midis'] = midi_paths
+    paths['combined_midi'] = os.path.join(folder, f"{tag}_combined.mid")
+    NoteTable.merge(list(voices.values()) + [drums]).write_midi(paths['combined_midi'], tempo=BENCH_BPM)
+    known = {'bpm': BENCH_BPM, 'drum_hits': len(drums), 'notes': sum(len(table) for table in voices.values())}
+    return paths, known
+
+
+# stand-in separators
+
+class PassthroughSeparator(torch.nn.Module):
+    """Every stem is the mix times a fixed gain (same interface as a Demucs model)"""
+
+    samplerate = SAMPLE_RATE
+    audio_channels = 2
+    segment = 7.8
+
+    def __init__(self, sources):
+        super().__init__()
+        self.sources = sources
+        self.gains = torch.nn.Parameter(torch.linspace(0.2, 1.0, len(sources)), requires_grad=False)
+
+    def valid_length(self, length):
+        return length
+
+    def forward(self, mix):
+        return mix[:, None] * self.gains[None, :, None, None]
+
+
+def stand_in_separator(kind="htdemucs"):
+    """(model, device) that remixAi.load_separator hands out instead of downloading htdemucs_6s"""
+    import remixAi
+
+    if kind == "htdemucs":
+        from demucs.htdemucs import HTDemucs
+
+        torch.manual_seed(0)
+        model = HTDemucs(sources=list(remixAi.STEMS))
+    else:
+        model = PassthroughSeparator(list(remixAi.STEMS))
+    model.eval()
+    return model, torch.device("cpu")
+
+
+# running
+
+class Benchmark:
+
+    def __init__(self, name, func, audio_seconds=None, heavy=False, check=None):
+        self.name = name
+        self.func = func
+        self.audio_seconds = audio_seconds
+        # heavy: one run and no warm-up (the separation takes a while)
+        self.heavy = heavy
+        self.check = check
+
+
+def reset_caches(work_dir):
+    """Empty every in-process cache so each repeat starts cold"""
+    import audio_store
+    import key_detection
+    import tempo_analysis
+
+    audio_store.default_store.clear()
+    tempo_analysis._tempo_maps.clear()
+    key_detection._key_cache.clear()
+    shutil.rmtree(os.path.join(work_dir, "tempo_cache"), ignore_errors=True)
+
+
+def build_benchmarks(durations, inputs_dir, model, device):
+    import audio_store
+    import drum_stream
+    import drumtest_1_1
+    import remixAi
+
+    benchmarks = []
+    for duration in durations:
+        paths, known = generate_inputs(duration, os.path.join(inputs_dir, f"{int(duration)}s"))
+        tag = f"[{int(duration)}s]"
+        out = os.path.join("outputs", f"{int(duration)}s")
+        os.makedirs(out, exist_ok=True)
+
+        def tempo_check(bpm, known=known):
+            return {'bpm': round(float(bpm), 1), 'expected_bpm': known['bpm']}
+
+        def drum_check(counts, known=known, path=paths['click']):
+            # per band, the same counts as the old per-sample detection
+            y, sr = drumtest_1_1.prepare_drum_audio(*audio_store.load(path))
+            reference = drumtest_1_1.reference_drum_counts(y, sr)
+            mismatches = {band: [counts.get(band), hits] for band, hits in reference.items()
+                          if counts.get(band) != hits}
+            return {'hits': int(sum(counts.values())) if counts else 0, 'expected_hits': known['drum_hits'],
+                    'reference_mismatches': mismatches, 'ok': not mismatches}
+
+        def stream_drum_check(events, known=known, path=paths['click']):
+            # per band, the same counts as the offline engine
+            y, sr = drumtest_1_1.prepare_drum_audio(*audio_store.load(path))
+            offline, _ = drumtest_1_1.get_drum_engine(sr).detect(y)
+            counts = {band: sum(event.band == band for event in events) for band in offline}
+            mismatches = {band: [counts[band], len(frames)] for band, frames in offline.items()
+                          if counts[band] != len(frames)}
+            return {'hits': len(events), 'expected_hits': known['drum_hits'], 'offline_mismatches': mismatches,
+                    'ok': not mismatches}
+
+        benchmarks += [
+            Benchmark(f"get_tempo{tag}", lambda p=paths: remixAi.get_tempo(p['song'], None), duration,
+                      check=tempo_check),
+            Benchmark(f"separate_stems{tag}", lambda p=paths: remixAi.separate_stems(p['song'], model, device),
+                      duration, heavy=True),
+            Benchmark(f"separate_instruments{tag}",
+                      lambda p=paths: remixAi.separate_instruments(p['song'], model, device) or _failed(),
+                      duration, heavy=True),
+            Benchmark(f"separate_songs_packed{tag}",
+                      lambda p=paths, out=out: _packed_stems(remixAi.separate_songs_packed(
+                          [p['click'], p['harmonic'], p['sparse']], model=model, device=device, cache=False,
+                          output_dir=out)), 3 * duration, heavy=True),
+            Benchmark(f"mp3_to_midi{tag}",
+                      lambda p=paths, out=out: remixAi.mp3_to_midi(p['harmonic'], os.path.join(out, "piano.mid"),
+                                                                   raise_errors=True), duration),
+            Benchmark(f"mp3_to_midi_sparse{tag}",
+                      lambda p=paths, out=out: remixAi.mp3_to_midi(p['sparse'], os.path.join(out, "other.mid"),
+                                                                   raise_errors=True), duration),
+            Benchmark(f"wav_to_drum_midi{tag}",
+                      lambda p=paths, out=out: drumtest_1_1.wav_to_drum_midi(p['click'], os.path.join(out, "drums.mid")),
+                      duration, check=drum_check),
+            Benchmark(f"stream_file_to_midi{tag}",
+                      lambda p=paths, out=out: drum_stream.stream_file_to_midi(
+                          p['click'], os.path.join(out, "drums_stream.mid")), duration, check=stream_drum_check),
+            Benchmark(f"midi_to_musicxml{tag}",
+                      lambda p=paths, out=out: remixAi.midi_to_musicxml(p['midis'][1], os.path.join(out, "piano.xml"),
+                                                                        BENCH_BPM), duration),
+            Benchmark(f"midi_to_musicxml_music21{tag}",
+                      lambda p=paths, out=out: remixAi.midi_to_musicxml(p['midis'][1], os.path.join(out, "m21.xml"),
+                                                                        BENCH_BPM, fast=False), duration),
+            Benchmark(f"putting_midis_together{tag}",
+                      lambda p=paths, out=out: remixAi.putting_midis_together(
+                          p['midis'], os.path.join(out, "combined.mid")), duration),
+            Benchmark(f"midi_to_wav{tag}",
+                      lambda p=paths, out=out: remixAi.midi_to_wav(p['combined_midi'], os.path.join(out, "final.wav"))
+                      or _failed(), duration),
+            Benchmark(f"midi_to_preview_wav{tag}",
+                      lambda p=paths, out=out: remixAi.midi_to_preview_wav(
+                          p['combined_midi'], os.path.join(out, "preview.wav")) or _failed(), duration),
+        ]
+    return benchmarks
+
+
+def _failed():
+    raise RuntimeError("returned nothing (see the output of the stage)")
+
+
+def _packed_stems(results):
+    import stem_writer
+
+    if not all(result['stems'] for result in results):
+        _failed()
+    # the stems are written in the background, count the writes too
+    for result in results:
+        stem_writer.wait(result['stems'])
+    return results
+
+
+def run_benchmark(benchmark, repeat, work_dir, verbose=False):
+    """{'seconds': best, 'runs': [...], 'rtf', 'status', ...} of one benchmark"""
+    runs = []
+    result = {'audio_seconds': benchmark.audio_seconds}
+    attempts = 1 if benchmark.heavy else repeat + 1  # the first (warm-up) run isn't counted
+    for attempt in range(attempts):
+        reset_caches(work_dir)
+        sink = sys.stdout if verbose else io.StringIO()
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(sink), contextlib.redirect_stderr(sink):
+                value = benchmark.func()
+        except Exception as e:
+            return dict(result, status='error', error=f"{type(e).__name__}: {str(e)}")
+        elapsed = time.perf_counter() - start
+        if benchmark.heavy or attempt > 0:
+            runs.append(elapsed)
+    result.update(status='ok', seconds=min(runs), median=float(np.median(runs)), runs=[round(r, 4) for r in runs])
+    if benchmark.audio_seconds:
+        result['rtf'] = result['seconds'] / benchmark.audio_seconds
+    if benchmark.check is not None:
+        result['check'] = benchmark.check(value)
+    return result
+
+
+def machine_info():
+    return {'platform': platform.platform(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'torch': torch.__version__, 'torch_threads': torch.get_num_threads()}
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD, min_seconds=DEFAULT_MIN_SECONDS):
+    """{name: (status, ratio)}: 'regression', 'faster', 'ok', or 'new' / 'error'"""
+    thresholds = baseline.get('thresholds', {})
+    verdicts = {}
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if result['status'] != 'ok':
+            verdicts[name] = ('error', None)
+        elif before is None or before.get('status') != 'ok':
+            verdicts[name] = ('new', None)
+        else:
+            ratio = result['seconds'] / max(before['seconds'], 1e-9)
+            limit = thresholds.get(name, threshold)
+            if ratio > limit and result['seconds'] - before['seconds'] > min_seconds:
+                verdicts[name] = ('regression', ratio)
+            elif ratio < 1 / limit and before['seconds'] - result['seconds'] > min_seconds:
+                verdicts[name] = ('faster', ratio)
+            else:
+                verdicts[name] = ('ok', ratio)
+    return verdicts
+
+
+def print_table(results, verdicts):
+    print(f"\n{'benchmark':<36} {'best s':>9} {'rtf':>8} {'vs base':>9}  status")
+    for name, result in results.items():
+        status, ratio = verdicts.get(name, (result['status'], None))
+        seconds = f"{result['seconds']:.3f}" if 'seconds' in result else "-"
+        rtf = f"{result['rtf']:.4f}" if 'rtf' in result else "-"
+        versus = f"{ratio:.2f}x" if ratio is not None else "-"
+        extra = result.get('error') or (json.dumps(result['check']) if 'check' in result else "")
+        print(f"{name:<36} {seconds:>9} {rtf:>8} {versus:>9}  {status} {extra}")
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the pipeline stages on synthetic audio")
+    parser.add_argument("--durations", type=float, nargs="+", default=list(DEFAULT_DURATIONS),
+                        help="lengths in seconds of the synthetic inputs")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark (the best one is kept)")
+    parser.add_argument("--only", nargs="+", default=None, help="run the benchmarks whose name starts with these")
+    parser.add_argument("--separator", choices=["htdemucs", "passthrough"], default="htdemucs",
+                        help="stand-in for Demucs: random-weight htdemucs_6s or a gain-only passthrough")
+    parser.add_argument("--backend", choices=separation_backends.BACKENDS, default="fp32",
+                        help="CPU inference backend of the stand-in separator (see separation_backends)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="slowdown ratio over the baseline counted as a regression")
+    parser.add_argument("--min-seconds", type=float, default=DEFAULT_MIN_SECONDS,
+                        help="slowdowns smaller than this are never regressions")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory with the inputs/outputs")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the stages")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="remixai-bench-")
+    os.environ["REMIXAI_TEMPO_CACHE_DIR"] = os.path.join(work_dir, "tempo_cache")
+    os.environ["REMIXAI_LIBRARY_DIR"] = os.path.join(work_dir, "transcription_library")
+    previous_dir = os.getcwd()
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(work_dir)
+    soundfont = os.path.join(REPO_DIR, "GeneralUser-GS.sf2")
+    if os.path.exists(soundfont):
+        os.symlink(soundfont, os.path.join(work_dir, "GeneralUser-GS.sf2"))
+    try:
+        import remixAi
+        import tempo_analysis
+
+        remixAi.configure_torch_threads(args.threads)
+        tempo_analysis.default_cache = tempo_analysis.TempoCache(os.path.join(work_dir, "tempo_cache"))
+        model, device = stand_in_separator(args.separator)
+        # anything calling load_separator gets the stand-in too
+        remixAi._separators[remixAi.MODEL_NAME] = (model, device)
+        remixAi.configure_separation(args.backend)
+        model, device = remixAi.load_separator()
+
+        benchmarks = build_benchmarks(args.durations, os.path.join(work_dir, "inputs"), model, device)
+        if args.only:
+            benchmarks = [b for b in benchmarks if any(b.name.startswith(prefix) for prefix in args.only)]
+        results = {}
+        for benchmark in benchmarks:
+            print(f"{benchmark.name} ...", flush=True)
+            results[benchmark.name] = run_benchmark(benchmark, args.repeat, work_dir, args.verbose)
+    finally:
+        os.chdir(previous_dir)
+        if args.keep:
+            print(f"Scratch directory kept: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    run = {'created': time.strftime("%Y-%m-%dT%H:%M:%S"), 'machine': machine_info(), 'separator': args.separator,
+           'backend': args.backend, 'repeat': args.repeat, 'results': results}
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('machine', {}).get('platform') != run['machine']['platform']:
+            print("Warning: the baseline was recorded on another machine, ratios aren't meaningful")
+        if baseline.get('separator') != args.separator:
+            print(f"Warning: the baseline used the {baseline.get('separator')} separator")
+        if baseline.get('backend', 'fp32') != args.backend:
+            print(f"Warning: the baseline used the {baseline.get('backend', 'fp32')} backend")
+    verdicts = compare(results, baseline, args.threshold, args.min_seconds) if baseline else {}
+    print_table(results, verdicts)
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(dict(run, verdicts=verdicts), f, indent=2)
+    if args.save_baseline:
+        if baseline:
+            # merged: benchmarks left out with --only keep their old baseline, thresholds are kept
+            run['results'] = dict(baseline.get('results', {}), **results)
+            run['thresholds'] = baseline.get('thresholds', {})
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f"Baseline saved: {args.baseline}")
+    # a benchmark that raised is a failure, whatever the baseline says
+    errors = [name for name, result in results.items() if result['status'] != 'ok']
+    if errors:
+        print(f"{len(errors)} benchmarks failed: {', '.join(errors)}")
+    if args.save_baseline:
+        return 1 if errors else 0
+    regressions = [name for name, (status, _) in verdicts.items() if status == 'regression']
+    if regressions:
+        print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+    # checks of the output (e.g. drum hits against the reference detection), whatever the timings
+    failed_checks = [name for name, result in results.items() if not result.get('check', {}).get('ok', True)]
+    if failed_checks:
+        print(f"{len(failed_checks)} failed checks: {', '.join(failed_checks)}")
+    return 1 if regressions or failed_checks or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
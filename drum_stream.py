@@ -0,0 +1,185 @@
+"""Streaming drum-to-MIDI: audio blocks in, GM drum events out.
+
+wav_to_drum_midi needs the whole file (zero-phase filtfilt, global
+normalisation, peak picking over the full signal). StreamingDrumTranscriber
+does the same analysis online: causal band-pass filters whose state is kept
+between blocks (each applied twice, so they attenuate out-of-band hits as much
+as filtfilt and the offline heights still hold), a running peak instead of
+librosa.util.normalize, and peak picking with one hop of look-ahead. Events
+come out at most two hops (~23 ms at the defaults) after the peak of the
+filtered band, so it can follow a live feed. Velocities come from the peak |y|
+of the hit's hop: the causal filters move the band peak off the transient, so
+the offline rule (|y| at the band's peak sample) doesn't carry over.
+
+    transcriber = StreamingDrumTranscriber()
+    for block in blocks:                    # any block size
+        for event in transcriber.process(block):
+            ...                             # DrumEvent(time, note, velocity, duration)
+    transcriber.flush()
+"""
+import time
+from collections import namedtuple
+
+import librosa
+import numpy as np
+import pretty_midi
+from scipy.signal import sosfilt, sosfilt_zi
+
+from drumtest_1_1 import DRUM_BANDS, butter_bandpass_sos
+
+DrumEvent = namedtuple('DrumEvent', ['time', 'note', 'velocity', 'duration', 'band'])
+
+# the cymbal envelopes are an RMS over this many samples, like the offline 2048-sample frames
+RMS_WINDOW = 2048
+
+
+class StreamingDrumTranscriber:
+
+    def __init__(self, sr=22050, hop_length=256, bands=None, release_seconds=10.0):
+        self.sr = sr
+        self.hop_length = hop_length
+        self.bands = dict(DRUM_BANDS if bands is None else bands)
+        self.release_seconds = release_seconds
+        self.latency = 2 * hop_length / sr  # the hop being filled + one hop of look-ahead
+
+        # each band-pass twice in a row: the |H|^2 magnitude (stopband attenuation) of the offline filtfilt,
+        # so the offline heights apply; only the phase differs (causal)
+        self._sos = {name: np.vstack([butter_bandpass_sos(b['low'], b['high'], sr, b['order'])] * 2)
+                     for name, b in self.bands.items()}
+        self._zi = {name: sosfilt_zi(sos) * 0.0 for name, sos in self._sos.items()}
+        self._distance = {name: max(1, int(round(b['distance'] * sr / hop_length))) for name, b in self.bands.items()}
+        self._rms_hops = max(1, RMS_WINDOW // hop_length)
+
+        self._pending = np.zeros(0, dtype=np.float32)  # samples that don't fill a hop yet
+        self._frame = 0  # index of the next hop frame
+        self._peak = 0.0  # running peak used instead of a global normalisation
+        # per band: envelope of the last two frames (for the local-max test) and the last hit
+        self._previous = {name: np.zeros(2) for name in self.bands}
+        self._previous_full = 0.0
+        self._last_hit = {name: -10 ** 9 for name in self.bands}
+        self._mean_square = {name: np.zeros(self._rms_hops - 1) for name in self.bands
+                             if self.bands[name]['envelope'] == 'rms'}
+
+    def process(self, block):
+        """Feed a block of audio (mono or [channels, samples], at self.sr); returns the new DrumEvents"""
+        block = np.asarray(block, dtype=np.float32)
+        if block.ndim > 1:
+            block = librosa.to_mono(block)
+        block = np.clip(np.nan_to_num(block, nan=0.0, posinf=1.0, neginf=-1.0), -1.0, 1.0)
+
+        samples = np.concatenate([self._pending, block])
+        n_frames = len(samples) // self.hop_length
+        self._pending = samples[n_frames * self.hop_length:]
+        if n_frames == 0:
+            return []
+        samples = samples[:n_frames * self.hop_length]
+
+        # running peak with a slow release, standing in for librosa.util.normalize
+        release = np.exp(-len(samples) / (self.release_seconds * self.sr))
+        self._peak = max(self._peak * release, float(np.max(np.abs(samples))))
+        gain = 1.0 / max(self._peak, 1e-4)
+
+        full = np.abs(samples).reshape(n_frames, self.hop_length).max(axis=1) * gain
+        events = []
+        for name, band in self.bands.items():
+            filtered, self._zi[name] = sosfilt(self._sos[name], samples, zi=self._zi[name])
+            frames = filtered.reshape(n_frames, self.hop_length)
+            if band['envelope'] == 'rms':
+                mean_square = np.concatenate([self._mean_square[name], np.mean(frames ** 2, axis=1)])
+                if len(self._mean_square[name]):
+                    self._mean_square[name] = mean_square[-len(self._mean_square[name]):]
+                window = np.ones(self._rms_hops) / self._rms_hops
+                envelope = np.sqrt(np.convolve(mean_square, window, mode='valid')) * gain
+            else:
+                envelope = np.abs(frames).max(axis=1) * gain
+            events.extend(self._pick(name, band, envelope, full))
+
+        self._previous_full = full[-1]
+        self._frame += n_frames
+        events.sort(key=lambda event: event.time)
+        return events
+
+    def _pick(self, name, band, envelope, full):
+        # frame i of `values` is global frame self._frame - 2 + i; a frame is decided once its successor is known
+        values = np.concatenate([self._previous[name], envelope])
+        full = np.concatenate([[0.0, self._previous_full], full])
+        candidates = np.flatnonzero((values[1:-1] >= band['height'])
+                                    & (values[1:-1] > values[:-2])
+                                    & (values[1:-1] >= values[2:])) + 1
+        self._previous[name] = values[-2:]
+
+        events = []
+        for i in candidates:
+            frame = self._frame - 2 + i
+            if frame < 0 or frame - self._last_hit[name] < self._distance[name]:
+                continue
+            self._last_hit[name] = frame
+            velocity = int(np.clip(band['velocity'] * (full[i] / 0.1), 1, 127))
+            sample = frame * self.hop_length
+            if band['envelope'] == 'rms':
+                # the RMS window ends with the frame, the offline one is centred on it
+                sample = max(0, sample + self.hop_length - self._rms_hops * self.hop_length // 2)
+            events.append(DrumEvent(sample / self.sr, band['note'], velocity, band['duration'], name))
+        return events
+
+    def flush(self):
+        """Events still held back by the look-ahead, at the end of the stream"""
+        return self.process(np.zeros(2 * self.hop_length - len(self._pending) % self.hop_length,
+                                     dtype=np.float32))
+
+
+def events_to_midi(events, output_file=None):
+    """PrettyMIDI with one drum instrument out of DrumEvents (written to output_file if given)"""
+    pm = pretty_midi.PrettyMIDI()
+    drum_program = pretty_midi.Instrument(program=0, is_drum=True)
+    drum_program.notes = [pretty_midi.Note(velocity=e.velocity, pitch=e.note, start=e.time, end=e.time + e.duration)
+                          for e in events]
+    pm.instruments.append(drum_program)
+    if output_file:
+        pm.write(output_file)
+    return pm
+
+
+def file_blocks(path, sr=22050, block_seconds=0.05):
+    """Mono blocks of an audio file at sr, read incrementally (stands in for a live feed)"""
+    import soundfile as sf
+    import soxr
+
+    with sf.SoundFile(path) as f:
+        resampler = soxr.ResampleStream(f.samplerate, sr, 1, dtype='float32') if f.samplerate != sr else None
+        block_frames = max(1, int(block_seconds * f.samplerate))
+        while True:
+            block = f.read(block_frames, dtype='float32', always_2d=True).mean(axis=1)
+            last = len(block) < block_frames
+            if resampler is not None:
+                block = resampler.resample_chunk(block, last=last)
+            if len(block):
+                yield block
+            if last:
+                break
+
+
+def stream_file_to_midi(wav_file, output_file, block_seconds=0.05):
+    """Run a file through the streaming transcriber block by block and write the MIDI"""
+    transcriber = StreamingDrumTranscriber()
+    events = []
+    audio_seconds = 0.0
+    start = time.perf_counter()
+    for block in file_blocks(wav_file, transcriber.sr, block_seconds):
+        audio_seconds += len(block) / transcriber.sr
+        events.extend(transcriber.process(block))
+    events.extend(transcriber.flush())
+    elapsed = time.perf_counter() - start
+    print(f"{len(events)} drum events, {audio_seconds:.1f}s of audio in {elapsed:.2f}s "
+          f"({audio_seconds / elapsed if elapsed else float('inf'):.0f}x real time, "
+          f"latency {transcriber.latency * 1000:.0f} ms)")
+    events_to_midi(events, output_file)
+    return events
+
+
+if __name__ == "__main__":
+    import sys
+
+    wav_file = sys.argv[1] if len(sys.argv) > 1 else "separated_wavs/trial_ensemble_drums.wav"
+    output_file = sys.argv[2] if len(sys.argv) > 2 else "separated_wavs/trial_ensemble_drums_stream.mid"
+    stream_file_to_midi(wav_file, output_file)
@@ -1,10 +1,36 @@
+import functools
 import numpy as np
 import librosa
 import pretty_midi
-from scipy.signal import find_peaks, butter, filtfilt
+import audio_store
+from scipy.signal import find_peaks, butter, filtfilt, sosfiltfilt
 import matplotlib.pyplot as plt
 
-def butter_bandpass(lowcut, highcut, fs, order=5):
+# MIDI note numbers for drum kit (General MIDI standard)
+KICK = 36      # Bass Drum 1
+SNARE = 38     # Acoustic Snare
+HIHAT = 42     # Closed Hi-Hat
+HIGH_TOM = 50  # High Tom
+MID_TOM = 47   # Mid Tom
+LOW_TOM = 45   # Low Tom
+CRASH = 49     # Crash Cymbal 1
+RIDE = 51      # Ride Cymbal 1
+
+# One entry per drum: band-pass range (Hz), filter order, GM note, base velocity, note duration (s),
+# peak height, minimum distance between hits (s) and which envelope the peaks are picked on
+# ('peak' is the peak |filtered signal| of every hop, 'rms' the cymbal decay envelope)
+DRUM_BANDS = {
+    'kick':     dict(low=30,   high=150,   order=3, note=KICK,     velocity=100, duration=0.1, height=0.15, distance=0.25,  envelope='peak'),
+    'snare':    dict(low=200,  high=700,   order=3, note=SNARE,    velocity=90,  duration=0.1, height=0.15, distance=0.25,  envelope='peak'),
+    'hihat':    dict(low=1200, high=16000, order=3, note=HIHAT,    velocity=70,  duration=0.1, height=0.01, distance=0.125, envelope='peak'),  # adjusted for eighth hihats
+    'high_tom': dict(low=450,  high=550,   order=5, note=HIGH_TOM, velocity=85,  duration=0.1, height=0.1,  distance=0.0,   envelope='peak'),
+    #'mid_tom': dict(low=350,  high=450,   order=5, note=MID_TOM,  velocity=85,  duration=0.1, height=0.1,  distance=0.0,   envelope='peak'),
+    #'low_tom': dict(low=200,  high=350,   order=5, note=LOW_TOM,  velocity=85,  duration=0.1, height=0.1,  distance=0.0,   envelope='peak'),
+    'crash':    dict(low=5000, high=15000, order=5, note=CRASH,    velocity=90,  duration=1.0, height=0.1,  distance=1.16,  envelope='rms'),   # longer notes for the decay
+    'ride':     dict(low=2000, high=7000,  order=5, note=RIDE,     velocity=85,  duration=0.5, height=0.1,  distance=1.16,  envelope='rms'),
+}
+
+def _band_edges(lowcut, highcut, fs):
     nyq = fs * 0.5  # Frecuencia de Nyquist
     low = lowcut / nyq 
     high = highcut / nyq
@@ -12,18 +38,120 @@ def butter_bandpass(lowcut, highcut, fs, order=5):
     # Asegurarnos de que los valores estén entre 0 y 1
     low = max(0.001, min(0.99, low))
     high = max(0.001, min(0.99, high))
-    
-    print(f"Low: {low}, High: {high}")  # Debug
-    
+    return low, high
+
+@functools.lru_cache(maxsize=None)
+def butter_bandpass(lowcut, highcut, fs, order=5):
+    low, high = _band_edges(lowcut, highcut, fs)
     b, a = butter(order, [low, high], btype='band') #only lets through frequencies between low and high
     #order is how steep the filter is, higher = steeper
     return b, a
 
+@functools.lru_cache(maxsize=None)
+def butter_bandpass_sos(lowcut, highcut, fs, order=5):
+    """Same filter as butter_bandpass as second-order sections (numerically stable, designed once)"""
+    low, high = _band_edges(lowcut, highcut, fs)
+    return butter(order, [low, high], btype='band', output='sos')
+
 def bandpass_filter(data, lowcut, highcut, fs, order=5):
     b, a = butter_bandpass(lowcut, highcut, fs, order=order)
     y = filtfilt(b, a, data)
     return y
 
+class DrumAnalysisEngine:
+    """Every drum band of a signal, with the peaks picked at hop rate
+
+    Each band is the same zero-phase Butterworth band-pass the old per-drum
+    filtfilt calls applied, one sosfiltfilt pass per band (designs cached as
+    second-order sections). The filtered signals are reduced to hop-rate
+    envelopes right away: 'peak' bands to the peak |filtered signal| of every
+    hop, so the old sample-peak heights still apply, and the cymbals to
+    librosa.feature.rms as before. Peaks are then picked on these envelopes
+    instead of on every sample. Velocities come from |y| at the sample where
+    the band peaks within the hit's hop, like the old per-sample peaks (the
+    cymbals, picked on RMS frames, use the frame's centre sample).
+    """
+
+    def __init__(self, sr=22050, hop_length=512, frame_length=2048, bands=None):
+        self.sr = sr
+        self.hop_length = hop_length
+        self.frame_length = frame_length  # of the cymbal RMS
+        self.bands = dict(DRUM_BANDS if bands is None else bands)
+        self.filters = {name: butter_bandpass_sos(band['low'], band['high'], sr, band['order'])
+                        for name, band in self.bands.items()}
+
+    def frame_peaks(self, x):
+        """Peak |x| of every hop and the sample it is at, frame t centred on sample t * hop_length like librosa's"""
+        hop = self.hop_length
+        n_frames = 1 + len(x) // hop
+        frames = np.pad(np.abs(x), (hop // 2, hop))[:n_frames * hop].reshape(n_frames, hop)
+        offsets = frames.argmax(axis=1)
+        samples = np.clip(np.arange(n_frames) * hop - hop // 2 + offsets, 0, max(len(x) - 1, 0))
+        return frames[np.arange(n_frames), offsets], samples
+
+    def envelopes(self, y):
+        """{band: envelope at hop rate}, and {band: |y| at every hop's band peak} for the velocities"""
+        envelopes, amplitudes = {}, {}
+        for name, band in self.bands.items():
+            filtered = sosfiltfilt(self.filters[name], y)
+            if band['envelope'] == 'rms':
+                envelopes[name] = librosa.feature.rms(y=filtered, frame_length=self.frame_length,
+                                                      hop_length=self.hop_length)[0]
+                samples = np.minimum(np.arange(len(envelopes[name])) * self.hop_length, len(y) - 1)
+            else:
+                envelopes[name], samples = self.frame_peaks(filtered)
+            amplitudes[name] = np.abs(y[samples])
+        return envelopes, amplitudes
+
+    def detect(self, y):
+        """{band: frame indices of the hits}, plus {band: |y| at every hop's band peak} for the velocities"""
+        envelopes, amplitudes = self.envelopes(y)
+        hits = {}
+        for name, band in self.bands.items():
+            # rounded down: never further apart than the old distance in samples
+            distance = max(1, int(band['distance'] * self.sr / self.hop_length))
+            # a leading zero so a hit in the very first frame is still a peak
+            peaks, _ = find_peaks(np.concatenate([[0.0], envelopes[name]]), height=band['height'], distance=distance)
+            hits[name] = peaks - 1
+        return hits, amplitudes
+
+    def notes(self, hits, amplitudes):
+        """Columns (start, end, pitch, velocity) of every hit, sorted by time"""
+        starts, ends, pitches, velocities = [], [], [], []
+        for name, frames in hits.items():
+            band = self.bands[name]
+            start = frames * self.hop_length / self.sr  # Convert frame position to seconds
+            # Scale the amplitude at the hit to MIDI velocity (1-127)
+            velocity = np.clip((band['velocity'] * (amplitudes[name][frames] / 0.1)).astype(int), 1, 127)
+            starts.append(start)
+            ends.append(start + band['duration'])
+            pitches.append(np.full(len(frames), band['note']))
+            velocities.append(velocity)
+        if not starts:
+            return np.zeros(0), np.zeros(0), np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        starts, ends, pitches, velocities = (np.concatenate(c) for c in (starts, ends, pitches, velocities))
+        order = np.argsort(starts, kind='stable')
+        return starts[order], ends[order], pitches[order], velocities[order]
+
+    def transcribe(self, y):
+        """PrettyMIDI with one drum instrument, and the number of hits per band"""
+        hits, amplitudes = self.detect(y)
+        starts, ends, pitches, velocities = self.notes(hits, amplitudes)
+
+        pm = pretty_midi.PrettyMIDI()
+        drum_program = pretty_midi.Instrument(program=0, is_drum=True)
+        drum_program.notes = [pretty_midi.Note(velocity=int(v), pitch=int(p), start=float(s), end=float(e))
+                              for s, e, p, v in zip(starts, ends, pitches, velocities)]
+        pm.instruments.append(drum_program)
+        return pm, {f'{name}_hits': len(frames) for name, frames in hits.items()}
+
+_engines = {}
+
+def get_drum_engine(sr=22050):
+    if sr not in _engines:
+        _engines[sr] = DrumAnalysisEngine(sr)
+    return _engines[sr]
+
 def wav_to_drum_midi(wav_file, output_file):
     """
     Convert drum hits in a WAV file to MIDI events.
@@ -33,7 +161,35 @@ def wav_to_drum_midi(wav_file, output_file):
     output_file (str): Path to output MIDI file
     """
     # Cargar el archivo WAV
-    y, sr = librosa.load(wav_file)
+    y, sr = audio_store.load(wav_file)
+    return audio_to_drum_midi(y, sr, output_file)
+
+def audio_to_drum_midi(y, sr, output_file):
+    """
+    Convert drum hits in an audio array to MIDI events (no WAV file needed).
+    
+    Parameters:
+    y (np.ndarray): audio, mono or [channels, samples]
+    sr (int): sample rate of y (resampled to 22050 Hz, like librosa.load does for wav_to_drum_midi)
+    output_file (str): Path to output MIDI file
+    """
+    y, sr = prepare_drum_audio(y, sr)
+
+    # one zero-phase band-pass per drum, peaks picked on hop-rate envelopes
+    pm, drum_counts = get_drum_engine(sr).transcribe(y)
+    
+    # Save the MIDI file
+    pm.write(output_file)
+    
+    return drum_counts
+
+def prepare_drum_audio(y, sr):
+    """Mono, 22050 Hz, cleaned and normalized: what the drum detection runs on"""
+    if y.ndim > 1:
+        y = librosa.to_mono(y)
+    if sr != 22050:
+        y = librosa.resample(y, orig_sr=sr, target_sr=22050)
+        sr = 22050
     
     # Limpieza exhaustiva de la señal
     y = np.nan_to_num(y, nan=0.0, posinf=1.0, neginf=-1.0)
@@ -51,126 +207,29 @@ def wav_to_drum_midi(wav_file, output_file):
     # Verificación estricta
     if not np.all(np.isfinite(y)):
         raise ValueError("No se pudo limpiar la señal correctamente")
-    
-    # Reducir el orden del filtro Butterworth
-    y_hihat = bandpass_filter(y, 1200, 16000, sr, order=3)  # adjusted for eighth hihats
-    y_snare = bandpass_filter(y, 200, 700, sr, order=3)
-    y_kick = bandpass_filter(y, 30, 150, sr, order=3)
-    
-    # Usar parámetros más seguros para onset_detect
-    onset_hihat = librosa.onset.onset_detect(
-        y=y_hihat, sr=sr,
-        delta=0.03,
-        wait=2,
-        pre_max=20,
-        post_max=20,
-        pre_avg=100,
-        post_avg=100,
-        units='time'
-    )
-    
-    # Ajustar detección para kick y snare
-    onset_kick = librosa.onset.onset_detect(
-        y=y_kick, sr=sr,
-        delta=0.2,     # Menos sensible para evitar falsos positivos
-        wait=10,       # Mayor espera para evitar detecciones múltiples
-        units='time'
-    )
-    
-    onset_snare = librosa.onset.onset_detect(
-        y=y_snare, sr=sr,
-        delta=0.2,
-        wait=10,
-        units='time'
-    )
-    
-    # Filter signals for different drums using specific frequency ranges
-    y_high_tom = bandpass_filter(y, 450, 550, sr)  # High tom
-    #y_mid_tom = bandpass_filter(y, 350, 450, sr)  # Mid tom
-    y_low_tom = bandpass_filter(y, 200, 350, sr)  # Low tom
-    y_crash = bandpass_filter(y, 5000, 15000, sr)  # Crash cymbal
-    y_ride = bandpass_filter(y, 2000, 7000, sr)  # Ride cymbal
-    
-    # Calculate RMS energy for cymbal decay detection
-    def get_cymbal_envelope(signal, frame_length=2048):
-        return librosa.feature.rms(y=signal, frame_length=frame_length)[0]
-    
-    crash_env = get_cymbal_envelope(y_crash)
-    ride_env = get_cymbal_envelope(y_ride)
-    
-    # Ajustar los umbrales de peaks
-    hihat_peaks, _ = find_peaks(np.abs(y_hihat), height=0.01, distance=int(sr/8))  # determinant for eighth hihats
-    kick_peaks, _ = find_peaks(np.abs(y_kick), height=0.15, distance=int(sr/4))
-    snare_peaks, _ = find_peaks(np.abs(y_snare), height=0.15, distance=int(sr/4))
-    high_tom_peaks, _ = find_peaks(np.abs(y_high_tom), height=0.1, distance=50)
-    #mid_tom_peaks, _ = find_peaks(np.abs(y_mid_tom), height=0.1, distance=50)
-    #low_tom_peaks, _ = find_peaks(np.abs(y_low_tom), height=0.1, distance=50)
-    crash_peaks, _ = find_peaks(crash_env, height=0.1, distance=50)
-    ride_peaks, _ = find_peaks(ride_env, height=0.1, distance=50)
-    
-    # Create a MIDI file
-    pm = pretty_midi.PrettyMIDI()
-    drum_program = pretty_midi.Instrument(program=0, is_drum=True)
-    
-    # MIDI note numbers for drum kit (General MIDI standard)
-    KICK = 36      # Bass Drum 1
-    SNARE = 38     # Acoustic Snare
-    HIHAT = 42     # Closed Hi-Hat
-    HIGH_TOM = 50  # High Tom
-    MID_TOM = 47   # Mid Tom
-    LOW_TOM = 45   # Low Tom
-    CRASH = 49     # Crash Cymbal 1
-    RIDE = 51      # Ride Cymbal 1
-    
-    # Convert peak positions to MIDI notes with variable note duration
-    def peaks_to_notes(peak_positions, note_number, velocity=100, duration=0.1):
-        for peak in peak_positions:
-            # Get the amplitude at the peak for velocity
-            amplitude = np.abs(y[peak])
-            # Scale amplitude to MIDI velocity (0-127)
-            scaled_velocity = min(127, int(velocity * (amplitude / 0.1)))
-            
-            note = pretty_midi.Note(
-                velocity=scaled_velocity,
-                pitch=note_number,
-                start=peak/sr,  # Convert sample position to seconds
-                end=(peak/sr) + duration  # Note duration
-            )
-            drum_program.notes.append(note)
-    
-    # Add notes for each drum type
-    peaks_to_notes(kick_peaks, KICK, velocity=100)
-    peaks_to_notes(snare_peaks, SNARE, velocity=90)
-    peaks_to_notes(hihat_peaks, HIHAT, velocity=70) 
-    peaks_to_notes(high_tom_peaks, HIGH_TOM, velocity=85)
-    #peaks_to_notes(mid_tom_peaks, MID_TOM, velocity=85)
-    #peaks_to_notes(low_tom_peaks, LOW_TOM, velocity=85)
-    # Longer duration for cymbals to capture their decay
-    peaks_to_notes(crash_peaks, CRASH, velocity=90, duration=1.0)
-    peaks_to_notes(ride_peaks, RIDE, velocity=85, duration=0.5)
-    
-    # Add the drum program to the MIDI file
-    pm.instruments.append(drum_program)
-    
-    # Save the MIDI file
-    pm.write(output_file)
-    
-    drum_counts = {
-        'kick_hits': len(kick_peaks),
-        'snare_hits': len(snare_peaks),
-        'hihat_hits': len(hihat_peaks),
-        'high_tom_hits': len(high_tom_peaks),
-        #'mid_tom_hits': len(mid_tom_peaks),
-        #'low_tom_hits': len(low_tom_peaks),
-        'crash_hits': len(crash_peaks),
-        'ride_hits': len(ride_peaks)
-    }
-    
-    return drum_counts
+    return y, sr
+
+def reference_drum_counts(y, sr=22050):
+    """Hits per band the way wav_to_drum_midi used to find them (one filtfilt per band, peaks on every
+    sample), for checking DrumAnalysisEngine against it. y as returned by prepare_drum_audio. Slow.
+    """
+    counts = {}
+    for name, band in DRUM_BANDS.items():
+        filtered = bandpass_filter(y, band['low'], band['high'], sr, order=band['order'])
+        if band['envelope'] == 'rms':
+            # distance was 50 RMS frames (of 512 samples)
+            envelope = librosa.feature.rms(y=filtered, frame_length=2048)[0]
+            distance = max(1, int(band['distance'] * sr / 512))
+        else:
+            envelope = np.abs(filtered)
+            distance = int(band['distance'] * sr) or 50  # the toms used 50 samples
+        peaks, _ = find_peaks(envelope, height=band['height'], distance=distance)
+        counts[f'{name}_hits'] = len(peaks)
+    return counts
 
 def wav_to_numpy(wav_file):
     # Cargar el archivo WAV
-    y, sr = librosa.load(wav_file)
+    y, sr = audio_store.load(wav_file)
     
     # Convertir a array numpy y normalizar
     audio_array = np.array(y)
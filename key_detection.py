@@ -0,0 +1,76 @@
+"""Key estimation straight from a NoteTable, no music21 parse needed.
+
+Same idea as music21's stream.analyze('key') (Krumhansl-Schmuckler): a
+pitch-class histogram weighted by note duration is correlated with the 12
+rotations of a major and a minor key profile, and the best correlation wins.
+The default profile is the Aarden-Essen one music21 uses for 'key', so the
+exported scores keep the keys they had.
+
+    tonic, mode, correlation = estimate_key(table)     # ('E-', 'major', 0.87), or None
+"""
+import numpy as np
+
+import audio_store
+
+PROFILES = {
+    'aarden': ([17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587, 0.291248, 22.062, 0.145624, 8.15494,
+                0.232998, 4.95122],
+               [18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362, 0.702494, 18.6161, 4.56621, 1.93186,
+                7.37619, 1.75623]),
+    'krumhansl': ([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88],
+                  [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]),
+}
+DEFAULT_PROFILE = 'aarden'
+
+# tonic spelling per pitch class (the enharmonics music21 picks for each mode)
+MAJOR_TONICS = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'A-', 'A', 'B-', 'B']
+MINOR_TONICS = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
+
+# (file hash, profile) -> estimate, so a MIDI exported several times is only analysed once
+_key_cache = {}
+
+
+def pitch_class_histogram(table):
+    """Seconds of sounding time per pitch class (drum notes left out)"""
+    pitched = ~table.is_drum
+    return np.bincount(table.pitch[pitched] % 12, weights=table.duration[pitched], minlength=12)
+
+
+def _rotations(profile):
+    """[12, 12]: row i is the profile with its tonic moved to pitch class i"""
+    profile = np.asarray(profile, dtype=np.float64)
+    return np.stack([np.roll(profile, i) for i in range(12)])
+
+
+def key_correlations(histogram, profile=DEFAULT_PROFILE):
+    """Pearson correlation of the histogram with every major and minor key: ([12], [12])"""
+    histogram = np.asarray(histogram, dtype=np.float64) - np.mean(histogram)
+    correlations = []
+    for weights in PROFILES[profile]:
+        rotations = _rotations(weights)
+        rotations -= rotations.mean(axis=1, keepdims=True)
+        denominator = np.sqrt(np.sum(rotations ** 2, axis=1) * np.sum(histogram ** 2))
+        correlations.append(np.divide(rotations @ histogram, denominator,
+                                      out=np.zeros(12), where=denominator > 0))
+    return correlations[0], correlations[1]
+
+
+def estimate_key(table, profile=DEFAULT_PROFILE):
+    """(tonic, mode, correlation) of the pitched notes of table, or None if there are none"""
+    histogram = pitch_class_histogram(table)
+    if not histogram.any():
+        return None
+    major, minor = key_correlations(histogram, profile)
+    if major.max() >= minor.max():
+        tonic = int(np.argmax(major))
+        return MAJOR_TONICS[tonic], 'major', float(major[tonic])
+    tonic = int(np.argmax(minor))
+    return MINOR_TONICS[tonic], 'minor', float(minor[tonic])
+
+
+def midi_key(midi_path, table, profile=DEFAULT_PROFILE):
+    """estimate_key for the table read from midi_path, cached by the file's content hash"""
+    cache_key = (audio_store.hash_file(midi_path), profile)
+    if cache_key not in _key_cache:
+        _key_cache[cache_key] = estimate_key(table, profile)
+    return _key_cache[cache_key]
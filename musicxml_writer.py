@@ -0,0 +1,282 @@
+"""Fast MusicXML export: NoteTable in, <part>/<measure>/<note> elements out.
+
+midi_to_musicxml in remixAi builds one music21 Note per MIDI note and runs
+makeNotation() over every part, which gets slow and memory hungry on dense
+stems. This writer quantizes all notes at once to a grid of `divisions`
+steps per beat at the song tempo, splits the ones crossing a barline into
+tied pieces, and writes the score measure by measure straight to the file.
+
+Same layout as the music21 export: piano split into a treble and a bass part
+at MIDDLE_C, bass in F clef, guitar and everything else in G clef, tempo mark
+on the first part. Drums are exported as well, as unpitched notes on a
+percussion staff.
+
+    write_musicxml(table, "midi_files/song_piano.xml", tempo=120, key=('E-', 'major'))
+"""
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pretty_midi
+
+import key_detection
+from note_table import NoteTable
+
+DIVISIONS = 4  # steps per quarter note: a sixteenth-note grid
+MIDDLE_C = 60
+
+# sharps/flats per key signature, for the tonic names key_detection returns
+MAJOR_FIFTHS = {'C': 0, 'G': 1, 'D': 2, 'A': 3, 'E': 4, 'B': 5, 'F#': 6, 'C#': 7,
+                'F': -1, 'B-': -2, 'E-': -3, 'A-': -4, 'D-': -5, 'G-': -6, 'C-': -7}
+MINOR_FIFTHS = {'A': 0, 'E': 1, 'B': 2, 'F#': 3, 'C#': 4, 'G#': 5, 'D#': 6, 'A#': 7,
+                'D': -1, 'G': -2, 'C': -3, 'F': -4, 'B-': -5, 'E-': -6, 'A-': -7}
+
+SHARP_SPELLING = [('C', 0), ('C', 1), ('D', 0), ('D', 1), ('E', 0), ('F', 0),
+                  ('F', 1), ('G', 0), ('G', 1), ('A', 0), ('A', 1), ('B', 0)]
+FLAT_SPELLING = [('C', 0), ('D', -1), ('D', 0), ('E', -1), ('E', 0), ('F', 0),
+                 ('G', -1), ('G', 0), ('A', -1), ('A', 0), ('B', -1), ('B', 0)]
+
+CLEFS = {
+    'treble': '<clef><sign>G</sign><line>2</line></clef>',
+    'bass': '<clef><sign>F</sign><line>4</line></clef>',
+    'percussion': '<clef><sign>percussion</sign></clef>',
+}
+
+
+def note_values(divisions=DIVISIONS):
+    """[(duration in divisions, type, dots), ...] longest first, for every writable note value"""
+    values = []
+    for name, quarters in (('whole', 4), ('half', 2), ('quarter', 1), ('eighth', 0.5), ('16th', 0.25),
+                           ('32nd', 0.125), ('64th', 0.0625)):
+        for dots in range(3):
+            duration = quarters * divisions * (2 - 0.5 ** dots)
+            if duration >= 1 and duration == int(duration):
+                values.append((int(duration), name, dots))
+    return sorted(values, reverse=True)
+
+
+def split_duration(duration, values):
+    """Pieces (duration, type, dots) that add up to duration, longest first (tied when written)"""
+    pieces = []
+    while duration > 0:
+        piece = next((value for value in values if value[0] <= duration), values[-1])
+        pieces.append(piece)
+        duration -= piece[0]
+    return pieces
+
+
+def key_fifths(key):
+    if key is None:
+        return 0, 'major'
+    tonic, mode = key[0], key[1]
+    fifths = (MAJOR_FIFTHS if mode == 'major' else MINOR_FIFTHS).get(tonic, 0)
+    return fifths, mode
+
+
+def quantize(table, tempo, divisions=DIVISIONS, tempo_map=None):
+    """Onset and duration of every note in divisions of a beat; durations are at least 1
+
+    The beats are those of tempo_map (tempo_analysis.TempoMap) when given,
+    otherwise a constant tempo (BPM).
+    """
+    if tempo_map is not None:
+        onset = np.round(tempo_map.seconds_to_beats(table.start) * divisions).astype(np.int64)
+        end = np.round(tempo_map.seconds_to_beats(table.end) * divisions).astype(np.int64)
+    else:
+        steps_per_second = tempo / 60.0 * divisions
+        onset = np.round(table.start * steps_per_second).astype(np.int64)
+        end = np.round(table.end * steps_per_second).astype(np.int64)
+    return np.maximum(onset, 0), np.maximum(end - onset, 1)
+
+
+def score_parts(table):
+    """The parts of the score: [{'name', 'clef', 'program', 'is_drum', 'rows'}, ...]"""
+    parts = []
+    for index, meta in enumerate(table.instruments):
+        rows = np.flatnonzero(table.instrument == index)
+        if len(rows) == 0:
+            continue
+        program, is_drum = meta['program'], meta['is_drum']
+        if is_drum:
+            split = [('Percussion', 'percussion', rows)]
+        elif program in range(0, 8):  # Piano: right hand (treble) and left hand (bass)
+            high = table.pitch[rows] >= MIDDLE_C
+            split = [('Piano', 'treble', rows[high]), ('Piano', 'bass', rows[~high])]
+        elif program in range(32, 40):
+            split = [('Electric Bass', 'bass', rows)]
+        elif program in range(24, 32):
+            split = [('Electric Guitar', 'treble', rows)]
+        else:
+            split = [(pretty_midi.program_to_instrument_name(program), 'treble', rows)]
+        for name, clef, part_rows in split:
+            parts.append({'name': name, 'clef': clef, 'program': program, 'is_drum': is_drum, 'rows': part_rows})
+    return parts
+
+
+def split_at_barlines(onset, duration, measure_length):
+    """Cut notes crossing a barline into pieces, all at once
+
+    Returns (note index, measure, start in measure, length, tie_stop, tie_start)
+    of every piece; tie_stop / tie_start say the piece continues a previous one
+    / is continued in the next measure.
+    """
+    end = onset + duration
+    first = onset // measure_length
+    last = (end - 1) // measure_length
+    counts = last - first + 1
+    note = np.repeat(np.arange(len(onset)), counts)
+    piece = np.arange(len(note)) - np.repeat(np.cumsum(counts) - counts, counts)
+    measure = first[note] + piece
+    start = np.maximum(onset[note], measure * measure_length)
+    stop = np.minimum(end[note], (measure + 1) * measure_length)
+    return (note, measure, start - measure * measure_length, stop - start,
+            start > onset[note], stop < end[note])
+
+
+def write_musicxml(table, xml_output_path, tempo, key=None, time_signature=(4, 4), divisions=DIVISIONS,
+                   tempo_map=None):
+    """Write table as a MusicXML score; returns xml_output_path
+
+    tempo is the tempo mark; with a tempo_map the notes are placed on its beat grid.
+    """
+    tempo = float(tempo)
+    beats, beat_type = time_signature
+    measure_length = beats * divisions * 4 // beat_type
+    fifths, mode = key_fifths(key)
+    spelling = SHARP_SPELLING if fifths >= 0 else FLAT_SPELLING
+    values = note_values(divisions)
+
+    onset, duration = quantize(table, tempo, divisions, tempo_map)
+    parts = score_parts(table)
+    n_measures = max(1, int(np.max((onset + duration - 1) // measure_length)) + 1) if len(table) else 1
+
+    with open(xml_output_path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" '
+                '"http://www.musicxml.org/dtds/partwise.dtd">\n'
+                '<score-partwise version="4.0">\n'
+                '  <identification><encoding><software>RemixAi</software></encoding></identification>\n'
+                '  <part-list>\n')
+        for number, part in enumerate(parts, 1):
+            channel = 10 if part['is_drum'] else min(number, 16)
+            f.write(f'    <score-part id="P{number}"><part-name>{escape(part["name"])}</part-name>'
+                    f'<score-instrument id="P{number}-I1"><instrument-name>{escape(part["name"])}</instrument-name>'
+                    f'</score-instrument><midi-instrument id="P{number}-I1"><midi-channel>{channel}</midi-channel>'
+                    f'<midi-program>{part["program"] + 1}</midi-program></midi-instrument></score-part>\n')
+        f.write('  </part-list>\n')
+
+        for number, part in enumerate(parts, 1):
+            attributes = (f'<attributes><divisions>{divisions}</divisions>'
+                          f'<key><fifths>{fifths}</fifths><mode>{mode}</mode></key>'
+                          f'<time><beats>{beats}</beats><beat-type>{beat_type}</beat-type></time>'
+                          f'{CLEFS[part["clef"]]}</attributes>')
+            if number == 1:  # tempo mark on the first part
+                tempo_text = f'{tempo:g}'
+                attributes += (f'<direction placement="above"><direction-type><metronome>'
+                               f'<beat-unit>quarter</beat-unit><per-minute>{tempo_text}</per-minute>'
+                               f'</metronome></direction-type><sound tempo="{tempo_text}"/></direction>')
+            f.write(f'  <part id="P{number}">\n')
+            _write_part(f, table, part, onset, duration, measure_length, n_measures, attributes, spelling, values)
+            f.write('  </part>\n')
+        f.write('</score-partwise>\n')
+    return xml_output_path
+
+
+def _pitch_elements(spelling, unpitched):
+    """Pre-rendered <pitch>/<unpitched> element of every MIDI pitch"""
+    elements = []
+    for midi_pitch in range(128):
+        step, alter = spelling[midi_pitch % 12]
+        octave = midi_pitch // 12 - 1
+        if unpitched:
+            elements.append(f'<unpitched><display-step>{step}</display-step>'
+                            f'<display-octave>{octave}</display-octave></unpitched>')
+        else:
+            alter_text = f'<alter>{alter}</alter>' if alter else ''
+            elements.append(f'<pitch><step>{step}</step>{alter_text}<octave>{octave}</octave></pitch>')
+    return elements
+
+
+def _rest(length, voice, values):
+    return ''.join(f'<note><rest/><duration>{d}</duration><voice>{voice}</voice><type>{name}</type>'
+                   + '<dot/>' * dots + '</note>' for d, name, dots in split_duration(length, values))
+
+
+def _write_part(f, table, part, onset, duration, measure_length, n_measures, attributes, spelling, values):
+    rows = part['rows']
+    pitch_elements = _pitch_elements(spelling, part['is_drum'])
+    note, measure, start, length, tie_stop, tie_start = split_at_barlines(onset[rows], duration[rows],
+                                                                          measure_length)
+    pitches = table.pitch[rows][note]
+    # by measure, then onset; equal onsets and lengths end up next to each other (chords)
+    order = np.lexsort((pitches, length, start, measure))
+    measure, start, length, tie_stop, tie_start = (measure[order], start[order], length[order],
+                                                   tie_stop[order], tie_start[order])
+    pitches = pitches[order].tolist()
+    measure_bounds = np.searchsorted(measure, np.arange(n_measures + 1)).tolist()
+    start, length = start.tolist(), length.tolist()
+    tie_stop, tie_start = tie_stop.tolist(), tie_start.tolist()
+
+    for m in range(n_measures):
+        out = [f'    <measure number="{m + 1}">']
+        if m == 0:
+            out.append(attributes)
+        lo, hi = measure_bounds[m], measure_bounds[m + 1]
+        if lo == hi:
+            out.append(f'<note><rest measure="yes"/><duration>{measure_length}</duration><voice>1</voice></note>')
+            out.append('</measure>\n')
+            f.write(''.join(out))
+            continue
+
+        # notes starting together with the same length form a chord; chords that
+        # overlap go to separate voices (first voice that is free again)
+        voices, voice_ends, chord = [], [], None
+        for i in range(lo, hi):
+            if chord is not None and (start[i], length[i]) == (start[chord[0]], length[chord[0]]):
+                chord.append(i)
+                continue
+            chord = [i]
+            v = next((v for v, voice_end in enumerate(voice_ends) if voice_end <= start[i]), len(voice_ends))
+            if v == len(voices):
+                voices.append([])
+                voice_ends.append(0)
+            voices[v].append(chord)
+            voice_ends[v] = start[i] + length[i]
+
+        for v, chords in enumerate(voices):
+            voice = v + 1
+            cursor = 0
+            for chord in chords:
+                chord_start, chord_length = start[chord[0]], length[chord[0]]
+                gap = chord_start - cursor
+                if gap > 0:
+                    out.append(_rest(gap, voice, values) if voice == 1
+                               else f'<forward><duration>{gap}</duration><voice>{voice}</voice></forward>')
+                pieces = split_duration(chord_length, values)
+                for p, (d, name, dots) in enumerate(pieces):
+                    for c, i in enumerate(chord):
+                        stop_tie = p > 0 or tie_stop[i]
+                        start_tie = p < len(pieces) - 1 or tie_start[i]
+                        ties = ('<tie type="stop"/>' if stop_tie else '') + ('<tie type="start"/>' if start_tie else '')
+                        tied = ('<tied type="stop"/>' if stop_tie else '') + ('<tied type="start"/>' if start_tie else '')
+                        out.append(f'<note>{"<chord/>" if c else ""}{pitch_elements[pitches[i]]}'
+                                   f'<duration>{d}</duration>{ties}<voice>{voice}</voice><type>{name}</type>'
+                                   + '<dot/>' * dots
+                                   + (f'<notations>{tied}</notations>' if tied else '') + '</note>')
+                cursor = chord_start + chord_length
+            if voice == 1 and cursor < measure_length:
+                out.append(_rest(measure_length - cursor, voice, values))
+                cursor = measure_length
+            if v < len(voices) - 1:
+                out.append(f'<backup><duration>{cursor}</duration></backup>')
+        out.append('</measure>\n')
+        f.write(''.join(out))
+
+
+def midi_to_musicxml(midi_path, xml_output_path, tempo, tempo_map=None):
+    """MIDI file -> MusicXML through write_musicxml (time signature and key taken from the MIDI)"""
+    pm = pretty_midi.PrettyMIDI(midi_path)
+    table = NoteTable.from_pretty_midi(pm)
+    time_signatures = pm.time_signature_changes
+    time_signature = (time_signatures[0].numerator, time_signatures[0].denominator) if time_signatures else (4, 4)
+    return write_musicxml(table, xml_output_path, tempo, key_detection.midi_key(midi_path, table), time_signature,
+                          tempo_map=tempo_map)
@@ -0,0 +1,266 @@
+"""Columnar note table: the pipeline's notes as NumPy arrays instead of pretty_midi.Note objects.
+
+A NoteTable keeps one array per field (pitch, start, end, velocity,
+instrument) plus a short list describing the instruments, so transforms such
+as halving durations, transposing, quantizing or merging stems are single
+vectorized operations, and a dense piano transcription costs a few bytes per
+note instead of a Python object per note.
+
+    table = NoteTable.from_pretty_midi(pm)
+    table.scale_durations(0.5).remap_programs({0: 25})
+    table.write_midi("out.mid")        # direct writer, no PrettyMIDI in between
+"""
+import copy
+
+import numpy as np
+import pretty_midi
+
+NOTE_DTYPES = {
+    'pitch': np.uint8,
+    'start': np.float64,
+    'end': np.float64,
+    'velocity': np.uint8,
+    'instrument': np.uint16,  # index into NoteTable.instruments
+}
+
+
+def instrument_info(program=0, is_drum=False, name='', pitch_bends=None, control_changes=None):
+    """Entry of NoteTable.instruments
+
+    pitch_bends: [n, 2] array of (time, bend), control_changes: [n, 3] array of
+    (time, number, value); both are carried along with the notes.
+    """
+    return {
+        'program': int(program),
+        'is_drum': bool(is_drum),
+        'name': name,
+        'pitch_bends': np.zeros((0, 2)) if pitch_bends is None else np.asarray(pitch_bends, dtype=np.float64),
+        'control_changes': (np.zeros((0, 3)) if control_changes is None
+                            else np.asarray(control_changes, dtype=np.float64)),
+    }
+
+
+class NoteTable:
+
+    def __init__(self, pitch=(), start=(), end=(), velocity=(), instrument=(), instruments=None):
+        self.pitch = np.asarray(pitch, dtype=NOTE_DTYPES['pitch'])
+        self.start = np.asarray(start, dtype=NOTE_DTYPES['start'])
+        self.end = np.asarray(end, dtype=NOTE_DTYPES['end'])
+        self.velocity = np.asarray(velocity, dtype=NOTE_DTYPES['velocity'])
+        self.instrument = np.asarray(instrument, dtype=NOTE_DTYPES['instrument'])
+        self.instruments = instruments if instruments is not None else []
+
+    def __len__(self):
+        return len(self.pitch)
+
+    def __repr__(self):
+        return f"NoteTable({len(self)} notes, {len(self.instruments)} instruments)"
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def program(self):
+        """Program of every note (through its instrument)"""
+        programs = np.array([meta['program'] for meta in self.instruments] or [0], dtype=np.uint8)
+        return programs[self.instrument]
+
+    @property
+    def is_drum(self):
+        drums = np.array([meta['is_drum'] for meta in self.instruments] or [False], dtype=bool)
+        return drums[self.instrument]
+
+    def notes_of(self, index):
+        """Row indices of instrument index's notes, ordered by start"""
+        rows = np.flatnonzero(self.instrument == index)
+        return rows[np.argsort(self.start[rows], kind='stable')]
+
+    # conversions
+
+    @classmethod
+    def from_pretty_midi(cls, pm):
+        instruments, columns = [], []
+        for index, inst in enumerate(pm.instruments):
+            instruments.append(instrument_info(
+                inst.program, inst.is_drum, inst.name,
+                [(b.time, b.pitch) for b in inst.pitch_bends] or None,
+                [(c.time, c.number, c.value) for c in inst.control_changes] or None))
+            columns.append(np.array([(n.pitch, n.start, n.end, n.velocity, index) for n in inst.notes],
+                                    dtype=np.float64).reshape(len(inst.notes), 5))
+        data = np.concatenate(columns) if columns else np.zeros((0, 5))
+        return cls(data[:, 0], data[:, 1], data[:, 2], data[:, 3], data[:, 4], instruments)
+
+    @classmethod
+    def from_midi_file(cls, path):
+        return cls.from_pretty_midi(pretty_midi.PrettyMIDI(path))
+
+    def to_pretty_midi(self, initial_tempo=120.0):
+        pm = pretty_midi.PrettyMIDI(initial_tempo=initial_tempo)
+        for index, meta in enumerate(self.instruments):
+            inst = pretty_midi.Instrument(program=meta['program'], is_drum=meta['is_drum'], name=meta['name'])
+            rows = self.notes_of(index)
+            inst.notes = [pretty_midi.Note(v, p, s, e) for p, s, e, v in
+                          zip(self.pitch[rows].tolist(), self.start[rows].tolist(),
+                              self.end[rows].tolist(), self.velocity[rows].tolist())]
+            inst.pitch_bends = [pretty_midi.PitchBend(int(b), t) for t, b in meta['pitch_bends'].tolist()]
+            inst.control_changes = [pretty_midi.ControlChange(int(n), int(v), t)
+                                    for t, n, v in meta['control_changes'].tolist()]
+            pm.instruments.append(inst)
+        return pm
+
+    def copy(self):
+        return NoteTable(self.pitch.copy(), self.start.copy(), self.end.copy(), self.velocity.copy(),
+                         self.instrument.copy(), copy.deepcopy(self.instruments))
+
+    def select(self, mask):
+        """New table with the notes where mask is True (same instruments)"""
+        return NoteTable(self.pitch[mask], self.start[mask], self.end[mask], self.velocity[mask],
+                         self.instrument[mask], self.instruments)
+
+    # vectorized transforms (in place, they return self so they chain)
+
+    def scale_durations(self, factor):
+        self.end = self.start + (self.end - self.start) * factor
+        return self
+
+    def shift(self, seconds):
+        """Move every note, bend and control change by seconds"""
+        self.start = self.start + seconds
+        self.end = self.end + seconds
+        for meta in self.instruments:
+            meta['pitch_bends'] = meta['pitch_bends'] + [seconds, 0]
+            meta['control_changes'] = meta['control_changes'] + [seconds, 0, 0]
+        return self
+
+    def transpose(self, semitones, include_drums=False):
+        mask = np.ones(len(self), dtype=bool) if include_drums else ~self.is_drum
+        pitch = self.pitch.astype(np.int16)
+        pitch[mask] += semitones
+        self.pitch = np.clip(pitch, 0, 127).astype(NOTE_DTYPES['pitch'])
+        return self
+
+    def quantize(self, grid, offset=0.0):
+        """Snap starts and ends to a grid (seconds); every note keeps at least one grid step"""
+        start = np.round((self.start - offset) / grid) * grid + offset
+        end = np.round((self.end - offset) / grid) * grid + offset
+        self.start, self.end = start, np.maximum(end, start + grid)
+        return self
+
+    def quantize_beats(self, tempo, subdivision=4):
+        """quantize() to 1/subdivision of a beat at tempo (BPM)"""
+        return self.quantize(60.0 / tempo / subdivision)
+
+    def remap_programs(self, mapping, drums=False):
+        """mapping: {old_program: new_program}; drum instruments are left alone unless drums=True"""
+        for meta in self.instruments:
+            if not meta['is_drum'] or drums:
+                meta['program'] = int(mapping.get(meta['program'], meta['program']))
+        return self
+
+    def set_program(self, program, is_drum=None):
+        """Give every instrument the same program (and is_drum flag, if given)"""
+        for meta in self.instruments:
+            meta['program'] = int(program)
+            if is_drum is not None:
+                meta['is_drum'] = bool(is_drum)
+        return self
+
+    @classmethod
+    def merge(cls, tables, single_instrument=False):
+        """One table with the notes of every table
+
+        Instruments are kept apart and renumbered, or with single_instrument=True
+        everything ends up on the first instrument (used to join the slices of one stem).
+        """
+        tables = list(tables)
+        if not tables:
+            return cls()
+        instruments, shifts, shift = [], [], 0
+        for table in tables:
+            instruments.extend(table.instruments)
+            shifts.append(np.full(len(table), shift, dtype=np.int64))
+            shift += len(table.instruments)
+        pitch, start, end, velocity = (np.concatenate([getattr(t, name) for t in tables])
+                                       for name in ('pitch', 'start', 'end', 'velocity'))
+        instrument = np.concatenate([t.instrument for t in tables]).astype(np.int64) + np.concatenate(shifts)
+        if single_instrument and instruments:
+            first = dict(instruments[0])
+            for events in ('pitch_bends', 'control_changes'):
+                merged = np.concatenate([meta[events] for meta in instruments])
+                first[events] = merged[np.argsort(merged[:, 0], kind='stable')]
+            instruments, instrument = [first], np.zeros(len(pitch), dtype=np.int64)
+        return cls(pitch, start, end, velocity, instrument, instruments)
+
+    # direct MIDI writer
+
+    def write_midi(self, path, tempo=120.0, resolution=220):
+        """Write a type 1 MIDI file straight from the columns (tempo track + one track per instrument)"""
+        ticks_per_second = resolution * tempo / 60.0
+        tracks = [_tempo_track(tempo)]
+        for index, (meta, channel) in enumerate(zip(self.instruments, _channels(self.instruments))):
+            rows = self.instrument == index
+            tracks.append(_instrument_track(meta, channel, self.pitch[rows], self.velocity[rows],
+                                            self.start[rows], self.end[rows], ticks_per_second))
+        with open(path, 'wb') as f:
+            f.write(b'MThd' + (6).to_bytes(4, 'big') + (1).to_bytes(2, 'big')
+                    + len(tracks).to_bytes(2, 'big') + int(resolution).to_bytes(2, 'big'))
+            for track in tracks:
+                f.write(b'MTrk' + len(track).to_bytes(4, 'big') + track)
+        return path
+
+
+def _channels(instruments):
+    """Drums on channel 9, everything else round-robin on the other 15 (like pretty_midi)"""
+    melodic = [c for c in range(16) if c != 9]
+    channels, next_channel = [], 0
+    for meta in instruments:
+        if meta['is_drum']:
+            channels.append(9)
+        else:
+            channels.append(melodic[next_channel % len(melodic)])
+            next_channel += 1
+    return channels
+
+
+def _vlq(values):
+    """MIDI variable-length quantities of many deltas at once: (bytes [n, 4], valid mask [n, 4])"""
+    values = np.asarray(values, dtype=np.int64)
+    septets = np.stack([(values >> shift) & 0x7F for shift in (21, 14, 7, 0)], axis=1).astype(np.uint8)
+    septets[:, :3] |= 0x80  # continuation bit on every byte but the last
+    n_bytes = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    valid = np.arange(4)[None, :] >= (4 - n_bytes)[:, None]
+    return septets, valid
+
+
+def _tempo_track(tempo):
+    microseconds = int(round(60_000_000 / tempo))
+    return (b'\x00\xff\x51\x03' + microseconds.to_bytes(3, 'big')
+            + b'\x00\xff\x58\x04\x04\x02\x18\x08'  # 4/4
+            + b'\x00\xff\x2f\x00')
+
+
+def _instrument_track(meta, channel, pitch, velocity, start, end, ticks_per_second):
+    name = meta['name'].encode('latin-1', 'replace')[:127]
+    header = b'\x00\xff\x03' + bytes([len(name)]) + name + bytes([0x00, 0xC0 | channel, meta['program'] & 0x7F])
+
+    on = np.round(start * ticks_per_second).astype(np.int64)
+    off = np.maximum(np.round(end * ticks_per_second).astype(np.int64), on + 1)
+    bends, controls = meta['pitch_bends'], meta['control_changes']
+    bend_values = np.clip(bends[:, 1].astype(np.int64) + 8192, 0, 16383)
+    n, n_bends, n_controls = len(pitch), len(bends), len(controls)
+
+    # every event as (tick, order at equal ticks, status, data1, data2): note-offs first, note-ons last
+    ticks = np.concatenate([off, np.round(bends[:, 0] * ticks_per_second).astype(np.int64),
+                            np.round(controls[:, 0] * ticks_per_second).astype(np.int64), on])
+    order = np.repeat([0, 1, 1, 2], [n, n_bends, n_controls, n])
+    status = np.repeat(np.array([0x80, 0xE0, 0xB0, 0x90], dtype=np.uint8) | channel, [n, n_bends, n_controls, n])
+    data1 = np.concatenate([pitch, bend_values & 0x7F, controls[:, 1], pitch]).astype(np.uint8)
+    data2 = np.concatenate([np.zeros(n), bend_values >> 7, controls[:, 2], velocity]).astype(np.uint8)
+
+    events = np.lexsort((order, ticks))
+    ticks = np.maximum(ticks[events], 0)
+    septets, valid = _vlq(np.diff(ticks, prepend=0))
+    rows = np.hstack([septets, np.stack([status[events], data1[events], data2[events]], axis=1)])
+    mask = np.hstack([valid, np.ones((len(rows), 3), dtype=bool)])
+    return header + rows[mask].tobytes() + b'\x00\xff\x2f\x00'
@@ -0,0 +1,143 @@
+"""Demucs on several songs at once: segments of different songs packed into one forward pass.
+
+apply_model separates one song at a time with a batch of 1, which leaves most
+of the CPU idle on a queue of short clips. separate_packed cuts every song into
+the same overlapping segments apply_model uses, fills each batch with segments
+from as many songs as needed (the last segment of a song is padded like
+apply_model pads it), and overlap-adds the outputs back per song. A song is
+yielded as soon as its last segment has been through the model, so only the
+songs that are in the current batches are kept in memory:
+
+    for key, sources in separate_packed(model, ((path, mix) for ...), batch_size=8):
+        sources  # float32 tensor [stems, channels, samples], same as apply_model(model, mix[None])[0]
+
+shifts, overlap, segment and bags of models work like in apply_model; the
+random shift of a song is shared by the models of a bag.
+"""
+import random
+
+import torch
+from demucs.apply import BagOfModels, TensorChunk
+from demucs.htdemucs import HTDemucs
+from demucs.utils import center_trim
+
+# segments per forward pass (7.8 s each for htdemucs_6s)
+DEFAULT_BATCH_SIZE = 4
+
+
+class _Song:
+
+    def __init__(self, key, length, passes):
+        self.key = key
+        self.length = length
+        self.passes_left = passes
+        self.out = 0.
+
+
+class _Pass:
+    """One shift of one song: the overlap-add of the outputs of its segments"""
+
+    def __init__(self, song, signal, start, length, trim, n_sources, n_segments):
+        self.song = song
+        # the song, zero padded for the shifts; the pass starts at `start`
+        self.signal = signal
+        self.start = start
+        self.length = length
+        # output samples before the song starts
+        self.trim = trim
+        self.out = torch.zeros(n_sources, signal.shape[0], length)
+        self.sum_weight = torch.zeros(length)
+        self.segments_left = n_segments
+
+
+def _passes(song, mix, shifts, samplerate, n_sources, stride):
+    """The passes of a song, as apply_model shifts it"""
+    length = mix.shape[-1]
+    if not shifts:
+        return [_Pass(song, mix, 0, length, 0, n_sources, len(range(0, length, stride)))]
+    max_shift = int(0.5 * samplerate)
+    padded = torch.nn.functional.pad(mix, (max_shift, max_shift))
+    passes = []
+    for _ in range(shifts):
+        offset = random.randint(0, max_shift)
+        pass_length = length + max_shift - offset
+        passes.append(_Pass(song, padded, offset, pass_length, max_shift - offset, n_sources,
+                            len(range(0, pass_length, stride))))
+    return passes
+
+
+def _target_length(model, segment, segment_length):
+    """Length every segment is padded to before going through model"""
+    if isinstance(model, HTDemucs):
+        if segment_length > int(model.segment * model.samplerate):
+            raise ValueError(f"segment {segment} is longer than the {float(model.segment):.1f}s the model was "
+                             f"trained on")
+        return segment_length
+    if hasattr(model, 'valid_length'):
+        return model.valid_length(segment_length)
+    return segment_length
+
+
+def separate_packed(model, mixes, batch_size=DEFAULT_BATCH_SIZE, segment=None, overlap=0.25, shifts=1,
+                    transition_power=1.):
+    """Separate every (key, mix tensor [channels, samples]) of mixes; yields (key, sources) as songs finish
+
+    mixes can be a generator: it is only advanced when the batch being filled
+    needs more segments.
+    """
+    if isinstance(model, BagOfModels):
+        models, weights = list(model.models), model.weights
+    else:
+        models, weights = [model], [[1.] * len(model.sources)]
+    # per source, the models' weights sum to 1 (apply_model divides by the totals)
+    weights = torch.tensor(weights, dtype=torch.float32)
+    weights = weights / weights.sum(0)
+    device = next(models[0].parameters()).device
+    samplerate = model.samplerate
+    n_sources = len(model.sources)
+    if segment is None:
+        segment = min(float(m.segment) for m in models)
+    segment_length = int(samplerate * segment)
+    stride = int((1 - overlap) * segment_length)
+    targets = [_target_length(m, segment, segment_length) for m in models]
+    # same triangle weights as apply_model
+    window = torch.cat([torch.arange(1, segment_length // 2 + 1),
+                        torch.arange(segment_length - segment_length // 2, 0, -1)]).float()
+    window = (window / window.max()) ** transition_power
+    for m in models:
+        m.eval()
+
+    def run(batch):
+        with torch.no_grad():
+            out = 0.
+            for m, target, weight in zip(models, targets, weights):
+                # a chunk of a chunk, as in apply_model: the last segment of a pass is shorter
+                x = torch.stack([TensorChunk(TensorChunk(p.signal, p.start, p.length), offset, segment_length)
+                                 .padded(target) for p, offset in batch]).to(device)
+                out = out + m(x).cpu() * weight[None, :, None, None]
+        for chunk_out, (p, offset) in zip(out, batch):
+            n = min(segment_length, p.length - offset)
+            p.out[..., offset:offset + n] += window[:n] * center_trim(chunk_out, n)
+            p.sum_weight[offset:offset + n] += window[:n]
+            p.segments_left -= 1
+            if p.segments_left:
+                continue
+            song = p.song
+            song.out = song.out + (p.out / p.sum_weight)[..., p.trim:p.trim + song.length]
+            song.passes_left -= 1
+            if not song.passes_left:
+                yield song.key, song.out / max(1, shifts)
+            # the padded mix and the per-pass buffers aren't needed any more
+            p.signal = p.out = p.sum_weight = None
+
+    batch = []
+    for key, mix in mixes:
+        song = _Song(key, mix.shape[-1], max(1, shifts))
+        for p in _passes(song, mix, shifts, samplerate, n_sources, stride):
+            for offset in range(0, p.length, stride):
+                batch.append((p, offset))
+                if len(batch) == batch_size:
+                    yield from run(batch)
+                    batch = []
+    if batch:
+        yield from run(batch)
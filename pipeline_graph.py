@@ -0,0 +1,121 @@
+"""Stage graph: pipeline stages declare what they depend on and run as soon as it's ready.
+
+Each stage is a function, the names of the stages it needs, and the pool it
+runs in. The scheduler starts every stage whose dependencies are finished,
+so independent stages overlap. For example, the tempo estimation runs next to
+the separation, and the XML export runs next to the MIDI merge and the WAV
+rendering. Stages get the results of their dependencies as keyword arguments.
+
+    graph = StageGraph()
+    graph.add("tempo", lambda: get_tempo(path), pool="cpu")
+    graph.add("separate", lambda: separate_with_cache(path), pool="cpu")
+    graph.add("xml", lambda tempo, separate: ..., deps=("tempo", "separate"), pool="io")
+    results, report = graph.run()
+
+Pools bound how many stages of one kind run at once: "cpu" for Demucs,
+basic_pitch and beat tracking (which use all cores on their own), "io" for
+file writing and the FluidSynth subprocess.
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import stage_profiler
+
+DEFAULT_POOLS = {'cpu': 2, 'io': 4}
+
+
+class Stage:
+
+    def __init__(self, name, func, deps=(), pool='cpu'):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.pool = pool
+
+
+class StageGraph:
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, func, deps=(), pool='cpu'):
+        """Add a stage; its dependencies have to be added first (so the graph can't have cycles)"""
+        if name in self.stages:
+            raise ValueError(f"Stage {name} already exists")
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unknown stages: {missing}")
+        self.stages[name] = Stage(name, func, deps, pool)
+        return self
+
+    def run(self, pools=None, on_event=None, executors=None):
+        """Run every stage; returns ({stage: result}, {stage: report})
+
+        A stage that raises is reported as 'error' and the stages depending on it
+        as 'skipped'; the independent ones still run.
+        on_event(stage, status, report) is called when a stage starts ('running')
+        and when it ends ('ok' / 'error' / 'skipped'), from whichever thread sees it happen.
+        executors: {pool: Executor} shared with other graphs (e.g. several songs in
+        the job server); they are left running. Otherwise pools gives their sizes.
+        """
+        owned = executors is None
+        if owned:
+            pools = dict(DEFAULT_POOLS, **(pools or {}))
+            executors = {pool: ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"stage-{pool}")
+                         for pool, size in pools.items()}
+        unknown = {stage.pool for stage in self.stages.values()} - set(executors)
+        if unknown:
+            raise ValueError(f"No pool configured for {sorted(unknown)}")
+        notify = on_event or (lambda stage, status, report: None)
+        results, report, running = {}, {}, {}
+        pending = dict(self.stages)
+        started = time.perf_counter()
+        try:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    failed = [dep for dep in stage.deps if report.get(dep, {}).get('status') in ('error', 'skipped')]
+                    if failed:
+                        report[name] = {'status': 'skipped', 'error': f"{failed[0]} failed", 'seconds': 0.0}
+                        del pending[name]
+                        print(f"[skipped] stage {name}: {failed[0]} failed")
+                        notify(name, 'skipped', report[name])
+                    elif all(dep in results for dep in stage.deps):
+                        kwargs = {dep: results[dep] for dep in stage.deps}
+                        on_start = (lambda name=name: notify(name, 'running', {}))
+                        running[executors[stage.pool].submit(_timed, stage.func, kwargs, on_start, name)] = name
+                        del pending[name]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    result, seconds, start, error = future.result()
+                    report[name] = {'status': 'ok' if error is None else 'error', 'error': error,
+                                    'seconds': seconds, 'start': start - started}
+                    if error is None:
+                        results[name] = result
+                    print(f"[{report[name]['status']}] stage {name} in {seconds:.1f}s"
+                          + (f": {error}" if error else ""))
+                    notify(name, report[name]['status'], report[name])
+        finally:
+            if owned:
+                for executor in executors.values():
+                    executor.shutdown(wait=True)
+        report['_total'] = {'status': 'ok', 'seconds': time.perf_counter() - started}
+        return results, report
+
+
+def _timed(func, kwargs, on_start=None, name=None):
+    """(result, seconds, start, error) of func(**kwargs); never raises"""
+    import traceback
+
+    if on_start is not None:
+        on_start()
+    start = time.perf_counter()
+    try:
+        with stage_profiler.stage(name or getattr(func, '__name__', 'stage')):
+            result = func(**kwargs)
+    except Exception as e:
+        traceback.print_exc()
+        return None, time.perf_counter() - start, start, f"{type(e).__name__}: {str(e)}"
+    return result, time.perf_counter() - start, start, None
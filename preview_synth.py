@@ -0,0 +1,207 @@
+"""Preview synthesizer: a rough audition of a MIDI in plain NumPy, no soundfont and no fluidsynth.
+
+Good enough to check what mp3_to_midi transcribed or how a program swap
+sounds, and fast enough to render a whole song in well under a second (a
+dense 4-minute song with 15k notes takes about 0.5 s on one core):
+
+    audio = render_preview(table)                        # float32 [2, samples] at 22050 Hz
+    preview_to_file("midi_files/song_combined.mid", "final_combined_wav/song_preview.wav")
+
+Every GM program family (program // 8) has one voice: a single-cycle wavetable
+built from a few harmonics plus an attack/decay/sustain/release envelope. One
+note per pitch is rendered once, and every note is then a contiguous slice of
+it added into the output with a gain, so the work per note is two slice
+additions. Drum notes use short synthesized hits for the GM drum map
+drumtest_1_1 writes (kick, snare, hi-hat, toms, crash, ride), added the same way.
+"""
+import os
+
+import numpy as np
+
+import drumtest_1_1
+from note_table import NoteTable
+
+PREVIEW_SR = 22050
+TABLE_SIZE = 2048
+TAIL_SECONDS = 0.5
+NOTE_GAIN = 0.15
+
+# family (program // 8): (harmonic amplitudes, attack, decay, sustain, release), times in seconds
+VOICES = {
+    0: ([1.0, 0.5, 0.25, 0.12, 0.06], 0.005, 0.8, 0.0, 0.15),           # piano
+    1: ([1.0, 0.0, 0.4, 0.0, 0.0, 0.2], 0.002, 0.5, 0.0, 0.3),         # chromatic percussion
+    2: ([1.0, 0.6, 0.0, 0.45, 0.0, 0.3, 0.0, 0.2], 0.01, 0.1, 0.9, 0.05),  # organ
+    3: ([1.0, 0.6, 0.4, 0.25, 0.15, 0.1], 0.003, 0.6, 0.0, 0.1),        # guitar
+    4: ([1.0, 0.35, 0.1], 0.005, 0.7, 0.3, 0.08),                       # bass
+    5: ([1.0, 0.5, 0.33, 0.25, 0.2, 0.16], 0.08, 0.3, 0.8, 0.25),       # strings
+    6: ([1.0, 0.5, 0.33, 0.25, 0.2], 0.12, 0.3, 0.8, 0.35),             # ensemble
+    7: ([1.0, 0.8, 0.6, 0.45, 0.3, 0.2], 0.03, 0.2, 0.8, 0.1),          # brass
+    8: ([1.0, 0.0, 0.5, 0.0, 0.3, 0.0, 0.15], 0.03, 0.2, 0.85, 0.08),   # reed
+    9: ([1.0, 0.1, 0.05], 0.04, 0.2, 0.85, 0.1),                        # pipe
+    10: ([1.0, 0.5, 0.33, 0.25, 0.2, 0.16, 0.14, 0.12], 0.005, 0.2, 0.8, 0.05),  # synth lead
+    11: ([1.0, 0.3, 0.2, 0.1], 0.3, 0.5, 0.8, 0.5),                     # synth pad
+    12: ([1.0, 0.4, 0.3], 0.05, 0.4, 0.6, 0.3),                         # synth effects
+    13: ([1.0, 0.5, 0.3, 0.2], 0.003, 0.5, 0.0, 0.1),                   # ethnic
+    14: ([1.0, 0.2, 0.3, 0.1], 0.001, 0.3, 0.0, 0.1),                   # percussive
+    15: ([1.0, 0.3], 0.01, 0.3, 0.5, 0.2),                              # sound effects
+}
+
+# drum pitch: (kind, length in seconds)
+DRUM_SOUNDS = {
+    drumtest_1_1.KICK: ('kick', 0.35),
+    drumtest_1_1.SNARE: ('snare', 0.25),
+    drumtest_1_1.HIHAT: ('hihat', 0.08),
+    drumtest_1_1.HIGH_TOM: ('tom', 0.3),
+    drumtest_1_1.MID_TOM: ('tom', 0.35),
+    drumtest_1_1.LOW_TOM: ('tom', 0.4),
+    drumtest_1_1.CRASH: ('cymbal', 1.2),
+    drumtest_1_1.RIDE: ('cymbal', 0.8),
+}
+TOM_FREQUENCIES = {drumtest_1_1.HIGH_TOM: 200.0, drumtest_1_1.MID_TOM: 150.0, drumtest_1_1.LOW_TOM: 110.0}
+
+_wavetables = {}
+_drum_samples = {}
+
+
+def wavetable(family):
+    """Single cycle of a family's voice, normalised to a peak of 1"""
+    if family not in _wavetables:
+        harmonics = np.asarray(VOICES[family][0])
+        phase = np.arange(TABLE_SIZE) / TABLE_SIZE
+        table = np.sin(2 * np.pi * np.outer(np.arange(1, len(harmonics) + 1), phase)).T @ harmonics
+        _wavetables[family] = (table / np.abs(table).max()).astype(np.float32)
+    return _wavetables[family]
+
+
+def drum_sample(pitch, sr=PREVIEW_SR):
+    """Synthesized hit for a GM drum pitch (pitches outside DRUM_SOUNDS get a short noise burst)"""
+    if (pitch, sr) in _drum_samples:
+        return _drum_samples[(pitch, sr)]
+    kind, length = DRUM_SOUNDS.get(pitch, ('hihat', 0.1))
+    t = np.arange(int(length * sr)) / sr
+    noise = np.random.default_rng(pitch).uniform(-1, 1, len(t))
+    if kind == 'kick':
+        # sine sweeping down from 150 to 50 Hz
+        frequency = 50 + 100 * np.exp(-t / 0.03)
+        sample = np.sin(2 * np.pi * np.cumsum(frequency) / sr) * np.exp(-t / 0.12)
+    elif kind == 'snare':
+        sample = 0.5 * np.sin(2 * np.pi * 185 * t) * np.exp(-t / 0.05) + 0.7 * noise * np.exp(-t / 0.08)
+    elif kind == 'tom':
+        frequency = TOM_FREQUENCIES.get(pitch, 150.0) * (1 + 0.5 * np.exp(-t / 0.02))
+        sample = np.sin(2 * np.pi * np.cumsum(frequency) / sr) * np.exp(-t / 0.15)
+    elif kind == 'cymbal':
+        # first difference: crude high-pass so it sits above the rest of the kit
+        sample = 0.5 * np.diff(noise, prepend=0.0) * np.exp(-t / (length / 3))
+    else:
+        sample = 0.6 * np.diff(noise, prepend=0.0) * np.exp(-t / 0.02)
+    _drum_samples[(pitch, sr)] = sample.astype(np.float32)
+    return _drum_samples[(pitch, sr)]
+
+
+def envelope(t, duration, attack, decay, sustain, release):
+    """ADSR level at times t (seconds since each note's start) of notes lasting duration"""
+    t = np.asarray(t, dtype=np.float64)
+    held_t = np.minimum(t, duration)
+    level = np.minimum(held_t / attack, 1.0) * (
+        sustain + (1 - sustain) * np.exp(-np.maximum(held_t - attack, 0.0) / decay))
+    return level * np.clip(1 - (t - duration) / release, 0.0, 1.0)
+
+
+def _render_family(out, family, pitch, start, duration, velocity, sr):
+    """Add the notes of one family to out (mono)
+
+    Every pitch gets one rendered note (oscillator times the attack/decay curve),
+    as long as its longest note plus the release. A note is then a slice of its
+    pitch's note, and its release is the continuation of that slice under a
+    linear fade, so the per-sample work is a multiply-add.
+    """
+    _, attack, decay, sustain, release = VOICES[family]
+    table = wavetable(family)
+    if sustain == 0:
+        # decaying voices are inaudible (-60 dB) after about 7 decay times
+        duration = np.minimum(duration, attack + 7 * decay)
+    held = np.maximum(np.round(duration * sr).astype(np.int64), 1)
+    release_samples = max(int(release * sr), 1)
+    pitches, pitch_of = np.unique(pitch, return_inverse=True)
+    longest = np.zeros(len(pitches), dtype=np.int64)
+    np.maximum.at(longest, pitch_of, held + release_samples)
+    curve = envelope(np.arange(longest.max()) / sr, np.inf, attack, decay, sustain, release).astype(np.float32)
+    bank = []
+    for note_pitch, length in zip(pitches, longest):
+        step = 440.0 * 2 ** ((note_pitch - 69) / 12.0) * TABLE_SIZE / sr  # table positions per sample
+        phase = (np.arange(length) * step).astype(np.int64) % TABLE_SIZE
+        bank.append(table[phase] * curve[:length])
+    offsets = np.concatenate([[0], np.cumsum(longest)[:-1]])
+    bank = np.concatenate(bank)
+    first = np.round(start * sr).astype(np.int64)
+    gain = NOTE_GAIN * velocity / 127.0
+    fade = np.linspace(1.0, 0.0, release_samples, endpoint=False, dtype=np.float32)
+    _add_segments(out, bank, offsets[pitch_of], first, held, gain)
+    _add_segments(out, bank, offsets[pitch_of] + held, first + held, np.full(len(held), release_samples), gain, fade)
+
+
+def _add_segments(out, bank, bank_start, out_start, lengths, gain, shape=None):
+    """out[out_start:+length] += bank[bank_start:+length] * gain (* shape[:length]) for every segment
+
+    One contiguous slice addition per segment: laying every sample of every
+    segment out in one flat array (index arrays, a gather and a bincount over
+    all of them) was several times slower on dense songs.
+    """
+    for bank_first, first, length, note_gain in zip(bank_start.tolist(), out_start.tolist(), lengths.tolist(),
+                                                    gain.tolist()):
+        length = min(length, len(out) - first)
+        if length <= 0:
+            continue
+        segment = bank[bank_first:bank_first + length] * np.float32(note_gain)
+        if shape is not None:
+            segment *= shape[:length]
+        out[first:first + length] += segment
+
+
+def _render_drums(out, pitch, start, velocity, sr):
+    """Every hit is its drum's sample, scaled by velocity, added at the onset"""
+    drums, drum_of = np.unique(pitch, return_inverse=True)
+    samples = [drum_sample(int(drum), sr) for drum in drums]
+    lengths = np.array([len(sample) for sample in samples], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    _add_segments(out, np.concatenate(samples), offsets[drum_of], np.round(start * sr).astype(np.int64),
+                  lengths[drum_of], 2 * NOTE_GAIN * velocity / 127.0)
+
+
+def render_preview(midi, sr=PREVIEW_SR, tail=TAIL_SECONDS):
+    """float32 [2, samples] preview of a NoteTable, a PrettyMIDI or a MIDI path"""
+    if isinstance(midi, str):
+        table = NoteTable.from_midi_file(midi)
+    elif isinstance(midi, NoteTable):
+        table = midi
+    else:
+        table = NoteTable.from_pretty_midi(midi)
+    end = float(table.end.max()) if len(table) else 0.0
+    # room for the longest release / drum hit after the last note
+    out = np.zeros(int((end + tail + 1.5) * sr), dtype=np.float32)
+    pitch = table.pitch.astype(np.float64)
+    velocity = table.velocity.astype(np.float64)
+    duration = np.maximum(table.duration, 0.0)
+    drums = table.is_drum
+    if drums.any():
+        _render_drums(out, table.pitch[drums], table.start[drums], velocity[drums], sr)
+    families = table.program // 8
+    for family in np.unique(families[~drums]):
+        notes = ~drums & (families == family)
+        _render_family(out, int(family), pitch[notes], table.start[notes], duration[notes], velocity[notes], sr)
+    out = out[:int((end + tail) * sr)]
+    peak = np.abs(out).max() if len(out) else 0.0
+    if peak > 1.0:
+        out /= peak
+    return np.repeat(out[np.newaxis], 2, axis=0)
+
+
+def preview_to_file(midi, wav_path, sr=PREVIEW_SR, tail=TAIL_SECONDS):
+    """render_preview written as a 16-bit wav; returns wav_path"""
+    import soundfile as sf
+
+    audio = render_preview(midi, sr, tail)
+    if os.path.dirname(wav_path):
+        os.makedirs(os.path.dirname(wav_path), exist_ok=True)
+    sf.write(wav_path, audio.T, sr, subtype='PCM_16')
+    return wav_path
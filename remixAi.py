@@ -1,7 +1,6 @@
 import torch
-import torchaudio
 from demucs.pretrained import get_model
-from demucs.apply import apply_model
+from demucs.apply import apply_model, BagOfModels
 import os
 import librosa
 import pretty_midi
@@ -9,23 +8,122 @@ import numpy as np
 from basic_pitch.inference import predict
 import music21 #import converter, stream
 import drumtest_1_1
+import audio_store
+import separation_cache
+import transcription
+import stem_energy
+import key_detection
+import musicxml_writer
+import pipeline_graph
+import tempo_analysis
+import synth_renderer
+import preview_synth
+import transcription_library
+import stage_profiler
+import separation_backends
+import packed_separation
+import stem_writer
+from note_table import NoteTable
 #from drumstest_1_1 import wav_to_drum_midi
 from music21 import *
-import glob
+import functools
 from scipy.io import wavfile
 import traceback
 
-def separate_instruments(file_path):
-    
-    # Print current working directory and check if file exists
-    print(f"Current working directory: {os.getcwd()}")
+MODEL_NAME = 'htdemucs_6s'
+# sources of MODEL_NAME: midi_files/<song>_<stem>.mid
+STEMS = ('drums', 'bass', 'other', 'vocals', 'guitar', 'piano')
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.flac', '.ogg', '.m4a', '.aiff')
+# apply_model settings used for every separation (also part of the separation cache key);
+# configure_separation adds 'segment' when it is overridden
+APPLY_MODEL_PARAMS = {'shifts': 1, 'split': True, 'overlap': 0.25}
+# where the Demucs network runs on CPU, see separation_backends
+SEPARATION_BACKEND = separation_backends.DEFAULT_BACKEND
+# file format of the separated stems, see stem_writer
+STEM_FORMAT = stem_writer.DEFAULT_FORMAT
 
-    print(f"File exists: {os.path.exists(file_path)}")
-    song_name = os.path.splitext(os.path.basename(file_path))[0]
-    print(f"Song name without extension: {song_name}")
+# one warm Demucs model per process, keyed by model name
+_separators = {}
+# the same models prepared for a CPU backend, keyed by (model name, backend)
+_backend_separators = {}
+
+def configure_torch_threads(intra_op_threads=None, inter_op_threads=None):
+    """Pin torch's intra-op and inter-op thread pools (None keeps torch's default)"""
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # torch only allows this before the first parallel op runs
+            print(f"Could not set inter-op threads: {str(e)}")
+    print(f"Torch threads: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}")
+
+def configure_separation(backend=None, segment=None, overlap=None, shifts=None, split=None, stem_format=None):
+    """Pick the CPU backend, the apply_model settings and the stem file format of every separation
+
+    None keeps the current setting.
+    """
+    global SEPARATION_BACKEND, STEM_FORMAT
+    if stem_format is not None:
+        STEM_FORMAT = stem_writer.check_format(stem_format)
+    if backend is not None:
+        if backend not in separation_backends.BACKENDS:
+            raise ValueError(f"Unknown separation backend {backend!r}")
+        SEPARATION_BACKEND = backend
+    if segment is not None:
+        if segment <= 0:
+            raise ValueError("segment must be positive")
+        APPLY_MODEL_PARAMS['segment'] = segment
+    if overlap is not None:
+        if not 0 <= overlap < 1:
+            raise ValueError("overlap must be in [0, 1)")
+        APPLY_MODEL_PARAMS['overlap'] = overlap
+    if shifts is not None:
+        APPLY_MODEL_PARAMS['shifts'] = shifts
+    if split is not None:
+        APPLY_MODEL_PARAMS['split'] = split
+    print(f"Separation: {SEPARATION_BACKEND} backend, {APPLY_MODEL_PARAMS}, {STEM_FORMAT} stems")
+
+def separation_params(streaming=False, window_seconds=30.0):
+    """Everything that changes the stems, for the separation cache key"""
+    params = dict(APPLY_MODEL_PARAMS)
+    if SEPARATION_BACKEND != 'fp32':
+        # fp32 keys stay as they were before there were backends
+        params['backend'] = SEPARATION_BACKEND
+    if STEM_FORMAT != 'float32':
+        params['stem_format'] = STEM_FORMAT
+    if streaming:
+        # windowed separation gives (slightly) different stems, so it gets its own entries
+        params['stream_window'] = window_seconds
+    return params
+
+def load_separator(model_name=MODEL_NAME, backend=None):
+    """Load the Demucs model and pick the device once, then reuse it for every song
+
+    backend (default SEPARATION_BACKEND) runs the model through one of the
+    CPU backends of separation_backends; they only apply on CPU.
+    """
+    backend = backend or SEPARATION_BACKEND
+    model, device = _load_fp32_separator(model_name)
+    segment = APPLY_MODEL_PARAMS.get('segment')
+    if segment and isinstance(model, BagOfModels) and segment > model.max_allowed_segment:
+        raise ValueError(f"segment {segment} is longer than the {model.max_allowed_segment:.1f}s {model_name} "
+                         f"was trained on")
+    if backend == 'fp32':
+        return model, device
+    if device.type != 'cpu':
+        print(f"The {backend} backend is for CPU, using fp32 on {device.type}")
+        return model, device
+    if (model_name, backend) not in _backend_separators:
+        _backend_separators[(model_name, backend)] = (separation_backends.prepare(model, backend), device)
+    return _backend_separators[(model_name, backend)]
+
+def _load_fp32_separator(model_name):
+    if model_name in _separators:
+        return _separators[model_name]
 
-    # Load model
-    model = get_model('htdemucs_6s')
+    model = get_model(model_name)
 
     # Check if MPS is available (for M1/M2 Macs)
     if torch.backends.mps.is_available():
@@ -37,152 +135,605 @@ def separate_instruments(file_path):
         device = torch.device("cpu")
         model.cpu()
         print("Using CPU backend")
+    model.eval()
 
-    try:
-        # Load audio using librosa
-        print("Loading audio file...")
-        audio_numpy, sr = librosa.load(file_path, sr=44100, mono=False)
-        
-        # Convert to torch tensor and reshape properly
-        input_audio = torch.tensor(audio_numpy)
-        
-        # Ensure correct shape (batch, channels, length)
-        if input_audio.dim() == 1:
-            # If mono, add channel and batch dimensions
-            input_audio = input_audio.unsqueeze(0).unsqueeze(0)
-        elif input_audio.dim() == 2:
-            # If stereo, just add batch dimension
-            input_audio = input_audio.unsqueeze(0)
-        
-        print(f"Input audio tensor shape: {input_audio.shape}")
-        print(f"Successfully loaded audio file with sample rate: {sr}")
-        
-        if torch.backends.mps.is_available():
-            input_audio = input_audio.to(device)
+    _separators[model_name] = (model, device)
+    return model, device
 
-        # Separate
-        sources = apply_model(model, input_audio, progress=True)
-        
-        # Convert sources to proper format
-        sources = sources.cpu()
-        
-        # Print shape of sources
-        print(f"Sources shape: {sources.shape}")
-        print(f"Sources: {sources[0][1]}")
-        # Sources shape is [1, 4, 2, samples]
-        # Remove batch dimension and get each stem
-        sources = sources.squeeze(0)  # Remove batch dimension, now [4, 2, samples]
+def separate_stems(file_path, model=None, device=None):
+    """Run Demucs on file_path and keep the result in memory
+
+    Returns ({stem_name: float32 array [channels, samples]}, sr). Nothing is
+    written to disk, errors are raised to the caller.
+    """
+    # Load model (cached, so a catalogue only loads the weights once)
+    if model is None:
+        model, device = load_separator()
+    elif device is None:
+        device = next(model.parameters()).device
+
+    # Load audio (decoded once and shared through the audio store)
+    print("Loading audio file...")
+    with stage_profiler.stage("decode"):
+        audio_numpy, sr = audio_store.load(file_path, sr=44100, mono=False)
+    
+    # Convert to torch tensor and reshape properly
+    input_audio = torch.tensor(audio_numpy)
+    
+    # Ensure correct shape (batch, channels, length)
+    if input_audio.dim() == 1:
+        # If mono, add channel and batch dimensions
+        input_audio = input_audio.unsqueeze(0).unsqueeze(0)
+    elif input_audio.dim() == 2:
+        # If stereo, just add batch dimension
+        input_audio = input_audio.unsqueeze(0)
+    
+    print(f"Input audio tensor shape: {input_audio.shape}")
+    print(f"Successfully loaded audio file with sample rate: {sr}")
+    
+    if torch.backends.mps.is_available():
+        input_audio = input_audio.to(device)
+
+    # Separate
+    with stage_profiler.stage("demucs", audio_numpy.shape[-1] / sr):
+        sources = apply_model(model, input_audio, progress=True, **APPLY_MODEL_PARAMS)
+    
+    # Convert sources to proper format
+    sources = sources.cpu()
+    
+    # Print shape of sources (not the values: formatting the tensor is slow)
+    print(f"Sources shape: {sources.shape}")
+    # Sources shape is [1, 4, 2, samples]
+    # Remove batch dimension and get each stem
+    sources = sources.squeeze(0)  # Remove batch dimension, now [4, 2, samples]
+
+    return {source_name: sources[idx].numpy() for idx, source_name in enumerate(model.sources)}, sr
+
+def separate_instruments(file_path, model=None, device=None, wait=True):
+    """Separate file_path into separated_wavs/<song>_<stem>.<ext>; returns the stem paths
+
+    The stems are written by the background stem writer in STEM_FORMAT. With
+    wait=False this returns as soon as they are queued: the writes overlap with
+    whatever the caller does next, and stem_writer.written(paths) is their
+    future (stem_writer.stem_files waits for them too).
+    """
+    # Print current working directory and check if file exists
+    print(f"Current working directory: {os.getcwd()}")
+
+    print(f"File exists: {os.path.exists(file_path)}")
+    song_name = os.path.splitext(os.path.basename(file_path))[0]
+    print(f"Song name without extension: {song_name}")
+    output_paths = []
+
+    try:
+        stems, sr = separate_stems(file_path, model, device)
         
         # if the folder does not exist, create it
         output_dir = "separated_wavs"
         os.makedirs(output_dir,exist_ok=True)
         
-        # Save separated tracks
-        for idx, source_name in enumerate(model.sources):
-            print(f"Processing {source_name}")
-            source_audio = sources[idx]
-            print(f"Shape for {source_name}: {source_audio.shape}")
-            # Path to save the separated wav files
-            output_path = os.path.join(output_dir, f'{song_name}_{source_name}.wav')
-            torchaudio.save(output_path, source_audio, sr)
-            print(f"Saved {output_path}")
-            
+        # Save separated tracks (in the background: encoding and disk writes don't hold up separation)
+        job = stem_writer.get_writer().write_stems(song_name, stems, sr, output_dir, STEM_FORMAT)
+
+        # per-frame energy while the stems are still in memory, so transcription can gate without decoding
+        stem_energy.save_manifest_from_stems(song_name, stems, sr, output_dir)
+
+        if wait:
+            job.result()
+            for output_path in job.paths:
+                print(f"Saved {output_path}")
+        output_paths = job.paths
+
     except Exception as e:
         print(f"Error occurred: {str(e)}")
         import traceback
         traceback.print_exc()
 
+    return output_paths
+
+def _stream_audio(file_path, sr, channels, block_seconds=10):
+    """Yield [channels, frames] float32 blocks of file_path resampled to sr, never holding the whole file"""
+    import soundfile as sf
+    import soxr
+
+    with sf.SoundFile(file_path) as f:
+        resampler = None
+        if f.samplerate != sr:
+            resampler = soxr.ResampleStream(f.samplerate, sr, f.channels, dtype='float32')
+        block_frames = int(block_seconds * f.samplerate)
+        while True:
+            block = f.read(block_frames, dtype='float32', always_2d=True)  # [frames, channels]
+            last = len(block) < block_frames
+            if resampler is not None:
+                block = resampler.resample_chunk(block, last=last)
+            if len(block):
+                # match the channel layout the model expects (mono -> duplicated, extra channels -> dropped)
+                if block.shape[1] < channels:
+                    block = np.repeat(block[:, :1], channels, axis=1)
+                yield np.ascontiguousarray(block[:, :channels].T)
+            if last:
+                break
+
+def separate_instruments_streaming(file_path, window_seconds=30.0, overlap_seconds=2.0, model=None, device=None):
+    """Separate a long recording window by window with bounded memory
+
+    The input is read in overlapping windows, each window goes through apply_model
+    on its own and the overlaps are linearly crossfaded. Every stem is appended to
+    separated_wavs/<song>_<stem>.<ext> as soon as it is produced, so peak memory
+    depends on window_seconds and not on the length of the track.
+    """
+    import soundfile as sf
+
+    song_name = os.path.splitext(os.path.basename(file_path))[0]
+    print(f"Streaming separation of {song_name} ({window_seconds}s windows, {overlap_seconds}s overlap)")
+
+    if model is None:
+        model, device = load_separator()
+    elif device is None:
+        device = next(model.parameters()).device
 
+    sr = model.samplerate
+    channels = model.audio_channels
+    window = int(window_seconds * sr)
+    overlap = int(overlap_seconds * sr)
+    if overlap <= 0 or 2 * overlap >= window:
+        raise ValueError("overlap_seconds must be positive and less than half of window_seconds")
+    hop = window - overlap
+    fade_in = np.linspace(0.0, 1.0, overlap, dtype=np.float32)
 
-def mp3_to_midi(mp3_path, midi_output_path):
+    output_dir = "separated_wavs"
+    os.makedirs(output_dir, exist_ok=True)
+    output_paths = [stem_writer.stem_path(song_name, source_name, output_dir, STEM_FORMAT)
+                    for source_name in model.sources]
+    # written window by window on this thread, in the same format as the stem writer's
+    writers = [sf.SoundFile(path, 'w', samplerate=sr, channels=channels, **stem_writer.soundfile_args(STEM_FORMAT))
+               for path in output_paths]
+    energies = [stem_energy.EnergyAccumulator() for _ in model.sources]
+
+    def separate_window(chunk):
+        input_audio = torch.from_numpy(chunk).unsqueeze(0).to(device)
+        with torch.no_grad():
+            sources = apply_model(model, input_audio, progress=False, **APPLY_MODEL_PARAMS)
+        return sources[0].cpu().numpy()  # [stems, channels, frames]
+
+    def write(stems_audio):
+        for writer, energy, stem in zip(writers, energies, stems_audio):
+            writer.write(stem_writer.prepare_audio(stem, STEM_FORMAT))
+            energy.add(stem)
+
+    try:
+        pending = np.zeros((channels, 0), dtype=np.float32)
+        tail = None  # last `overlap` frames of the previous window, waiting to be crossfaded
+        n_windows = 0
+
+        def process(chunk, last):
+            nonlocal tail, n_windows
+            out = separate_window(chunk)
+            start = 0
+            if tail is not None:
+                # crossfade the region shared with the previous window
+                write(tail * (1.0 - fade_in) + out[..., :overlap] * fade_in)
+                start = overlap
+            if last:
+                write(out[..., start:])
+                tail = None
+            else:
+                write(out[..., start:-overlap])
+                tail = out[..., -overlap:]
+            n_windows += 1
+            print(f"Window {n_windows} written ({chunk.shape[-1] / sr:.1f}s)")
+
+        for block in _stream_audio(file_path, sr, channels):
+            pending = np.concatenate([pending, block], axis=1)
+            while pending.shape[1] >= window:
+                process(pending[:, :window], last=False)
+                pending = pending[:, hop:]
+
+        if pending.shape[1] > overlap or (n_windows == 0 and pending.shape[1] > 0):
+            process(pending, last=True)
+        elif tail is not None:
+            # the stream ended exactly on a window boundary
+            write(tail)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    stem_energy.save_manifest(song_name, {name: energy.finish() for name, energy in zip(model.sources, energies)},
+                              sr, {name: energy.samples for name, energy in zip(model.sources, energies)},
+                              output_dir)
+    for path in output_paths:
+        print(f"Saved {path}")
+    return output_paths
+
+def separate_with_cache(file_path, streaming=False, window_seconds=30.0, cache=None, wait=True):
+    """separate_instruments / separate_instruments_streaming behind the separation cache
+
+    On a hit the cached stems are copied into separated_wavs/ and Demucs is not
+    even loaded. Pass cache=False to always separate. With wait=False the stems
+    may still be being written when this returns (see separate_instruments);
+    they are stored in the cache once written.
+    """
+    import contextlib
+
+    if cache is False:
+        if streaming:
+            return separate_instruments_streaming(file_path, window_seconds)
+        return separate_instruments(file_path, wait=wait)
+    if cache is None:
+        cache = separation_cache.SeparationCache()
+
+    song_name = os.path.splitext(os.path.basename(file_path))[0]
+    params = separation_params(streaming, window_seconds)
+    key = separation_cache.cache_key(file_path, MODEL_NAME, 44100, params)
+
+    # hold the key while separating so other workers wait for this result instead of redoing it
+    # (until the stems are stored, which happens after their background writes)
+    with contextlib.ExitStack() as locks:
+        locks.enter_context(cache.lock(key))
+        stems = cache.fetch(key, song_name)
+        if stems:
+            print(f"Separation cache hit for {song_name} ({key[:12]})")
+            return stems
+
+        print(f"Separation cache miss for {song_name} ({key[:12]})")
+        if streaming:
+            stems = separate_instruments_streaming(file_path, window_seconds)
+        else:
+            stems = separate_instruments(file_path, wait=False)
+        # no stems: the separation failed (maybe loading the model did), so don't load it again here
+        sources = load_separator()[0].sources if stems else []
+        if stems and len(stems) == len(sources):  # never cache a separation that failed half-way
+            info = {'song': song_name, 'model': MODEL_NAME, 'samplerate': 44100, 'params': params}
+            json_path, npz_path = stem_energy.manifest_paths(song_name)
+            key_lock = locks.pop_all()
+
+            def store(job):
+                try:
+                    _store_written(cache, key, sources, info,
+                                   {'energy.json': json_path, 'energy.npz': npz_path}, job)
+                finally:
+                    key_lock.close()
+
+            job = stem_writer.written(stems)
+            job.add_done_callback(store)
+            if wait:
+                try:
+                    job.result()
+                except Exception as e:
+                    print(f"Error saving the stems of {song_name}: {str(e)}")
+                    return []
+        return stems
+
+def _store_written(cache, key, sources, info, extras, job):
+    """Done callback of a StemJob: store its stems in the separation cache if they were all written"""
+    if job.exception() is not None:
+        return
+    try:
+        cache.store(key, job.paths, sources, info, extras=extras)
+    except Exception as e:
+        # runs on a writer thread, nobody would see the exception
+        print(f"Could not store {key[:12]} in the separation cache: {str(e)}")
+
+def stems_duration(stem_paths):
+    """Seconds of audio of separated stems: from the energy manifest if there is one, since the
+    files may still be being written, otherwise from the header of the first one"""
+    manifest = stem_energy.load_manifest(os.path.splitext(os.path.basename(stem_paths[0]))[0].rsplit('_', 1)[0],
+                                         os.path.dirname(stem_paths[0]))
+    if manifest and manifest['stems'] and manifest['sr']:
+        return next(iter(manifest['stems'].values()))['samples'] / manifest['sr']
+    stem_writer.wait(stem_paths[:1])
+    return librosa.get_duration(path=stem_paths[0])  # header only
+
+def find_songs(songs):
+    """Expand a list of files and/or directories into the audio files to process"""
+    if isinstance(songs, str):
+        songs = [songs]
+    found = []
+    for song in songs:
+        if os.path.isdir(song):
+            for name in sorted(os.listdir(song)):
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    found.append(os.path.join(song, name))
+        else:
+            found.append(song)
+    return found
+
+def separate_batch(songs, intra_op_threads=None, inter_op_threads=None, streaming=False, window_seconds=30.0,
+                   cache=None, pack=None):
+    """Separate a list (or directory) of songs with a single warm Demucs model
+
+    Returns one dict per song with the stem paths, wall time and real-time factor
+    (processing seconds per second of audio, lower is faster). With streaming=True
+    every song goes through separate_instruments_streaming. Songs already in the
+    separation cache are not separated again (cache=False disables it).
+    pack: separate with separate_songs_packed, pack segments per forward pass.
+    """
+    import time
+
+    configure_torch_threads(intra_op_threads, inter_op_threads)
+    if pack:
+        if streaming:
+            print("Packed separation reads whole songs, --stream is ignored")
+        return separate_songs_packed(songs, pack, cache=cache)
+
+    results = []
+    for song in find_songs(songs):
+        start = time.perf_counter()
+        # load_separator keeps the model warm, it is only loaded on the first cache miss;
+        # the stems are written in the background while the next song is separated
+        stems = separate_with_cache(song, streaming, window_seconds, cache, wait=False)
+        elapsed = time.perf_counter() - start
+
+        audio_seconds = 0.0
+        if stems:
+            audio_seconds = stems_duration(stems)
+        rtf = elapsed / audio_seconds if audio_seconds else float('nan')
+        print(f"{song}: {elapsed:.1f}s for {audio_seconds:.1f}s of audio (RTF {rtf:.3f})")
+        results.append({
+            'song': song,
+            'stems': stems,
+            'seconds': elapsed,
+            'audio_seconds': audio_seconds,
+            'rtf': rtf,
+        })
+    return results
+
+
+
+def separate_songs_packed(songs, batch_size=packed_separation.DEFAULT_BATCH_SIZE, model=None, device=None,
+                          cache=None, output_dir="separated_wavs"):
+    """Separate a list (or directory) of songs with segments of several songs in every Demucs forward pass
+
+    For queues of short clips: the songs are decoded one after another as the
+    batches need more segments, and each song's stems are written to
+    separated_wavs/<song>_<stem>.wav (with the energy manifest) as soon as its
+    last segment is done. Songs already in the separation cache are not
+    separated again (cache=False disables it). Prints the throughput in
+    audio-seconds per wall-second; returns one dict per song like separate_batch
+    (the model time is shared by the batches, so every song gets the same RTF).
+    """
+    import time
+
+    if model is None:
+        model, device = load_separator()
+    if cache is None:
+        cache = separation_cache.SeparationCache()
+    params = separation_params()
+    results = {}
+    keys = {}
+    to_separate = []
+    for path in find_songs(songs):
+        song_name = os.path.splitext(os.path.basename(path))[0]
+        results[path] = {'song': path, 'stems': [], 'seconds': 0.0, 'audio_seconds': 0.0, 'rtf': float('nan')}
+        if cache is not False:
+            keys[path] = separation_cache.cache_key(path, MODEL_NAME, 44100, params)
+            stems = cache.fetch(keys[path], song_name, output_dir)
+            if stems:
+                print(f"Separation cache hit for {song_name} ({keys[path][:12]})")
+                results[path].update(stems=stems, audio_seconds=librosa.get_duration(path=stems[0]))
+                continue
+        to_separate.append(path)
+
+    def mixes():
+        for path in to_separate:
+            try:
+                audio, sr = audio_store.load(path, sr=model.samplerate, mono=False)
+            except Exception as e:
+                print(f"Could not load {path}: {str(e)}")
+                continue
+            if audio.ndim == 1:
+                audio = np.stack([audio] * model.audio_channels)
+            results[path]['audio_seconds'] = audio.shape[-1] / sr
+            yield path, torch.from_numpy(np.ascontiguousarray(audio))
+
+    os.makedirs(output_dir, exist_ok=True)
+    sr = model.samplerate
+    separated = []
+    start = time.perf_counter()
+    with stage_profiler.stage("demucs:packed"):
+        for path, sources in packed_separation.separate_packed(
+                model, mixes(), batch_size, APPLY_MODEL_PARAMS.get('segment'), APPLY_MODEL_PARAMS['overlap'],
+                APPLY_MODEL_PARAMS['shifts']):
+            song_name = os.path.splitext(os.path.basename(path))[0]
+            stems = {source_name: sources[idx].numpy() for idx, source_name in enumerate(model.sources)}
+            # written in the background while the next batches go through the model
+            job = stem_writer.get_writer().write_stems(song_name, stems, sr, output_dir, STEM_FORMAT)
+            stem_energy.save_manifest_from_stems(song_name, stems, sr, output_dir)
+            if path in keys:
+                info = {'song': song_name, 'model': MODEL_NAME, 'samplerate': 44100, 'params': params}
+                json_path, npz_path = stem_energy.manifest_paths(song_name, output_dir)
+                job.add_done_callback(functools.partial(
+                    _store_written, cache, keys[path], model.sources, info,
+                    {'energy.json': json_path, 'energy.npz': npz_path}))
+            results[path]['stems'] = job.paths
+            separated.append(path)
+            print(f"Separated {song_name} ({time.perf_counter() - start:.1f}s)")
+    elapsed = time.perf_counter() - start
+
+    audio_seconds = sum(results[path]['audio_seconds'] for path in separated)
+    if separated:
+        print(f"Separated {len(separated)} songs ({audio_seconds:.1f}s of audio) in {elapsed:.1f}s with batches of "
+              f"{batch_size} segments: {audio_seconds / elapsed:.2f} audio-seconds per second")
+    for path in separated:
+        result = results[path]
+        result['seconds'] = elapsed * result['audio_seconds'] / audio_seconds if audio_seconds else 0.0
+        result['rtf'] = elapsed / audio_seconds if audio_seconds else float('nan')
+    return list(results.values())
+
+def mp3_to_midi(mp3_path, midi_output_path, engine=None, raise_errors=False):
     
 
-    """Convert MP3 / WAV to MIDI using basic_pitch with multi-instrument support"""
-    from basic_pitch import ICASSP_2022_MODEL_PATH
-    from basic_pitch.inference import predict_and_save
+    """Convert MP3 / WAV to MIDI using basic_pitch with multi-instrument support
+
+    engine: a transcription.TranscriptionEngine (default: the process-wide one,
+    so the basic_pitch model is only loaded once).
+    raise_errors: re-raise instead of printing the error and returning None.
+    """
+    if engine is None:
+        engine = transcription.get_engine()
     print("debug mp3_path name: ", mp3_path) #flag
 
     try:
-         # Load WAV file, verify it has significant content
-        y, sr = librosa.load(mp3_path, sr=44100)
-        # Calculation of RMS
-        rms = librosa.feature.rms(y=y)[0]
-
-        average_rms = np.mean(rms)
-        print(f"Average RMS for {mp3_path}: {average_rms}")
-        # If RMS too low, file considered empty
-        if average_rms < 0.01:
-            print(f"File {mp3_path} is empty or has no significant content. Skipping...")
-            return None #no returns any file, not even an empty one
+        instrument_name = stem_name(mp3_path)
+        with stage_profiler.stage(f"gate:{instrument_name}"):
+            # energy computed during separation: the silence check doesn't need to decode anything
+            energy = stem_energy.lookup(mp3_path)
+            if energy is not None and energy['average_rms'] < RMS_SILENCE_THRESHOLD:
+                print(f"File {mp3_path} is empty or has no significant content (energy manifest). Skipping...")
+                return None
+
+             # Load WAV file, verify it has significant content
+            y, sr = audio_store.load(mp3_path, sr=44100)
+            if energy is None:
+                # Calculation of RMS
+                average_rms = stem_rms(y)
+                print(f"Average RMS for {mp3_path}: {average_rms}")
+                # If RMS too low, file considered empty
+                if average_rms < RMS_SILENCE_THRESHOLD:
+                    print(f"File {mp3_path} is empty or has no significant content. Skipping...")
+                    return None #no returns any file, not even an empty one
+        stem_seconds = y.shape[-1] / sr
 
         print(f"Processing instrument: {os.path.basename(mp3_path)}")    #debug 
 
-        instrument_name = os.path.basename(mp3_path).split('_')[2].split('.')[0] 
         print(f"Processing instrument: {instrument_name}")  # Debug
         
         midi_output_path_drums ="midi_files/trial_ensemble_drums.mid"
         # MIDI program according to instrument
-        if 'guitar' in instrument_name:
-            program = 25  # Electric Guitar
-        elif 'bass' in instrument_name:
-            program = 33  # Electric Bass
-        elif 'piano' in instrument_name:
-            program = 0   # Acoustic Piano
-        elif 'drums' in instrument_name:
-            program = 10  # Drums. We're never going to use this, its just so it does not crash due to no value in program var
-            
-        elif 'other' in instrument_name:
-            program = 0   # Default to piano for 'other'
-        else:
-            program = 0   # Default to piano
+        program = stem_program(instrument_name)
         
         print(f"Selected program: {program}")  # Debug
         if (program == 10):
             print("Drums detected, converting wav into MIDI...")
-            drum_counts = drumtest_1_1.wav_to_drum_midi(mp3_path, midi_output_path)
+            with stage_profiler.stage(f"drums:{instrument_name}", stem_seconds):
+                drum_counts = drumtest_1_1.wav_to_drum_midi(mp3_path, midi_output_path)
             print("Drums successfully converted into MIDI...")
+            return midi_output_path
         else: #the machine "listens" to the audio and "understands" it so it and detects instruments, chords, notes,rhythms..etc
-            predict_and_save(
-                model_or_model_path=ICASSP_2022_MODEL_PATH,
-                audio_path_list=[mp3_path],
-                output_directory=os.path.dirname(midi_output_path),
-                save_midi=True,
-                sonify_midi=False,
-                save_model_outputs=False,
-                save_notes=False
-            )
-            basic_pitch_midi = midi_output_path.replace('.mid', '_basic_pitch.mid')
-            if os.path.exists(basic_pitch_midi):
-                pm = pretty_midi.PrettyMIDI(basic_pitch_midi)
-                print(f"Before change - Program: {pm.instruments[0].program}")  # Debug
-                
-                for instrument in pm.instruments:
-                    for note in instrument.notes:
-                        duration = note.end - note.start
-                        note.end = note.start + (duration / 2)  # Make each note half as long (for better accuracy)
-                
-                # Change instrument program
-                for instrument in pm.instruments:
-                    instrument.program = program
-                    if 'drums' in instrument_name:
-                        instrument.is_drum = True
-                        print("Setting as drums")  # Debug
-                
-                print(f"After change - Program: {pm.instruments[0].program}")  # Debug
-                
-                # debug. calculating the tempo
-                estimated_tempo = pm.estimate_tempo()
-                print(f"Estimated tempo: {estimated_tempo} BPM of instrument {instrument_name}")
-                # save modified midi
-                pm.write(midi_output_path)
-                # remove temporary midi
-                os.remove(basic_pitch_midi)
-                return midi_output_path
+            # the audio is already decoded, and the notes are shortened + given their
+            # program in memory, so the MIDI is written exactly once
+            # only the regions where the stem is playing go through basic_pitch
+            regions = stem_energy.regions_worth_slicing(energy)
+            with stage_profiler.stage(f"transcribe:{instrument_name}", stem_seconds):
+                if regions:
+                    print(f"Transcribing {len(regions)} active regions of {instrument_name}")
+                    table = engine.transcribe_regions(y, sr, regions, program=program,
+                                                      is_drum='drums' in instrument_name)
+                else:
+                    table = engine.transcribe(y, sr, program=program, is_drum='drums' in instrument_name)
+            print(f"After change - Program: {table.instruments[0]['program'] if table.instruments else None}")  # Debug
+            
+            # save modified midi
+            table.write_midi(midi_output_path)
+            return midi_output_path
             
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Error processing {mp3_path}: {str(e)}")
         return None
 
+RMS_SILENCE_THRESHOLD = 0.01
+# seconds in the middle of the song used for tempo estimation (None = the whole song)
+TEMPO_WINDOW_SECONDS = 60.0
+
+def stem_rms(y):
+    """Average RMS of a stem (mono or [channels, samples]) used to skip silent stems"""
+    if y.ndim > 1:
+        y = librosa.to_mono(y)
+    return np.mean(librosa.feature.rms(y=y)[0])
+
+def stem_program(instrument_name):
+    """General MIDI program for a Demucs stem name"""
+    if 'guitar' in instrument_name:
+        return 25  # Electric Guitar
+    elif 'bass' in instrument_name:
+        return 33  # Electric Bass
+    elif 'piano' in instrument_name:
+        return 0   # Acoustic Piano
+    elif 'drums' in instrument_name:
+        return 10  # Drums. We're never going to use this, its just so it does not crash due to no value in program var
+    elif 'other' in instrument_name:
+        return 0   # Default to piano for 'other'
+    return 0   # Default to piano
+
+def stem_name(wav_path):
+    """'separated_wavs/trial_ensemble_bass.wav' -> 'bass' (song names may contain underscores too)"""
+    return os.path.splitext(os.path.basename(wav_path))[0].rsplit('_', 1)[-1]
+
+def _init_transcription_worker():
+    # one basic_pitch model per worker process, loaded before the first stem arrives
+    transcription.get_engine()
+
+def _transcribe_stem_job(wav_path, midi_path, xml_path, tempo, profile_started=None):
+    """Worker task: one stem to MIDI, then straight to MusicXML. Always returns a result dict
+
+    When the parent is profiling (profile_started, see stage_profiler.collect)
+    the worker's stages come back in result['stages'].
+    """
+    import time
+
+    start = time.perf_counter()
+    result = {'stem': stem_name(wav_path), 'wav': wav_path, 'midi': None, 'xml': None,
+              'status': 'ok', 'error': None, 'seconds': 0.0}
+    with stage_profiler.collect(profile_started) as stages:
+        _run_stem_job(result, wav_path, midi_path, xml_path, tempo)
+    if profile_started is not None:
+        result['stages'] = stages
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def _run_stem_job(result, wav_path, midi_path, xml_path, tempo):
+    try:
+        # drums are routed to drumtest_1_1.wav_to_drum_midi inside mp3_to_midi
+        result['midi'] = mp3_to_midi(wav_path, midi_path, raise_errors=True)
+        if result['midi'] is None:
+            result['status'] = 'skipped'  # silent stem
+        elif tempo is not None:  # no tempo: MIDI only, the XML is exported later
+            midi_to_musicxml(midi_path, xml_path, tempo)
+            result['xml'] = xml_path
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = f"{type(e).__name__}: {str(e)}"
+        result['traceback'] = traceback.format_exc()
+
+def transcribe_stems_parallel(song_name, tempo, workers=None, wav_folder="separated_wavs", output_dir="midi_files"):
+    """Transcribe every separated stem of song_name in a process pool
+
+    Each worker keeps one basic_pitch model loaded, and a stem is exported to XML
+    as soon as its own MIDI is ready. Returns one result dict per stem with
+    status 'ok', 'skipped' (silent) or 'error' (+ the error message).
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = []
+    for wav_file in stem_writer.stem_files(song_name, STEMS, wav_folder):
+        midi_name = os.path.splitext(wav_file)[0] + ".mid"
+        jobs.append((os.path.join(wav_folder, wav_file),
+                     os.path.join(output_dir, midi_name),
+                     os.path.join(output_dir, midi_name.replace(".mid", ".xml")),
+                     tempo,
+                     stage_profiler.started()))
+    if not jobs:
+        return []
+
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    results = []
+    # spawn: forking a process that already imported torch/tensorflow can deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_transcription_worker) as pool:
+        futures = [pool.submit(_transcribe_stem_job, *job) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            # stages recorded in the worker process join this song's profile
+            stage_profiler.merge(result.pop('stages', None))
+            print(f"[{result['status']}] {result['stem']} in {result['seconds']:.1f}s"
+                  + (f": {result['error']}" if result['error'] else ""))
+            results.append(result)
+    return results
+
 def changing_piano_to_guitar(midi_path, midi_output_path):
     #unfinished
     try:
@@ -208,15 +759,23 @@ def changing_piano_to_guitar(midi_path, midi_output_path):
         traceback.print_exc()
         return None
 
-def midi_to_musicxml(midi_path, xml_output_path, tempo):
-    """Convert MIDI to MusicXML with better instrument and voice separation"""
-    from music21 import meter, key, instrument, converter, stream, tempo as m21_tempo, metadata, expressions, clef
+def midi_to_musicxml(midi_path, xml_output_path, tempo, fast=True, tempo_map=None):
+    """Convert MIDI to MusicXML with better instrument and voice separation
+
+    fast: write the MusicXML directly with musicxml_writer (tempo-aware grid,
+    drums included; notes follow tempo_map's beats if given). fast=False builds
+    the score with music21 note by note.
+    """
+    if fast:
+        return musicxml_writer.midi_to_musicxml(midi_path, xml_output_path, tempo, tempo_map)
+    from music21 import meter, key, instrument, stream, tempo as m21_tempo, metadata, expressions, clef
     
     # Load MIDI file
     pm = pretty_midi.PrettyMIDI(midi_path)
-    
-    # Load MIDI file with music21 (for the notes/structure)
-    midi_stream = converter.parse(midi_path)
+    # every note snapped to the quarter-length grid (round(x * 4) / 4) in one go
+    table = NoteTable.from_pretty_midi(pm)
+    offsets = np.round(table.start * 4) / 4
+    lengths = np.round(table.duration * 4) / 4
     
     # Create main score
     score = stream.Score()
@@ -231,21 +790,24 @@ def midi_to_musicxml(midi_path, xml_output_path, tempo):
     else:
         time_sig = meter.TimeSignature('4/4')
     
-    # Try to get key signature (might fail for drum tracks)
-    try:
-        key_analysis = midi_stream.analyze('key')
-    except:
-        # Default to C major if key analysis fails, for drums
+    # Key signature from the notes we already have (no second parse with music21)
+    estimated_key = key_detection.midi_key(midi_path, table)
+    if estimated_key is None:
+        # Default to C major when there are no pitched notes, for drums
         key_analysis = key.Key('C')
+    else:
+        key_analysis = key.Key(estimated_key[0], estimated_key[1])
     
     # Create tempo mark
     mm = m21_tempo.MetronomeMark(number=tempo)
     first_part_created = False
     
     # For piano, create two parts: right hand (treble) and left hand (bass)
-    for midi_instrument in pm.instruments:
+    for index, midi_instrument in enumerate(pm.instruments):
         if len(midi_instrument.notes) == 0:
             continue
+        rows = table.instrument == index
+        quantized_notes = zip(table.pitch[rows].tolist(), offsets[rows].tolist(), lengths[rows].tolist())
             
         # Create a new part
         part = stream.Part()
@@ -271,15 +833,12 @@ def midi_to_musicxml(midi_path, xml_output_path, tempo):
             
             # Split notes between hands
             MIDDLE_C = 60
-            for midi_note in midi_instrument.notes:
-                n = music21.note.Note(
-                    pitch=midi_note.pitch,
-                    quarterLength=round((midi_note.end - midi_note.start) * 4) / 4
-                )
-                if midi_note.pitch >= MIDDLE_C:
-                    treble_part.insert(round(midi_note.start * 4) / 4, n)
+            for pitch, offset, length in quantized_notes:
+                n = music21.note.Note(pitch=pitch, quarterLength=length)
+                if pitch >= MIDDLE_C:
+                    treble_part.insert(offset, n)
                 else:
-                    bass_part.insert(round(midi_note.start * 4) / 4, n)
+                    bass_part.insert(offset, n)
             
             treble_cleaned = treble_part.makeNotation()
             bass_cleaned = bass_part.makeNotation()
@@ -295,12 +854,8 @@ def midi_to_musicxml(midi_path, xml_output_path, tempo):
             part.append(key_analysis)
             part.append(instrument.ElectricBass())
             
-            for midi_note in midi_instrument.notes:
-                n = music21.note.Note(
-                    pitch=midi_note.pitch,
-                    quarterLength=round((midi_note.end - midi_note.start) * 4) / 4
-                )
-                part.insert(round(midi_note.start * 4) / 4, n)
+            for pitch, offset, length in quantized_notes:
+                part.insert(offset, music21.note.Note(pitch=pitch, quarterLength=length))
                 
         elif midi_instrument.program in range(24, 32):  # Guitar sounds
             part.append(clef.TrebleClef())
@@ -311,12 +866,8 @@ def midi_to_musicxml(midi_path, xml_output_path, tempo):
             part.append(key_analysis)
             part.append(instrument.ElectricGuitar())
             
-            for midi_note in midi_instrument.notes:
-                n = music21.note.Note(
-                    pitch=midi_note.pitch,
-                    quarterLength=round((midi_note.end - midi_note.start) * 4) / 4
-                )
-                part.insert(round(midi_note.start * 4) / 4, n)
+            for pitch, offset, length in quantized_notes:
+                part.insert(offset, music21.note.Note(pitch=pitch, quarterLength=length))
                 
         elif midi_instrument.is_drum:  # Drums
             part.append(clef.PercussionClef())
@@ -327,12 +878,8 @@ def midi_to_musicxml(midi_path, xml_output_path, tempo):
             part.append(key_analysis)
             part.append(instrument.Percussion())
             
-            for midi_note in midi_instrument.notes:
-                n = music21.note.Note(
-                    pitch=midi_note.pitch,
-                    quarterLength=round((midi_note.end - midi_note.start) * 4) / 4
-                )
-                part.insert(round(midi_note.start * 4) / 4, n)
+            for pitch, offset, length in quantized_notes:
+                part.insert(offset, music21.note.Note(pitch=pitch, quarterLength=length))
                 
         else:  # Other instruments
             part.append(clef.TrebleClef())
@@ -344,12 +891,8 @@ def midi_to_musicxml(midi_path, xml_output_path, tempo):
             inst = instrument.instrumentFromMidiProgram(midi_instrument.program)
             part.append(inst)
             
-            for midi_note in midi_instrument.notes:
-                n = music21.note.Note(
-                    pitch=midi_note.pitch,
-                    quarterLength=round((midi_note.end - midi_note.start) * 4) / 4
-                )
-                part.insert(round(midi_note.start * 4) / 4, n)
+            for pitch, offset, length in quantized_notes:
+                part.insert(offset, music21.note.Note(pitch=pitch, quarterLength=length))
         
         # Clean up and add part (except for piano which is already added)
         if midi_instrument.program not in range(0, 8):
@@ -393,17 +936,16 @@ def midi_to_musicxml(midi_path, xml_output_path, tempo):
     score.append(part_drums)
 '''
 def putting_midis_together(midi_paths, output_midis_path): #will have to prepare the midi_paths list beforehand
-    #the object we're about to create only exists in the memory, not on the disk.
-    combined_midi = pretty_midi.PrettyMIDI() #create a new pretty midi object empty.
+    #midi_paths can also hold NoteTables already in memory, those aren't parsed again
+    tables = []
     for midi_path in midi_paths: #example of midi_paths: "C:/Musica/proyecto/piano.mid"
-        
-        pm = pretty_midi.PrettyMIDI(midi_path)
-        for instrument in pm.instruments:
-            print(f"instrument in {midi_path}: {instrument.name}")
-            combined_midi.instruments.append(instrument)
-    #now we save the created object in the disk, as a file
+        table = midi_path if isinstance(midi_path, NoteTable) else NoteTable.from_midi_file(midi_path)
+        print(f"instruments in {midi_path}: {[meta['name'] for meta in table.instruments]}")
+        tables.append(table)
+    #one table with every instrument, written straight to the disk
+    combined_midi = NoteTable.merge(tables)
     os.makedirs(os.path.dirname(output_midis_path), exist_ok=True)
-    combined_midi.write(output_midis_path)
+    combined_midi.write_midi(output_midis_path)
 
     return output_midis_path 
 
@@ -411,24 +953,27 @@ def midi_to_wav(midi_path, wav_output_path):
     #using sf: its a library of sounds(includes real audios of different instruments)(its like a sound bank that the synthesizer uses to convert MIDI notes into real audio)
     """Convert MIDI to WAV using FluidSynth with proper instrument sounds"""
     try:
-        from midi2audio import FluidSynth
-
         # checking the content of the MIDI
-        pm = pretty_midi.PrettyMIDI(midi_path)
-        print(f"Number of instruments in the MIDI: {len(pm.instruments)}") #debug loop
-        for i, instrument in enumerate(pm.instruments):
-            print(f"Instrumento {i+1}: {len(instrument.notes)} notes")
+        table = NoteTable.from_midi_file(midi_path)
+        print(f"Number of instruments in the MIDI: {len(table.instruments)}") #debug loop
+        for i in range(len(table.instruments)):
+            print(f"Instrumento {i+1}: {np.count_nonzero(table.instrument == i)} notes")
         
         # checking the directory exists
         os.makedirs(os.path.dirname(wav_output_path), exist_ok=True)
         # update this path to the place where you saved the .sf2 file
         soundfont_path = "./GeneralUser-GS.sf2"
-        
-        # instance of FluidSynth with specific configuration
-        fs = FluidSynth(sound_font=soundfont_path, sample_rate=44100)
-        
-        # Convertir con parámetros específicos
-        fs.midi_to_audio(midi_path, wav_output_path)
+
+        try:
+            # in-process synth: the soundfont stays loaded and the instruments render in parallel
+            synth_renderer.get_renderer(soundfont_path, 44100).render_to_file(table, wav_output_path)
+        except (ImportError, OSError) as e:
+            # no pyfluidsynth / libfluidsynth: fall back to the fluidsynth binary
+            print(f"In-process FluidSynth unavailable ({str(e)}), using the fluidsynth command")
+            from midi2audio import FluidSynth
+
+            fs = FluidSynth(sound_font=soundfont_path, sample_rate=44100)
+            fs.midi_to_audio(midi_path, wav_output_path)
         
         # check if the wav file was created
         if os.path.exists(wav_output_path):
@@ -444,8 +989,195 @@ def midi_to_wav(midi_path, wav_output_path):
         traceback.print_exc() #shows something similar to what would appear in the terminal
         return None
 
-def convert_mp3_to_musicxml(mp3_path, tempo, output_dir=None):
-    """Convert MP3 to MusicXML through MIDI intermediate"""
+def midi_to_preview_wav(midi_path, wav_output_path):
+    """Quick audition of a MIDI with the NumPy preview synth (no soundfont, no fluidsynth)"""
+    try:
+        preview_synth.preview_to_file(midi_path, wav_output_path)
+        print(f"Preview WAV created: {wav_output_path}")
+        return wav_output_path
+    except Exception as e:
+        print(f"Error in MIDI preview: {str(e)}")
+        return None
+
+def transcribe_songs_batched(song_names, tempos, batch_size=transcription.DEFAULT_BATCH_SIZE,
+                             wav_folder="separated_wavs", output_dir="midi_files"):
+    """Transcribe the separated stems of one or several songs with packed basic_pitch batches
+
+    The windows of every non-drum, non-silent stem of every song go through the
+    model together in batches of batch_size windows; the notes are then split
+    back per stem, written to MIDI and exported to XML. Drums still go to
+    wav_to_drum_midi. tempos: one tempo per song (or a single value for all);
+    a song whose tempo is None only gets its MIDIs.
+    Returns one result dict per stem, like transcribe_stems_parallel.
+    """
+    import time
+
+    if isinstance(song_names, str):
+        song_names = [song_names]
+    if not isinstance(tempos, (list, tuple)):
+        tempos = [tempos] * len(song_names)
+    os.makedirs(output_dir, exist_ok=True)
+    engine = transcription.get_engine()
+
+    results = []
+    pending = []  # (result, item, tempo) of the stems that go through basic_pitch
+    for song_name, tempo in zip(song_names, tempos):
+        for wav_file in stem_writer.stem_files(song_name, STEMS, wav_folder):
+            wav_path = os.path.join(wav_folder, wav_file)
+            midi_path = os.path.join(output_dir, os.path.splitext(wav_file)[0] + ".mid")
+            result = {'stem': stem_name(wav_path), 'wav': wav_path, 'midi': None,
+                      'xml': midi_path.replace(".mid", ".xml"), 'status': 'ok', 'error': None, 'seconds': 0.0}
+            results.append(result)
+            try:
+                program = stem_program(result['stem'])
+                energy = stem_energy.lookup(wav_path)
+                if energy is not None:
+                    average_rms = energy['average_rms']  # no decoding needed
+                else:
+                    y, sr = audio_store.load(wav_path, sr=44100)
+                    average_rms = stem_rms(y)
+                if average_rms < RMS_SILENCE_THRESHOLD:
+                    result['status'] = 'skipped'
+                    result['xml'] = None
+                elif program == 10:
+                    with stage_profiler.stage(f"drums:{result['stem']}"):
+                        drumtest_1_1.wav_to_drum_midi(wav_path, midi_path)
+                    result['midi'] = midi_path
+                    if tempo is None:
+                        result['xml'] = None
+                    else:
+                        midi_to_musicxml(midi_path, result['xml'], tempo)
+                else:
+                    result['midi'] = midi_path
+                    y, sr = audio_store.load(wav_path, sr=44100)
+                    item = {'y': y, 'sr': sr, 'program': program, 'regions': stem_energy.regions_worth_slicing(energy)}
+                    pending.append((result, item, tempo))
+            except Exception as e:
+                result['status'] = 'error'
+                result['error'] = f"{type(e).__name__}: {str(e)}"
+                result['xml'] = None
+
+    start = time.perf_counter()
+    try:
+        batch_seconds = sum(item['y'].shape[-1] / item['sr'] for _, item, _ in pending)
+        with stage_profiler.stage("transcribe:batch", batch_seconds):
+            tables = engine.transcribe_batch([item for _, item, _ in pending], batch_size)
+    except Exception as e:
+        for result, _, _ in pending:
+            result.update({'status': 'error', 'error': f"{type(e).__name__}: {str(e)}", 'midi': None, 'xml': None})
+        return results
+    elapsed = time.perf_counter() - start
+    print(f"Transcribed {len(pending)} stems in one batched pass ({elapsed:.1f}s)")
+
+    for (result, _, tempo), table in zip(pending, tables):
+        try:
+            table.write_midi(result['midi'])
+            if tempo is None:
+                result['xml'] = None
+            else:
+                midi_to_musicxml(result['midi'], result['xml'], tempo)
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = f"{type(e).__name__}: {str(e)}"
+        # the model time is shared by the whole batch, split it evenly
+        result['seconds'] = elapsed / len(pending)
+    return results
+
+def transcribe_stems_in_memory(song_name, stems, sr, tempo, engine=None, output_dir="midi_files", energy=None):
+    """Gate, transcribe and export stems that are still in memory (no WAV decoding)
+
+    stems: {stem_name: array [channels, samples]} as returned by separate_stems.
+    energy: {stem_name: stem_energy entry}, computed here for the stems missing from it.
+    tempo=None only writes the MIDIs (the XML is exported later, see export_musicxml).
+    Returns one result dict per stem, like transcribe_stems_parallel.
+    """
+    import time
+
+    os.makedirs(output_dir, exist_ok=True)
+    if engine is None:
+        engine = transcription.get_engine()
+
+    results = []
+    for instrument_name, audio in stems.items():
+        start = time.perf_counter()
+        midi_path = os.path.join(output_dir, f"{song_name}_{instrument_name}.mid")
+        xml_path = os.path.join(output_dir, f"{song_name}_{instrument_name}.xml")
+        result = {'stem': instrument_name, 'wav': None, 'midi': None, 'xml': None,
+                  'status': 'ok', 'error': None, 'seconds': 0.0}
+        try:
+            stem_seconds = audio.shape[-1] / sr
+            entry = (energy or {}).get(instrument_name)
+            if entry is None:
+                with stage_profiler.stage(f"gate:{instrument_name}", stem_seconds):
+                    entry = stem_energy.describe(stem_energy.frame_energy(audio), sr, audio.shape[-1])
+            average_rms = entry['average_rms']
+            print(f"Average RMS for {instrument_name}: {average_rms}")
+            program = stem_program(instrument_name)
+            if average_rms < RMS_SILENCE_THRESHOLD:
+                print(f"Stem {instrument_name} has no significant content. Skipping...")
+                result['status'] = 'skipped'
+            else:
+                if program == 10:
+                    with stage_profiler.stage(f"drums:{instrument_name}", stem_seconds):
+                        drumtest_1_1.audio_to_drum_midi(audio, sr, midi_path)
+                else:
+                    regions = stem_energy.regions_worth_slicing(entry)
+                    with stage_profiler.stage(f"transcribe:{instrument_name}", stem_seconds):
+                        if regions:
+                            engine.transcribe_regions(audio, sr, regions, program=program).write_midi(midi_path)
+                        else:
+                            engine.transcribe_to_file(audio, sr, midi_path, program=program)
+                result['midi'] = midi_path
+                if tempo is not None:
+                    midi_to_musicxml(midi_path, xml_path, tempo)
+                    result['xml'] = xml_path
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = f"{type(e).__name__}: {str(e)}"
+            result['traceback'] = traceback.format_exc()
+        result['seconds'] = time.perf_counter() - start
+        print(f"[{result['status']}] {instrument_name} in {result['seconds']:.1f}s"
+              + (f": {result['error']}" if result['error'] else ""))
+        results.append(result)
+    return results
+
+def separate_and_transcribe(file_path, tempo, write_wavs=True, engine=None):
+    """Separation straight into transcription, passing the stems as arrays
+
+    The stems never go through a WAV file on the critical path: they are gated,
+    transcribed and exported from memory. With write_wavs=True the usual
+    separated_wavs/<song>_<stem> files are still written, by the stem writer
+    while transcription runs.
+    """
+    song_name = os.path.splitext(os.path.basename(file_path))[0]
+    stems, sr = separate_stems(file_path)
+
+    job = None
+    energy = None
+    if write_wavs:
+        energy = stem_energy.save_manifest_from_stems(song_name, stems, sr)['stems']
+        job = stem_writer.get_writer().write_stems(song_name, stems, sr, "separated_wavs", STEM_FORMAT)
+
+    results = transcribe_stems_in_memory(song_name, stems, sr, tempo, engine, energy=energy)
+
+    if job is not None:
+        try:
+            paths = dict(zip(stems, job.result()))
+        except Exception as e:
+            print(f"Error saving the stems of {song_name}: {str(e)}")
+        else:
+            for result in results:
+                result['wav'] = paths.get(result['stem'])
+    return results
+
+def convert_mp3_to_musicxml(mp3_path, tempo, output_dir=None, workers=1, batch_size=None):
+    """Convert MP3 to MusicXML through MIDI intermediate
+
+    workers > 1 transcribes the stems concurrently (see transcribe_stems_parallel).
+    batch_size packs the windows of all stems into shared basic_pitch batches
+    (see transcribe_songs_batched).
+    tempo=None stops at the MIDIs, export_musicxml writes the XML afterwards.
+    """
     output_dir = "midi_files" # RELATIVE PATH (doesnt start with /)
     print(f"the output directory is {output_dir}")
     # Create output directory if it doesn't exist
@@ -456,22 +1188,28 @@ def convert_mp3_to_musicxml(mp3_path, tempo, output_dir=None):
     midi_path = os.path.join(output_dir, f"{song_name}.mid")
     print(f"the midi path is {midi_path}") #flag 
     xml_path = os.path.join(output_dir, f"{song_name}.xml")
+
+    if batch_size:
+        transcribe_songs_batched([song_name], tempo, batch_size, output_dir=output_dir)
+        return xml_path
+    if workers is None or workers > 1:
+        transcribe_stems_parallel(song_name, tempo, workers, output_dir=output_dir)
+        return xml_path
     
     # Perform conversion mp3 to midi of each separated wav file
     wav_folder = "separated_wavs"
-    for wav_file in os.listdir(wav_folder):
-        if wav_file.startswith(f"{song_name}_") and wav_file.endswith(".wav"):
-            wav_path = os.path.join(wav_folder, wav_file)
-            print(f"wav_folder: {wav_folder}") #flag, erase
-            print(f"wav_file: {wav_file}") #flag, erase
-            print(f"wav_path: {wav_path}") 
-            midi_name = wav_file.replace(".wav", ".mid")
-            midi_path = os.path.join("midi_files", midi_name)
-            print(f"midi_path: {midi_path}") 
-            
-            print(f"Converting {wav_file} to MIDI...")
-            mp3_to_midi(wav_path, midi_path)
-            print(f"Successfully converted {wav_file} to {midi_name}")
+    for wav_file in stem_writer.stem_files(song_name, STEMS, wav_folder):
+        wav_path = os.path.join(wav_folder, wav_file)
+        print(f"wav_folder: {wav_folder}") #flag, erase
+        print(f"wav_file: {wav_file}") #flag, erase
+        print(f"wav_path: {wav_path}") 
+        midi_name = os.path.splitext(wav_file)[0] + ".mid"
+        midi_path = os.path.join("midi_files", midi_name)
+        print(f"midi_path: {midi_path}") 
+        
+        print(f"Converting {wav_file} to MIDI...")
+        mp3_to_midi(wav_path, midi_path)
+        print(f"Successfully converted {wav_file} to {midi_name}")
     #mp3_to_midi(mp3_path, midi_path)
     #midi_to_musicxml(midi_path, xml_path, tempo)
 
@@ -484,14 +1222,11 @@ def convert_mp3_to_musicxml(mp3_path, tempo, output_dir=None):
             xml_path = os.path.join(output_dir, xml_name)
 
             pm = pretty_midi.PrettyMIDI(midi_path) #need this for the drums
-            print("Converting MIDI to XML...")
-            if any (instrument.is_drum for instrument in pm.instruments):
-                print("Drums detected, will work on it on a separate function..")
-                #midi_to_musicxml(midi_path, xml_path, tempo)
-            else:
+            if tempo is not None:
+                print("Converting MIDI to XML...")
+                # drums go through the same export (percussion staff)
                 midi_to_musicxml(midi_path, xml_path, tempo)
-                
-            print(f"Successfully converted {midi_file} to {xml_path}") #check what appears here
+                print(f"Successfully converted {midi_file} to {xml_path}") #check what appears here
             
             print(f"\nSeeing what instruments the song has: {midi_file}:")
             for instrument in pm.instruments:
@@ -515,12 +1250,10 @@ def convert_mp3_to_musicxml(mp3_path, tempo, output_dir=None):
     
     return xml_path # will return sth like "midi_files/The_Beatles_-_Help.xml" not a file! just the text that is the path
 
-def get_tempo(audio_path):
-    y, sr = librosa.load(audio_path) #y = actual audio data (numpy array, amplitude values of the signal)
-    # sr: sampling rate (samples per second)
-    tempo, _ = librosa.beat.beat_track(y=y, sr=sr, start_bpm=120, units='time')
-    #_ is to ignore the return value of the tuple from beat_track. it would be beat_frames: exact location where bets occur. we dont need it
-    return tempo
+def get_tempo(audio_path, window_seconds=TEMPO_WINDOW_SECONDS):
+    # beat tracking of (a window of) the song, cached per audio hash with the whole beat grid:
+    # tempo_analysis.tempo_map_for_file(audio_path) gives the beats and the local tempo too
+    return tempo_analysis.tempo_map_for_file(audio_path, window_seconds).bpm
 
 def choose_instrument():
     print("\nChoose the instrument you want to change: ")
@@ -589,57 +1322,60 @@ def choose_instrument():
     return instrument_to_be_changed, instrument_final #returning program numbers!
 
 
-if __name__ == "__main__":    
-    
-    tempo = get_tempo("trial_ensemble.mp3")
-    if isinstance(tempo, np.ndarray): #for older python versions
-        tempo = float(tempo[0])  
-    tempo = round(tempo)
-    
-    mp3_path = "trial_ensemble.mp3"
+def song_tempo(mp3_path, window_seconds=TEMPO_WINDOW_SECONDS):
+    """Tempo map of the song (tempo_analysis.TempoMap); round(tempo_map.bpm) is the tempo mark"""
+    # the mix, not the drum stem: this runs while the song is still being separated
+    tempo_map = tempo_analysis.tempo_map_for_file(mp3_path, window_seconds)
     song_name = os.path.splitext(os.path.basename(mp3_path))[0]  # "trial_ensemble"
-    print(f"The tempo of the song {song_name} is {tempo} bpm") #flag
-    # Separar instrumentos
-    separate_instruments(mp3_path)
-    print("Successfully separated the instruments")
+    print(f"The tempo of the song {song_name} is {round(tempo_map.bpm)} bpm") #flag
+    return tempo_map
 
-    convert_mp3_to_musicxml(mp3_path, tempo, output_dir=None) 
-
-    #modifying the songs
-    input_modified_midi_path = "midi_files/trial_ensemble_piano.mid"
-    output_modified_midi_path = "modified_midis/trial_ensemble_modified.mid"
-
-    # Crear el directorio si no existe
-    os.makedirs("modified_midis", exist_ok=True)
-
-    # The next task: modify instruments within the whole song. This step is unfinished
-    #original_instrument_program, new_instrument_program = choose_instrument()
-    #changing_piano_to_guitar(input_modified_midi_path, output_modified_midi_path)
+def export_musicxml(song_name, tempo_map, output_dir="midi_files"):
+    """MusicXML of every stem MIDI of the song (midi_files/<song>_<stem>.mid -> .xml), on its beat grid"""
+    xml_paths = []
+    for midi_file in sorted(os.listdir(output_dir)):
+        if midi_file.startswith(f"{song_name}_") and midi_file.endswith(".mid"):
+            midi_path = os.path.join(output_dir, midi_file)
+            xml_path = os.path.join(output_dir, midi_file.replace(".mid", ".xml"))
+            midi_to_musicxml(midi_path, xml_path, round(tempo_map.bpm), tempo_map=tempo_map)
+            xml_paths.append(xml_path)
+    print(f"Exported {len(xml_paths)} MusicXML files of {song_name}")
+    return xml_paths
 
-    midi_input_path = "midi_files/trial_ensemble_drums.mid"
-    xml_output_path = "midi_files/trial_ensemble_drums1.xml"
+def merge_song_midis(song_name, tempo_map=None, midi_dir="midi_files"):
+    """Put the stem midis of the song together in a single midi file; returns its path or None
 
-    #to put all the midis together in a single midi file
-    midi_files = glob.glob("./midi_files/*.mid") # also could use: files = os.listdir("midi_files") but glob.glob comes in handy for filtering and only taking midi files
-    #glob.glob will automatically return a list of strings, each string is the (relative) path to a midi file
+    The stems go into the transcription library first (with tempo, key and stem
+    energy), and the combined MIDI is a slice of the library.
+    """
+    # only this song's stems: a glob of midi_files/*.mid also picked up every other song
+    midi_files = {stem: os.path.join(midi_dir, f"{song_name}_{stem}.mid") for stem in STEMS}
+    midi_files = {stem: path for stem, path in midi_files.items() if os.path.exists(path)}
     print("MIDIs encontrados:")
-    for midi_file in midi_files:
+    for midi_file in midi_files.values():
         print(f"- {midi_file}")
 
-    if midi_files:  # Verifying that files were found
-        output_midis_path = f"final_combined_midi/{song_name}_combined.mid"
-        os.makedirs(os.path.dirname(output_midis_path), exist_ok=True)
-        combined_midi = putting_midis_together(midi_files, output_midis_path)
-        print(f"MIDIs combined saved 1 in: {combined_midi}")
-    else:
+    if not midi_files:  # Verifying that files were found
         print("No MIDI files found to combine")
+        return None
+    manifest = stem_energy.load_manifest(song_name) or {'stems': {}}
+    library = transcription_library.get_library()
+    library.add_song(song_name, {stem: NoteTable.from_midi_file(path) for stem, path in midi_files.items()},
+                     tempo=tempo_map.bpm if tempo_map is not None else None,
+                     energies=manifest['stems'], sources=midi_files)
+    output_midis_path = f"final_combined_midi/{song_name}_combined.mid"
+    combined_midi = putting_midis_together([library.song_table(song_name, stems=list(midi_files))],
+                                           output_midis_path)
+    print(f"MIDIs combined saved 1 in: {combined_midi}")
+    return combined_midi
 
+def render_song(song_name, midi_path, preview=False):
+    """Combined MIDI -> final_combined_wav/<song>_final.wav (<song>_preview.wav with the preview synth)"""
     # Create folder for final WAVs if it doesn't exist
     final_wavs_dir = "./final_combined_wav"
     os.makedirs(final_wavs_dir, exist_ok=True)
-
-    # path for MIDI combined and final WAV
-    midi_path = f"final_combined_midi/{song_name}_combined.mid"
+    if preview:
+        return midi_to_preview_wav(midi_path, os.path.join(final_wavs_dir, f"{song_name}_preview.wav"))
     final_wav_output_path = os.path.join(final_wavs_dir, f"{song_name}_final.wav")
     
     # Convert MIDI to WAV
@@ -648,8 +1384,147 @@ if __name__ == "__main__":
         print(f"Conversion successful. WAV saved in: {final_wav}")
     else:
         print("Error in the conversion MIDI to WAV")
- 
-    
-    
+    return final_wav
+
+def build_pipeline_graph(mp3_path, streaming=False, window_seconds=30.0, cache=None, workers=1, in_memory=False,
+                         batch_size=None, tempo_window=TEMPO_WINDOW_SECONDS, preview=False):
+    """Stage graph of run_pipeline for one song
+
+    tempo || separate -> transcribe -> (xml || merge -> render): the tempo is only
+    needed by the XML export and the library entries written by the merge, so
+    beat tracking overlaps with Demucs, and the XML export overlaps with merging
+    and rendering.
+    """
+    song_name = os.path.splitext(os.path.basename(mp3_path))[0]  # "trial_ensemble"
+    graph = pipeline_graph.StageGraph()
+    graph.add("tempo", lambda: song_tempo(mp3_path, tempo_window), pool="cpu")
+    if in_memory:
+        # stems go from Demucs to basic_pitch/drums as arrays, the wavs are written in the background
+        graph.add("separate", lambda: separate_and_transcribe(mp3_path, None), pool="cpu")
+        graph.add("transcribe", lambda separate: separate, deps=("separate",), pool="io")
+    else:
+        graph.add("separate", lambda: separate_with_cache(mp3_path, streaming, window_seconds, cache), pool="cpu")
+        graph.add("transcribe", lambda separate: convert_mp3_to_musicxml(
+            mp3_path, None, output_dir=None, workers=workers, batch_size=batch_size),
+            deps=("separate",), pool="cpu")
+    graph.add("xml", lambda tempo, transcribe: export_musicxml(song_name, tempo),
+              deps=("tempo", "transcribe"), pool="io")
+    graph.add("merge", lambda tempo, transcribe: merge_song_midis(song_name, tempo), deps=("tempo", "transcribe"),
+              pool="io")
+    graph.add("render", lambda merge: render_song(song_name, merge, preview) if merge else None, deps=("merge",), pool="io")
+    return graph
+
+def run_pipeline(mp3_path, streaming=False, window_seconds=30.0, cache=None, workers=1, in_memory=False,
+                 batch_size=None, pools=None, on_event=None, executors=None, tempo_window=TEMPO_WINDOW_SECONDS,
+                 preview=False, profile=None):
+    """Full remix pipeline for one song: tempo, separation, MIDI/XML, combined MIDI and WAV
+
+    The stages run through pipeline_graph.StageGraph, independent ones at the
+    same time; pools: {'cpu': n, 'io': n} stages of each kind allowed at once.
+    on_event / executors are passed to StageGraph.run (progress callbacks, pools
+    shared between songs). preview: render the WAV with the NumPy preview synth
+    instead of FluidSynth. profile: write per-stage metrics to profiles/<song>_profile.json/.csv
+    (see stage_profiler; default: the REMIXAI_PROFILE environment variable).
+    """
+    song_name = os.path.splitext(os.path.basename(mp3_path))[0]  # "trial_ensemble"
+
+    # The next task: modify instruments within the whole song. This step is unfinished
+    #input_modified_midi_path = f"midi_files/{song_name}_piano.mid"
+    #output_modified_midi_path = f"modified_midis/{song_name}_modified.mid"
+    #original_instrument_program, new_instrument_program = choose_instrument()
+    #changing_piano_to_guitar(input_modified_midi_path, output_modified_midi_path)
+    os.makedirs("modified_midis", exist_ok=True)
+
+    graph = build_pipeline_graph(mp3_path, streaming, window_seconds, cache, workers, in_memory, batch_size,
+                                 tempo_window, preview)
+    if profile is None:
+        profile = stage_profiler.env_enabled()
+    if profile:
+        # the song length from the file header, for the real-time factors
+        with stage_profiler.profile_song(song_name, librosa.get_duration(path=mp3_path)):
+            results, report = graph.run(pools, on_event, executors)
+    else:
+        results, report = graph.run(pools, on_event, executors)
+    print(f"Pipeline for {song_name} finished in {report['_total']['seconds']:.1f}s")
+    return results.get("render")
+
 
-    
\ No newline at end of file
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Separate songs into instruments and transcribe them to MIDI/XML")
+    parser.add_argument("songs", nargs="*", default=["trial_ensemble.mp3"],
+                        help="audio files or directories of audio files (default: trial_ensemble.mp3)")
+    parser.add_argument("--batch", action="store_true",
+                        help="only separate the songs into separated_wavs/, loading Demucs once")
+    parser.add_argument("--stream", action="store_true",
+                        help="separate in overlapping windows with bounded memory (long recordings)")
+    parser.add_argument("--window", type=float, default=30.0, help="window length in seconds for --stream")
+    parser.add_argument("--no-cache", action="store_true", help="always run Demucs, ignoring the separation cache")
+    parser.add_argument("--cache-dir", default=None,
+                        help="separation cache directory, can be shared by several workers "
+                             "(default: $REMIXAI_CACHE_DIR or ~/.cache/remixai/separation)")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="hand the separated stems to transcription as arrays instead of re-reading the wavs")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes used to transcribe the stems of a song (0 = one per CPU)")
+    parser.add_argument("--transcribe-batch", type=int, default=None, metavar="WINDOWS",
+                        help="transcribe all stems with packed basic_pitch batches of this many windows; "
+                             "with --batch, the stems of all the songs are transcribed together")
+    parser.add_argument("--separate-batch", type=int, default=None, metavar="SEGMENTS",
+                        help="with --batch, pack Demucs segments of several songs into forward passes of this many "
+                             "segments (for queues of short clips)")
+    parser.add_argument("--cpu-stages", type=int, default=pipeline_graph.DEFAULT_POOLS['cpu'],
+                        help="pipeline stages allowed to run at once in the CPU pool (separation, transcription, tempo)")
+    parser.add_argument("--io-stages", type=int, default=pipeline_graph.DEFAULT_POOLS['io'],
+                        help="pipeline stages allowed to run at once in the I/O pool (XML export, merging, rendering)")
+    parser.add_argument("--tempo-window", type=float, default=TEMPO_WINDOW_SECONDS,
+                        help="seconds in the middle of the song analysed for the tempo (0 = whole song)")
+    parser.add_argument("--preview", action="store_true",
+                        help="render the final WAV with the built-in preview synth instead of FluidSynth")
+    parser.add_argument("--profile", action="store_true",
+                        help="write wall/CPU time, peak RSS and real-time factor of every stage to profiles/")
+    parser.add_argument("--cprofile", action="store_true",
+                        help="profile, and also dump a cProfile .prof file per stage")
+    parser.add_argument("--backend", choices=separation_backends.BACKENDS, default=None,
+                        help="CPU inference backend for Demucs (default: $REMIXAI_SEPARATION_BACKEND or fp32); "
+                             "check it first with separation_backends.py")
+    parser.add_argument("--segment", type=float, default=None,
+                        help="seconds of audio per Demucs forward pass (default: the model's)")
+    parser.add_argument("--overlap", type=float, default=None, help="overlap between Demucs segments (default 0.25)")
+    parser.add_argument("--shifts", type=int, default=None, help="random shifts averaged by Demucs (default 1)")
+    parser.add_argument("--no-split", action="store_true", help="run Demucs on the whole song at once")
+    parser.add_argument("--stem-format", choices=list(stem_writer.FORMATS), default=None,
+                        help="format of the separated stems (default: $REMIXAI_STEM_FORMAT or float32 WAV)")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--interop-threads", type=int, default=None, help="torch inter-op threads")
+    args = parser.parse_args()
+
+    if args.cprofile:
+        os.environ["REMIXAI_CPROFILE"] = "1"
+    configure_separation(args.backend, args.segment, args.overlap, args.shifts, False if args.no_split else None,
+                         args.stem_format)
+
+    if args.no_cache:
+        cache = False
+    elif args.cache_dir:
+        cache = separation_cache.SeparationCache(args.cache_dir)
+    else:
+        cache = None
+
+    if args.batch:
+        separated = separate_batch(args.songs, args.threads, args.interop_threads, args.stream, args.window, cache,
+                                   args.separate_batch)
+        if args.transcribe_batch:
+            songs = [r['song'] for r in separated if r['stems']]
+            # the songs are separated already: their drum stem energy gives the tempo without decoding
+            tempos = [round(tempo_analysis.tempo_map_for_song(song, args.tempo_window or None).bpm) for song in songs]
+            transcribe_songs_batched([os.path.splitext(os.path.basename(song))[0] for song in songs],
+                                     tempos, args.transcribe_batch)
+    else:
+        configure_torch_threads(args.threads, args.interop_threads)
+        for mp3_path in find_songs(args.songs):
+            run_pipeline(mp3_path, args.stream, args.window, cache, args.workers or None, args.in_memory,
+                         args.transcribe_batch, {'cpu': args.cpu_stages, 'io': args.io_stages},
+                         tempo_window=args.tempo_window or None, preview=args.preview,
+                         profile=(args.profile or args.cprofile) or None)
@@ -0,0 +1,326 @@
+"""Local remix job server: warm models, a bounded job queue and per-stage progress.
+
+Every `python remixAi.py` pays for importing torch, basic_pitch and music21
+and for loading the models. This server does that once and then runs the
+pipeline for every song submitted to it. A small HTTP API is served on
+localhost or on a Unix socket:
+
+    POST /jobs               {"path": "/music/song.mp3", "in_memory": false, ...}  -> 202 {"id": ...}
+                             503 when the queue is full (retry later), 409 when a queued or running
+                             job has a song with the same file name (their outputs would collide)
+    GET  /jobs               every job and its status
+    GET  /jobs/<id>          status, per-stage progress and results of one job
+    GET  /jobs/<id>/events   progress as it happens, one JSON object per line, until the job ends
+    GET  /health             queue length, running jobs, warm models
+
+    python remix_server.py --socket /tmp/remixai.sock --jobs 2 --queue 16
+    curl --unix-socket /tmp/remixai.sock -d '{"path": "song.mp3"}' http://localhost/jobs
+
+Up to --jobs songs run at the same time. Their stages share one CPU pool and
+one I/O pool (see pipeline_graph), so the render of one song overlaps with
+the separation of the next without oversubscribing the machine. The outputs
+go to the usual separated_wavs/, midi_files/, ... folders named after the
+song, so two songs with the same file name can't be in flight at once.
+Only the last --keep finished jobs (and their events) are kept.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pipeline_graph
+
+def _workers(value):
+    """0 means one worker per CPU, like --workers 0 on the command line"""
+    return int(value) or None
+
+
+# options a job can set, with the type they're converted to (passed to remixAi.run_pipeline)
+JOB_OPTIONS = {'streaming': bool, 'window_seconds': float, 'in_memory': bool, 'workers': _workers, 'batch_size': int,
+               'preview': bool}
+HTTP_STATUS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               409: 'Conflict', 503: 'Service Unavailable'}
+# finished jobs kept for GET /jobs, oldest dropped first
+DEFAULT_KEEP_FINISHED = 100
+
+
+class SongInFlight(Exception):
+    """A queued or running job already has a song with this file name"""
+
+    def __init__(self, job):
+        super().__init__(f"job {job.id} is already processing {os.path.basename(job.path)}")
+        self.job = job
+
+
+class Job:
+
+    def __init__(self, path, options):
+        self.id = uuid.uuid4().hex[:12]
+        self.path = path
+        self.song = os.path.splitext(os.path.basename(path))[0]
+        self.options = options
+        self.status = 'queued'  # queued -> running -> done / failed
+        self.stages = {}
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.events = []  # every progress event, so late subscribers can replay them
+        self._changed = asyncio.Event()
+
+    def to_dict(self):
+        return {
+            'id': self.id, 'path': self.path, 'options': self.options, 'status': self.status,
+            'stages': self.stages, 'result': self.result, 'error': self.error,
+            'submitted': self.submitted, 'started': self.started, 'finished': self.finished,
+        }
+
+    def emit(self, event):
+        event = dict(event, job=self.id, time=time.time())
+        self.events.append(event)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self):
+        """Yield every event of the job (past and future) until it ends"""
+        sent = 0
+        while True:
+            changed = self._changed
+            while sent < len(self.events):
+                yield self.events[sent]
+                sent += 1
+            if self.status in ('done', 'failed'):
+                return
+            await changed.wait()
+
+
+class RemixServer:
+
+    def __init__(self, concurrent_jobs=1, queue_size=8, pools=None, cache=None, keep_finished=DEFAULT_KEEP_FINISHED):
+        self.concurrent_jobs = concurrent_jobs
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.jobs = {}
+        self.keep_finished = keep_finished
+        self.finished = deque()  # ids of the finished jobs still in self.jobs, oldest first
+        self.in_flight = {}  # song name -> queued or running job
+        self.cache = cache
+        pools = dict(pipeline_graph.DEFAULT_POOLS, **(pools or {}))
+        # stage pools shared by every job
+        self.executors = {pool: ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"stage-{pool}")
+                          for pool, size in pools.items()}
+        # one thread per running job to drive its stage graph
+        self.drivers = ThreadPoolExecutor(max_workers=concurrent_jobs, thread_name_prefix="job")
+        self.warm = []
+        self.remixAi = None
+
+    def warm_up(self):
+        """Import the pipeline and load the models once (blocking)"""
+        import remixAi
+        import transcription
+
+        self.remixAi = remixAi
+        start = time.perf_counter()
+        remixAi.load_separator()
+        self.warm.append(f"{remixAi.MODEL_NAME} ({remixAi.SEPARATION_BACKEND})")
+        transcription.get_engine()
+        self.warm.append('basic_pitch')
+        try:
+            import synth_renderer
+
+            synth_renderer.get_renderer().warm_up()
+            self.warm.append('fluidsynth')
+        except (ImportError, OSError, RuntimeError) as e:
+            print(f"FluidSynth not preloaded ({str(e)}), renders will use the fluidsynth command")
+        print(f"Models loaded in {time.perf_counter() - start:.1f}s")
+
+    def submit(self, path, options):
+        """Queue a job; raises asyncio.QueueFull when the queue is full, SongInFlight on a song name clash"""
+        job = Job(path, options)
+        if job.song in self.in_flight:
+            raise SongInFlight(self.in_flight[job.song])
+        self.queue.put_nowait(job)
+        self.jobs[job.id] = job
+        self.in_flight[job.song] = job
+        job.emit({'stage': None, 'status': 'queued'})
+        return job
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            job.status = 'running'
+            job.started = time.time()
+            job.emit({'stage': None, 'status': 'running'})
+
+            def on_event(stage, status, report, job=job):
+                # called from the pipeline threads: hand the event over to the loop
+                loop.call_soon_threadsafe(self._stage_event, job, stage, status, report)
+
+            try:
+                job.result = await loop.run_in_executor(self.drivers, self._run, job, on_event)
+                job.status = 'done'
+            except Exception as e:
+                job.status = 'failed'
+                job.error = f"{type(e).__name__}: {str(e)}"
+            job.finished = time.time()
+            job.emit({'stage': None, 'status': job.status, 'error': job.error})
+            self._retire(job)
+            self.queue.task_done()
+
+    def _retire(self, job):
+        del self.in_flight[job.song]
+        self.finished.append(job.id)
+        while len(self.finished) > self.keep_finished:
+            # subscribers still following it keep their reference, new requests get a 404
+            self.jobs.pop(self.finished.popleft(), None)
+
+    def _run(self, job, on_event):
+        failed = []
+
+        def record(stage, status, report):
+            if status == 'error':
+                failed.append(stage)
+            on_event(stage, status, report)
+
+        final_wav = self.remixAi.run_pipeline(job.path, cache=self.cache, on_event=record,
+                                              executors=self.executors, **job.options)
+        if failed:
+            raise RuntimeError(f"stages failed: {', '.join(failed)}")
+        return {'song': job.song, 'wav': final_wav}
+
+    def _stage_event(self, job, stage, status, report):
+        job.stages[stage] = {'status': status, 'seconds': report.get('seconds'), 'error': report.get('error')}
+        job.emit({'stage': stage, 'status': status, 'seconds': report.get('seconds'), 'error': report.get('error')})
+
+    def health(self):
+        return {'queued': self.queue.qsize(), 'queue_size': self.queue.maxsize,
+                'running': sum(job.status == 'running' for job in self.jobs.values()),
+                'concurrent_jobs': self.concurrent_jobs, 'warm_models': self.warm}
+
+    # HTTP
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, body = await _read_request(reader)
+        except (ValueError, asyncio.IncompleteReadError):
+            await _respond(writer, 400, {'error': 'malformed request'})
+            writer.close()
+            return
+        try:
+            await self.route(method, path, body, writer)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body, writer):
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        if parts == ['health']:
+            return await _respond(writer, 200, self.health())
+        if parts == ['jobs'] and method == 'GET':
+            return await _respond(writer, 200, [job.to_dict() for job in self.jobs.values()])
+        if parts == ['jobs'] and method == 'POST':
+            return await self.create_job(body, writer)
+        if len(parts) >= 2 and parts[0] == 'jobs':
+            job = self.jobs.get(parts[1])
+            if job is None:
+                return await _respond(writer, 404, {'error': f"no job {parts[1]}"})
+            if len(parts) == 2:
+                return await _respond(writer, 200, job.to_dict())
+            if parts[2:] == ['events']:
+                return await self.stream_events(job, writer)
+        return await _respond(writer, 404, {'error': f"no route {method} {path}"})
+
+    async def create_job(self, body, writer):
+        try:
+            request = json.loads(body or b'{}')
+            path = request['path']
+            options = {name: kind(request[name]) for name, kind in JOB_OPTIONS.items() if name in request}
+        except (ValueError, KeyError, TypeError) as e:
+            return await _respond(writer, 400, {'error': f"bad job: {str(e)}"})
+        if not os.path.isfile(path):
+            return await _respond(writer, 400, {'error': f"no such file: {path}"})
+        try:
+            job = self.submit(os.path.abspath(path), options)
+        except asyncio.QueueFull:
+            # backpressure: the client retries later instead of piling up work
+            return await _respond(writer, 503, {'error': 'queue full', **self.health()}, {'Retry-After': '10'})
+        except SongInFlight as e:
+            return await _respond(writer, 409, {'error': str(e), 'job': e.job.id})
+        return await _respond(writer, 202, job.to_dict())
+
+    async def stream_events(self, job, writer):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n')
+        async for event in job.follow():
+            writer.write(json.dumps(event).encode() + b'\n')
+            await writer.drain()
+
+
+async def _read_request(reader):
+    request_line = (await reader.readline()).decode('latin-1').strip()
+    method, path, _ = request_line.split(' ', 2)
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), path, body
+
+
+async def _respond(writer, status, payload, headers=None):
+    body = json.dumps(payload, indent=2).encode()
+    head = [f"HTTP/1.1 {status} {HTTP_STATUS.get(status, '')}", 'Content-Type: application/json',
+            f"Content-Length: {len(body)}", 'Connection: close']
+    head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+    await writer.drain()
+
+
+async def serve(host='127.0.0.1', port=8765, socket_path=None, concurrent_jobs=1, queue_size=8, pools=None,
+                cache=None, keep_finished=DEFAULT_KEEP_FINISHED):
+    server = RemixServer(concurrent_jobs, queue_size, pools, cache, keep_finished)
+    await asyncio.get_running_loop().run_in_executor(None, server.warm_up)
+    workers = [asyncio.create_task(server.worker()) for _ in range(concurrent_jobs)]
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        listener = await asyncio.start_unix_server(server.handle, path=socket_path)
+        print(f"Remix server listening on {socket_path}")
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+        print(f"Remix server listening on http://{host}:{port}")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Long-running remix server with warm models")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", default=None, help="serve on this Unix socket instead of TCP")
+    parser.add_argument("--jobs", type=int, default=1, help="songs processed at the same time")
+    parser.add_argument("--queue", type=int, default=8, help="jobs waiting before new submissions get a 503")
+    parser.add_argument("--keep", type=int, default=DEFAULT_KEEP_FINISHED,
+                        help="finished jobs kept (with their events) for GET /jobs")
+    parser.add_argument("--cpu-stages", type=int, default=pipeline_graph.DEFAULT_POOLS['cpu'],
+                        help="stages allowed to run at once in the shared CPU pool")
+    parser.add_argument("--io-stages", type=int, default=pipeline_graph.DEFAULT_POOLS['io'],
+                        help="stages allowed to run at once in the shared I/O pool")
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.host, args.port, args.socket, args.jobs, args.queue,
+                      {'cpu': args.cpu_stages, 'io': args.io_stages}, keep_finished=args.keep))
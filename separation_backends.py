@@ -0,0 +1,353 @@
+"""CPU inference backends for the Demucs separator.
+
+By default separate_stems runs apply_model on the fp32 PyTorch model. On
+CPU-only machines it can use one of these instead (load_separator(backend=...),
+--backend, or the REMIXAI_SEPARATION_BACKEND environment variable):
+
+    fp32         the stock model (default)
+    int8         dynamic int8 quantization of the Linear layers (the cross transformer)
+    compile      torch.compile of the network (needs a C++ compiler, compiles while loading)
+    torchscript  traced and frozen with torch.jit
+    onnx         exported to ONNX and run with ONNX Runtime (needs onnx and onnxruntime)
+
+HTDemucs computes its STFT and iSTFT with complex tensors, which the tracer
+and ONNX can't handle. So only the network between them (the encoders, the
+cross transformer and the decoders) goes through the backend, and the STFT and
+the masking stay in PyTorch. prepare() returns a model that works as a drop-in
+for apply_model, so segment, overlap, shifts and split work as before.
+
+Every backend changes the stems a little. Before switching the fleet over,
+compare a backend with fp32 on a reference clip:
+
+    python separation_backends.py clip.wav --backend int8 torchscript --seconds 30
+    -> SDR of every stem against the fp32 stems, and the speed-up
+
+Exported ONNX models are kept in $REMIXAI_ONNX_DIR (default
+~/.cache/remixai/onnx), keyed by the weights, so the export only runs once.
+"""
+import copy
+import hashlib
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from demucs.apply import BagOfModels, apply_model
+from demucs.htdemucs import HTDemucs
+
+BACKENDS = ('fp32', 'int8', 'compile', 'torchscript', 'onnx')
+DEFAULT_BACKEND = os.environ.get("REMIXAI_SEPARATION_BACKEND", "fp32")
+DEFAULT_ONNX_DIR = os.environ.get(
+    "REMIXAI_ONNX_DIR", os.path.join(os.path.expanduser("~"), ".cache", "remixai", "onnx"))
+# stems further than this from fp32 fail the quality check
+MIN_SDR = 30.0
+ONNX_OPSET = 17
+
+
+class HTDemucsNetwork(torch.nn.Module):
+    """The part of HTDemucs.forward between the STFT and the masking, which is what the backends run
+
+    Takes the normalized spectrogram (cac channels) and the normalized waveform;
+    returns the spectrogram of every source and the time branch output, both
+    still normalized.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x, xt):
+        model = self.model
+        # same as HTDemucs.forward
+        saved = []  # skip connections, freq.
+        saved_t = []  # skip connections, time.
+        lengths = []  # saved lengths to properly remove padding, freq branch.
+        lengths_t = []  # saved lengths for time branch.
+        for idx, encode in enumerate(model.encoder):
+            lengths.append(x.shape[-1])
+            inject = None
+            if idx < len(model.tencoder):
+                # we have not yet merged branches.
+                lengths_t.append(xt.shape[-1])
+                tenc = model.tencoder[idx]
+                xt = tenc(xt)
+                if not tenc.empty:
+                    saved_t.append(xt)
+                else:
+                    # now time and freq. branches have the same shape and can be merged.
+                    inject = xt
+            x = encode(x, inject)
+            if idx == 0 and model.freq_emb is not None:
+                frs = torch.arange(x.shape[-2], device=x.device)
+                emb = model.freq_emb(frs).t()[None, :, :, None].expand_as(x)
+                x = x + model.freq_emb_scale * emb
+            saved.append(x)
+
+        if model.crosstransformer:
+            if model.bottom_channels:
+                b, c, f, t = x.shape
+                x = x.reshape(b, c, f * t)
+                x = model.channel_upsampler(x)
+                x = x.reshape(b, -1, f, t)
+                xt = model.channel_upsampler_t(xt)
+            x, xt = model.crosstransformer(x, xt)
+            if model.bottom_channels:
+                b, c, f, t = x.shape
+                x = x.reshape(b, c, f * t)
+                x = model.channel_downsampler(x)
+                x = x.reshape(b, -1, f, t)
+                xt = model.channel_downsampler_t(xt)
+
+        for idx, decode in enumerate(model.decoder):
+            skip = saved.pop(-1)
+            x, pre = decode(x, skip, lengths.pop(-1))
+            offset = model.depth - len(model.tdecoder)
+            if idx >= offset:
+                tdec = model.tdecoder[idx - offset]
+                length_t = lengths_t.pop(-1)
+                if tdec.empty:
+                    pre = pre[:, :, 0]
+                    xt, _ = tdec(pre, None, length_t)
+                else:
+                    skip = saved_t.pop(-1)
+                    xt, _ = tdec(xt, skip, length_t)
+        return x, xt
+
+
+class BackendHTDemucs(HTDemucs):
+    """HTDemucs whose network runs on a backend; apply_model uses it like the model itself
+
+    It is an HTDemucs only so that apply_model pads the segments exactly as it
+    does for the stock model (HTDemucs.__init__ isn't run, the layers stay in
+    self.model). Every segment is padded to the training length the network
+    was prepared for, so segment can only be made shorter, not longer.
+    """
+
+    def __init__(self, model, network, backend):
+        torch.nn.Module.__init__(self)
+        # STFT settings, plus the parameters apply_model moves to the device
+        self.model = model
+        self.network = network
+        self.backend = backend
+        self.sources = model.sources
+        self.samplerate = model.samplerate
+        self.audio_channels = model.audio_channels
+        self.training_length = int(model.segment * model.samplerate)
+
+    @property
+    def segment(self):
+        return self.model.segment
+
+    @segment.setter
+    def segment(self, value):
+        self.model.segment = value
+
+    def valid_length(self, length):
+        if length > self.training_length:
+            raise ValueError(f"Given length {length} is longer than training length {self.training_length}")
+        return self.training_length
+
+    def forward(self, mix):
+        model = self.model
+        length = mix.shape[-1]
+        if length < self.training_length:
+            mix = F.pad(mix, (0, self.training_length - length))
+        z = model._spec(mix)
+        x = model._magnitude(z)
+        B, C, Fq, T = x.shape
+        mean = x.mean(dim=(1, 2, 3), keepdim=True)
+        std = x.std(dim=(1, 2, 3), keepdim=True)
+        x = (x - mean) / (1e-5 + std)
+        meant = mix.mean(dim=(1, 2), keepdim=True)
+        stdt = mix.std(dim=(1, 2), keepdim=True)
+        xt = (mix - meant) / (1e-5 + stdt)
+
+        x, xt = self.network(x, xt)
+
+        S = len(self.sources)
+        x = x.view(B, S, -1, Fq, T) * std[:, None] + mean[:, None]
+        x = model._ispec(model._mask(z, x), self.training_length)
+        xt = xt.view(B, S, -1, self.training_length) * stdt[:, None] + meant[:, None]
+        return (xt + x)[..., :length]
+
+
+class OnnxNetwork:
+    """HTDemucsNetwork exported to ONNX, run by an ONNX Runtime session"""
+
+    def __init__(self, path, threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, x, xt):
+        x, xt = self.session.run(['x_out', 'xt_out'], {'x': x.cpu().numpy(), 'xt': xt.cpu().numpy()})
+        return torch.from_numpy(x), torch.from_numpy(xt)
+
+
+def example_inputs(model, batch=1):
+    """(x, xt) for one segment of the training length, as HTDemucsNetwork receives them"""
+    training_length = int(model.segment * model.samplerate)
+    mix = torch.randn(batch, model.audio_channels, training_length)
+    x = model._magnitude(model._spec(mix))
+    return torch.randn_like(x), mix
+
+
+def weights_hash(model):
+    h = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def export_onnx(model, export_dir=DEFAULT_ONNX_DIR):
+    """Path of the ONNX export of model's network, exported on the first call"""
+    training_length = int(model.segment * model.samplerate)
+    key = hashlib.sha256(f"{weights_hash(model)}:{training_length}:{ONNX_OPSET}:{torch.__version__}".encode())
+    path = os.path.join(export_dir, f"htdemucs_{key.hexdigest()[:16]}.onnx")
+    if os.path.exists(path):
+        return path
+    os.makedirs(export_dir, exist_ok=True)
+    print(f"Exporting the separator to {path}...")
+    network = HTDemucsNetwork(model).eval()
+    batch = {0: 'batch'}
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    # not under no_grad: that makes MultiheadAttention take its fused path, which has no ONNX op
+    torch.onnx.export(network, example_inputs(model), tmp_path, input_names=['x', 'xt'],
+                      output_names=['x_out', 'xt_out'], opset_version=ONNX_OPSET, dynamo=False,
+                      dynamic_axes={'x': batch, 'xt': batch, 'x_out': batch, 'xt_out': batch})
+    os.replace(tmp_path, path)
+    return path
+
+
+def prepare(model, backend="fp32"):
+    """model (HTDemucs or a bag of them) with its network running on backend; fp32 returns model as is
+
+    The model itself is left untouched, so the fp32 version can still be used next to it.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown separation backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    if backend == 'fp32':
+        return model
+    if isinstance(model, BagOfModels):
+        return BagOfModels([prepare(sub_model, backend) for sub_model in model.models], model.weights)
+    if not isinstance(model, HTDemucs):
+        raise ValueError(f"The {backend} backend only supports HTDemucs models, not {type(model).__name__}")
+
+    model = model.cpu().eval()
+    if backend == 'int8':
+        # only Linear layers have dynamic int8 kernels, the convolutions stay fp32
+        network = torch.ao.quantization.quantize_dynamic(
+            HTDemucsNetwork(copy.deepcopy(model)).eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend == 'compile':
+        network = torch.compile(HTDemucsNetwork(model).eval())
+        with torch.no_grad():
+            network(*example_inputs(model))  # compile now rather than on the first song
+    elif backend == 'torchscript':
+        with torch.no_grad():
+            traced = torch.jit.trace(HTDemucsNetwork(model).eval(), example_inputs(model), check_trace=False)
+        network = torch.jit.freeze(traced)
+    else:
+        network = OnnxNetwork(export_onnx(model))
+    print(f"Separator network on the {backend} backend")
+    return BackendHTDemucs(model, network, backend)
+
+
+def sdr(reference, estimate):
+    """Signal-to-distortion ratio of estimate against reference in dB (the plain energy ratio)"""
+    reference = np.asarray(reference, dtype=np.float64)
+    error = reference - np.asarray(estimate, dtype=np.float64)
+    return float(10 * np.log10((np.sum(reference ** 2) + 1e-8) / (np.sum(error ** 2) + 1e-8)))
+
+
+def _separate(model, audio, params):
+    # same random shifts for every backend
+    random.seed(0)
+    start = time.perf_counter()
+    with torch.no_grad():
+        sources = apply_model(model, torch.from_numpy(audio)[None], progress=False, **params)
+    return sources[0].numpy(), time.perf_counter() - start
+
+
+def quality_check(model, backends, audio, params=None, min_sdr=MIN_SDR):
+    """Separate audio ([channels, samples] float32) with fp32 and with every backend, compare the stems
+
+    Returns one dict per backend with the SDR of every stem against the fp32
+    stems, the seconds each took and whether every stem reached min_sdr.
+    """
+    params = dict(params or {})
+    reference, fp32_seconds = _separate(model, audio, params)
+    results = []
+    for backend in backends:
+        start = time.perf_counter()
+        prepared = prepare(model, backend)
+        load_seconds = time.perf_counter() - start
+        estimate, seconds = _separate(prepared, audio, params)
+        sdrs = {name: round(sdr(reference[i], estimate[i]), 2) for i, name in enumerate(model.sources)}
+        results.append({
+            'backend': backend,
+            'sdr': sdrs,
+            'min_sdr': min(sdrs.values()),
+            'passed': min(sdrs.values()) >= min_sdr,
+            'load_seconds': round(load_seconds, 2),
+            'seconds': round(seconds, 2),
+            'fp32_seconds': round(fp32_seconds, 2),
+            'speedup': round(fp32_seconds / seconds, 2),
+        })
+    return results
+
+
+def print_results(results, audio_seconds):
+    for result in results:
+        status = "ok" if result['passed'] else "FAILED"
+        print(f"\n{result['backend']}: {result['seconds']:.1f}s vs fp32 {result['fp32_seconds']:.1f}s "
+              f"for {audio_seconds:.1f}s of audio (x{result['speedup']:.2f}, "
+              f"loaded in {result['load_seconds']:.1f}s), lowest SDR {result['min_sdr']:.1f} dB {status}")
+        for name, value in result['sdr'].items():
+            print(f"    {name:<8} {value:>7.2f} dB")
+
+
+def main():
+    import argparse
+    import json
+
+    import librosa
+
+    parser = argparse.ArgumentParser(description="Compare separation backends with fp32 on a reference clip")
+    parser.add_argument("clip", help="reference audio file")
+    parser.add_argument("--backend", nargs="+", default=[b for b in BACKENDS if b != 'fp32'],
+                        choices=[b for b in BACKENDS if b != 'fp32'])
+    parser.add_argument("--model", default="htdemucs_6s")
+    parser.add_argument("--offset", type=float, default=0.0, help="start of the clip in seconds")
+    parser.add_argument("--seconds", type=float, default=30.0, help="length of the clip in seconds")
+    parser.add_argument("--segment", type=float, default=None, help="apply_model segment (default: the model's)")
+    parser.add_argument("--overlap", type=float, default=0.25)
+    parser.add_argument("--shifts", type=int, default=1)
+    parser.add_argument("--no-split", action="store_true")
+    parser.add_argument("--min-sdr", type=float, default=MIN_SDR, help="lowest acceptable SDR in dB")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    from demucs.pretrained import get_model
+
+    model = get_model(args.model).cpu().eval()
+    audio, _ = librosa.load(args.clip, sr=model.samplerate, mono=False, offset=args.offset, duration=args.seconds)
+    if audio.ndim == 1:
+        audio = np.stack([audio] * model.audio_channels)
+    params = {'shifts': args.shifts, 'split': not args.no_split, 'overlap': args.overlap, 'segment': args.segment}
+    results = quality_check(model, args.backend, audio.astype(np.float32), params, args.min_sdr)
+    print_results(results, audio.shape[-1] / model.samplerate)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'clip': args.clip, 'model': args.model, 'params': params, 'results': results}, f, indent=2)
+    raise SystemExit(0 if all(result['passed'] for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
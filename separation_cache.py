@@ -0,0 +1,176 @@
+"""Content-addressed cache for Demucs separation results.
+
+Entries are keyed by a hash of the input audio plus the model name, sample
+rate and apply_model parameters, so a re-run with the same song and the same
+separation settings skips Demucs entirely. Layout of the cache directory:
+
+    <cache_dir>/<key>/manifest.json     what was separated and how
+    <cache_dir>/<key>/<stem>.wav        one file per stem (.flac when separated with --stem-format flac)
+    <cache_dir>/locks/<key>.lock        per-key lock so workers don't separate the same song twice
+    <cache_dir>/tmp/                    entries being written, published with an atomic rename
+
+Several worker processes can share one cache directory: entries only become
+visible once complete, and eviction skips entries another worker is using.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+import audio_store
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "REMIXAI_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "remixai", "separation"))
+DEFAULT_MAX_BYTES = int(float(os.environ.get("REMIXAI_SEPARATION_CACHE_GB", "20")) * 1024 ** 3)
+
+def cache_key(audio_path, model_name, samplerate, params):
+    """Key of one separation: input audio hash + everything that changes the stems"""
+    settings = json.dumps({'model': model_name, 'samplerate': samplerate, 'params': params}, sort_keys=True)
+    h = hashlib.sha256()
+    h.update(audio_store.hash_file(audio_path).encode())
+    h.update(settings.encode())
+    return h.hexdigest()
+
+
+class SeparationCache:
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, "locks"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "tmp"), exist_ok=True)
+
+    @contextmanager
+    def lock(self, key, blocking=True):
+        """Exclusive per-key lock shared across processes (yields False if not acquired)"""
+        path = os.path.join(self.cache_dir, "locks", f"{key}.lock")
+        with open(path, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def manifest(self, key):
+        path = os.path.join(self.cache_dir, key, "manifest.json")
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def fetch(self, key, song_name, output_dir="separated_wavs"):
+        """Copy the cached stems to output_dir/<song>_<stem>.<ext>; returns the paths or None on a miss"""
+        manifest = self.manifest(key)
+        if manifest is None:
+            return None
+        entry_dir = os.path.join(self.cache_dir, key)
+        os.makedirs(output_dir, exist_ok=True)
+        output_paths = []
+        try:
+            # entries written before the stem formats only have .wav files
+            files = manifest.get('files', {})
+            for stem in manifest['stems']:
+                name = files.get(stem, f"{stem}.wav")
+                output_path = os.path.join(output_dir, f"{song_name}_{stem}{os.path.splitext(name)[1]}")
+                # copy, never hardlink: separate_instruments overwrites these files in place later on
+                shutil.copyfile(os.path.join(entry_dir, name), output_path)
+                # the same stem in the other format, from an earlier run, would be transcribed twice
+                for extension in ('.wav', '.flac'):
+                    stale = os.path.join(output_dir, f"{song_name}_{stem}{extension}")
+                    if stale != output_path and os.path.exists(stale):
+                        os.remove(stale)
+                output_paths.append(output_path)
+            for name in manifest.get('extras', []):
+                shutil.copyfile(os.path.join(entry_dir, name), os.path.join(output_dir, f"{song_name}_{name}"))
+        except OSError as e:
+            print(f"Separation cache entry {key} is broken, ignoring it: {str(e)}")
+            return None
+        # the manifest mtime is the entry's last use, used for LRU eviction
+        os.utime(os.path.join(entry_dir, "manifest.json"))
+        return output_paths
+
+    def store(self, key, stem_paths, stems, info=None, extras=None):
+        """Publish freshly separated stems under key (atomic, first writer wins)
+
+        extras: {name: path} of side files (e.g. the stem energy manifest), restored
+        by fetch as output_dir/<song>_<name>. Missing ones are skipped.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry_dir):
+            return
+        tmp_dir = os.path.join(self.cache_dir, "tmp", f"{key}-{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        try:
+            size = 0
+            files = {}
+            for stem, path in zip(stems, stem_paths):
+                files[stem] = f"{stem}{os.path.splitext(path)[1]}"
+                target = os.path.join(tmp_dir, files[stem])
+                shutil.copyfile(path, target)
+                size += os.path.getsize(target)
+            stored_extras = []
+            for name, path in (extras or {}).items():
+                if os.path.exists(path):
+                    shutil.copyfile(path, os.path.join(tmp_dir, name))
+                    size += os.path.getsize(path)
+                    stored_extras.append(name)
+            manifest = dict(info or {})
+            manifest.update({'key': key, 'stems': list(stems), 'files': files, 'extras': stored_extras, 'bytes': size,
+                             'created': time.time()})
+            with open(os.path.join(tmp_dir, "manifest.json"), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another worker published the same key first, or the disk is full: keep going uncached
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def entries(self):
+        """(last_used, bytes, key) of every complete entry"""
+        found = []
+        for key in os.listdir(self.cache_dir):
+            manifest_path = os.path.join(self.cache_dir, key, "manifest.json")
+            try:
+                last_used = os.path.getmtime(manifest_path)
+            except OSError:
+                continue
+            manifest = self.manifest(key) or {}
+            found.append((last_used, manifest.get('bytes', 0), key))
+        return found
+
+    def evict(self):
+        """Drop least-recently-used entries until the cache fits in max_bytes"""
+        with self.lock("evict"):
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in entries:
+                if total <= self.max_bytes:
+                    break
+                with self.lock(key, blocking=False) as acquired:
+                    if not acquired:
+                        continue  # a worker is reading or writing this entry right now
+                    self.remove(key)
+                    total -= size
+
+    def remove(self, key):
+        # rename first so readers never see a half-deleted entry
+        trash = os.path.join(self.cache_dir, "tmp", f"{key}-deleted-{uuid.uuid4().hex}")
+        try:
+            os.rename(os.path.join(self.cache_dir, key), trash)
+        except OSError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self.remove(key)
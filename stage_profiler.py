@@ -0,0 +1,287 @@
+"""Per-stage metrics of a pipeline run: wall time, CPU time, peak RSS and real-time factor.
+
+The pipeline marks its stages with `stage(name)`; while a song is being
+profiled every marked stage is recorded, otherwise the marks cost nothing:
+
+    with profile_song("song", audio_seconds=212.0):
+        run the pipeline ...
+            with stage("transcribe:bass", audio_seconds=212.0):
+                ...
+    -> profiles/song_profile.json and profiles/song_profile.csv
+
+Per stage: wall seconds, CPU seconds of the whole process (includes the
+torch/basic_pitch worker threads and the other stages running at the same
+time), CPU seconds of the stage's own thread, peak RSS while it ran (sampled)
+and the real-time factor (wall seconds / seconds of audio).
+
+With cprofile=True (or REMIXAI_CPROFILE=1) the outermost stage of every thread
+also runs under cProfile and is dumped to profiles/<song>_<stage>.prof
+(`python -m pstats` / snakeviz). For py-spy, the thread running a stage is
+renamed "<thread>:<stage>" while it runs, so the samples show the stage.
+
+Stages run in worker processes are recorded there with collect() and handed
+back to the song being profiled with merge() (their CPU and RSS are the
+worker's own):
+
+    worker:  with collect(profile_started) as stages: ...   -> return stages
+    parent:  merge(stages)   (profile_started = started() in the parent)
+
+REMIXAI_PROFILE=1 turns profiling on for run_pipeline without the --profile flag.
+"""
+import csv
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_PROFILE_DIR = os.environ.get("REMIXAI_PROFILE_DIR", "profiles")
+# RSS sampling period while a stage runs
+SAMPLE_SECONDS = 0.05
+FIELDS = ['stage', 'start', 'wall_seconds', 'cpu_seconds', 'thread_cpu_seconds', 'peak_rss_mb', 'audio_seconds',
+          'rtf', 'thread']
+
+_active = None
+_active_lock = threading.Lock()
+_local = threading.local()
+
+
+def env_enabled(name="REMIXAI_PROFILE"):
+    return os.environ.get(name, "").lower() in ("1", "true", "yes")
+
+
+def current_rss():
+    """Resident set size of the process in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # no /proc (macOS): peak of the whole process so far instead
+        import resource
+        import sys
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageRecord:
+
+    def __init__(self, name, audio_seconds, started):
+        self.name = name
+        self.audio_seconds = audio_seconds
+        self.thread = threading.current_thread().name
+        self.start = time.perf_counter() - started
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.thread_cpu = time.thread_time()
+        self.peak_rss = current_rss()
+
+    def finish(self):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+        self.thread_cpu = time.thread_time() - self.thread_cpu
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+    def to_dict(self):
+        return {
+            'stage': self.name,
+            'start': round(self.start, 4),
+            'wall_seconds': round(self.wall, 4),
+            'cpu_seconds': round(self.cpu, 4),
+            'thread_cpu_seconds': round(self.thread_cpu, 4),
+            'peak_rss_mb': round(self.peak_rss / 1024 ** 2, 1),
+            'audio_seconds': self.audio_seconds,
+            'rtf': round(self.wall / self.audio_seconds, 4) if self.audio_seconds else None,
+            'thread': self.thread,
+        }
+
+
+class CollectedRecord:
+    """A stage recorded in another process by collect(), kept as its dict"""
+
+    def __init__(self, row):
+        self.row = row
+        self.start = row['start']
+        self.peak_rss = row['peak_rss_mb'] * 1024 ** 2
+
+    def to_dict(self):
+        return dict(self.row)
+
+
+class Profiler:
+
+    def __init__(self, song, audio_seconds=None, output_dir=DEFAULT_PROFILE_DIR, cprofile=False):
+        self.song = song
+        self.audio_seconds = audio_seconds
+        self.output_dir = output_dir
+        self.cprofile = cprofile
+        self.records = []
+        self.running = set()
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(SAMPLE_SECONDS):
+            rss = current_rss()
+            with self._lock:
+                for record in self.running:
+                    record.peak_rss = max(record.peak_rss, rss)
+
+    @contextmanager
+    def stage(self, name, audio_seconds=None):
+        record = StageRecord(name, audio_seconds if audio_seconds is not None else self.audio_seconds, self.started)
+        with self._lock:
+            self.running.add(record)
+        thread = threading.current_thread()
+        thread_name = thread.name
+        thread.name = f"{thread_name}:{name}"
+        depth = getattr(_local, 'depth', 0)
+        _local.depth = depth + 1
+        # cProfile only once per thread: the outermost stage covers the nested ones
+        profile = None
+        if self.cprofile and depth == 0:
+            import cProfile
+
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+                os.makedirs(self.output_dir, exist_ok=True)
+                profile.dump_stats(os.path.join(self.output_dir, f"{self.song}_{_safe(name)}.prof"))
+            _local.depth = depth
+            thread.name = thread_name
+            record.finish()
+            with self._lock:
+                self.running.discard(record)
+                self.records.append(record)
+
+    def report(self):
+        return {
+            'song': self.song,
+            'audio_seconds': self.audio_seconds,
+            'wall_seconds': round(time.perf_counter() - self.started, 4),
+            'peak_rss_mb': round(max([record.peak_rss for record in self.records] or [current_rss()]) / 1024 ** 2, 1),
+            'stages': [record.to_dict() for record in sorted(self.records, key=lambda record: record.start)],
+        }
+
+    def write(self):
+        """profiles/<song>_profile.json and .csv; returns the report"""
+        report = self.report()
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f"{self.song}_profile")
+        with open(base + ".json", 'w') as f:
+            json.dump(report, f, indent=2)
+        with open(base + ".csv", 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(report['stages'])
+        return report
+
+
+def _safe(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+
+
+@contextmanager
+def stage(name, audio_seconds=None):
+    """Record the enclosed block as a stage of the song being profiled (no-op if there isn't one)"""
+    profiler = _active
+    if profiler is None:
+        yield None
+        return
+    with profiler.stage(name, audio_seconds) as record:
+        yield record
+
+
+def started():
+    """perf_counter() at which the song being profiled started (None if there isn't one), for collect()"""
+    profiler = _active
+    return profiler.started if profiler is not None else None
+
+
+@contextmanager
+def collect(profile_started):
+    """Record the stages of the block in this process (e.g. a pool worker) for merge() in the parent
+
+    profile_started is the parent's started(): perf_counter is system-wide, so
+    the start offsets line up with the parent's own stages. Yields a list that
+    gets the stage dicts when the block ends; stays empty if profile_started is None.
+    """
+    global _active
+    rows = []
+    if profile_started is None:
+        yield rows
+        return
+    profiler = Profiler(None)
+    profiler.started = profile_started
+    with _active_lock:
+        previous, _active = _active, profiler
+    profiler._sampler.start()
+    try:
+        yield rows
+    finally:
+        profiler._stop.set()
+        with _active_lock:
+            _active = previous
+        process = multiprocessing.current_process().name
+        for record in sorted(profiler.records, key=lambda record: record.start):
+            row = record.to_dict()
+            row['thread'] = f"{process}:{row['thread']}"
+            rows.append(row)
+
+
+def merge(rows):
+    """Add the stage dicts of collect() to the song being profiled (no-op if there isn't one)"""
+    profiler = _active
+    if profiler is None or not rows:
+        return
+    with profiler._lock:
+        profiler.records.extend(CollectedRecord(row) for row in rows)
+
+
+@contextmanager
+def profile_song(song, audio_seconds=None, output_dir=DEFAULT_PROFILE_DIR, cprofile=None):
+    """Profile every stage run until the block ends, then write the report
+
+    Stages are collected process-wide, so one song is profiled at a time; if
+    another song is already being profiled this one isn't (yields None).
+    """
+    global _active
+    if cprofile is None:
+        cprofile = env_enabled("REMIXAI_CPROFILE")
+    profiler = Profiler(song, audio_seconds, output_dir, cprofile)
+    with _active_lock:
+        if _active is not None:
+            print(f"Already profiling {_active.song}, {song} is not profiled")
+            profiler = None
+        else:
+            _active = profiler
+    if profiler is None:
+        yield None
+        return
+    print(f"Profiling {song} (pid {os.getpid()}, e.g. py-spy record --pid {os.getpid()})")
+    profiler._sampler.start()
+    try:
+        yield profiler
+    finally:
+        profiler._stop.set()
+        with _active_lock:
+            _active = None
+        report = profiler.write()
+        print_report(report)
+
+
+def print_report(report):
+    print(f"\nProfile of {report['song']}: {report['wall_seconds']:.1f}s, peak RSS {report['peak_rss_mb']:.0f} MB")
+    print(f"{'stage':<28} {'wall':>8} {'cpu':>8} {'rss MB':>8} {'rtf':>7}")
+    for row in report['stages']:
+        rtf = f"{row['rtf']:.3f}" if row['rtf'] is not None else "-"
+        print(f"{row['stage']:<28} {row['wall_seconds']:>8.2f} {row['cpu_seconds']:>8.2f} "
+              f"{row['peak_rss_mb']:>8.0f} {rtf:>7}")
@@ -0,0 +1,183 @@
+"""Per-stem energy computed once, right after separation.
+
+The frame RMS of every stem is computed from the separated audio while it is
+still in memory and saved next to the wavs:
+
+    separated_wavs/<song>_energy.json   average RMS, active regions, sample count per stem
+    separated_wavs/<song>_energy.npz    the frame RMS curves themselves
+
+Transcription reads the json to skip silent stems without decoding them, and
+to only transcribe the regions of a stem where something is actually playing.
+"""
+import json
+import os
+
+import librosa
+import numpy as np
+
+FRAME_LENGTH = 2048  # librosa.feature.rms defaults
+HOP_LENGTH = 512
+# frames above this RMS count as playing
+ACTIVE_RMS_THRESHOLD = 0.005
+# if more than this fraction of the stem is active, transcribing it whole is cheaper than slicing it
+MAX_ACTIVE_FRACTION = 0.8
+
+
+class EnergyAccumulator:
+    """Frame RMS of a signal fed block by block
+
+    Gives the same frames as librosa.feature.rms(y=y) (centered, zero padded)
+    on the whole signal, so it can follow the streaming separation too.
+    """
+
+    def __init__(self, frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH):
+        self.frame_length = frame_length
+        self.hop_length = hop_length
+        self.samples = 0
+        self._buffer = np.zeros(frame_length // 2, dtype=np.float32)  # centering pad
+        self._frames = []
+        self._finished = None
+
+    def add(self, y):
+        """y: mono or [channels, samples]"""
+        y = np.asarray(y, dtype=np.float32)
+        if y.ndim > 1:
+            y = librosa.to_mono(y)
+        self.samples += y.shape[-1]
+        buffer = np.concatenate([self._buffer, y])
+        n_frames = 0
+        if len(buffer) >= self.frame_length:
+            n_frames = (len(buffer) - self.frame_length) // self.hop_length + 1
+            frames = librosa.util.frame(buffer[:(n_frames - 1) * self.hop_length + self.frame_length],
+                                        frame_length=self.frame_length, hop_length=self.hop_length)
+            self._frames.append(np.sqrt(np.mean(frames ** 2, axis=0)))
+        self._buffer = buffer[n_frames * self.hop_length:]
+
+    def finish(self):
+        """Frame RMS of everything added so far (the accumulator can't take more audio afterwards)"""
+        if self._finished is None:
+            self._add_end_padding()
+            self._finished = np.concatenate(self._frames) if self._frames else np.zeros(0, dtype=np.float32)
+        return self._finished
+
+    def _add_end_padding(self):
+        samples = self.samples
+        self.add(np.zeros(self.frame_length // 2, dtype=np.float32))
+        self.samples = samples
+
+
+def frame_energy(y):
+    """Frame RMS of a whole array"""
+    accumulator = EnergyAccumulator()
+    accumulator.add(y)
+    return accumulator.finish()
+
+
+def active_regions(rms, sr, hop_length=HOP_LENGTH, threshold=ACTIVE_RMS_THRESHOLD,
+                   min_gap=1.0, pad=0.25, min_length=0.1):
+    """[(start_s, end_s), ...] where the stem is playing
+
+    Gaps shorter than min_gap seconds are bridged, every region is padded by
+    pad seconds so note onsets/decays aren't cut, and blips shorter than
+    min_length are dropped.
+    """
+    active = np.flatnonzero(rms > threshold)
+    if len(active) == 0:
+        return []
+    frame_seconds = hop_length / sr
+    duration = len(rms) * frame_seconds
+    # split wherever two consecutive active frames are more than min_gap apart
+    breaks = np.flatnonzero(np.diff(active) * frame_seconds > min_gap)
+    starts = active[np.concatenate([[0], breaks + 1])]
+    ends = active[np.concatenate([breaks, [len(active) - 1]])] + 1
+
+    regions = []
+    for start, end in zip(starts * frame_seconds, ends * frame_seconds):
+        if end - start < min_length:
+            continue
+        start, end = max(0.0, start - pad), min(duration, end + pad)
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], end)  # padding made them touch
+        else:
+            regions.append((start, end))
+    return regions
+
+
+def describe(rms, sr, samples, hop_length=HOP_LENGTH):
+    """Manifest entry of one stem"""
+    regions = active_regions(rms, sr, hop_length)
+    duration = samples / sr if sr else 0.0
+    active_seconds = sum(end - start for start, end in regions)
+    return {
+        'average_rms': float(np.mean(rms)) if len(rms) else 0.0,
+        'samples': int(samples),
+        'active_regions': [[round(float(start), 4), round(float(end), 4)] for start, end in regions],
+        'active_fraction': float(active_seconds / duration) if duration else 0.0,
+    }
+
+
+def regions_worth_slicing(entry):
+    """Active regions to transcribe, or None when the whole stem should be transcribed"""
+    if entry is None or entry['active_fraction'] > MAX_ACTIVE_FRACTION or not entry['active_regions']:
+        return None
+    return [tuple(region) for region in entry['active_regions']]
+
+
+def manifest_paths(song_name, output_dir="separated_wavs"):
+    base = os.path.join(output_dir, f"{song_name}_energy")
+    return base + ".json", base + ".npz"
+
+
+def save_manifest(song_name, curves, sr, samples, output_dir="separated_wavs"):
+    """curves: {stem: frame rms}, samples: {stem: length in samples}. Returns the manifest"""
+    manifest = {
+        'song': song_name,
+        'sr': sr,
+        'frame_length': FRAME_LENGTH,
+        'hop_length': HOP_LENGTH,
+        'stems': {stem: describe(rms, sr, samples[stem]) for stem, rms in curves.items()},
+    }
+    json_path, npz_path = manifest_paths(song_name, output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(json_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    np.savez_compressed(npz_path, **{stem: rms.astype(np.float32) for stem, rms in curves.items()})
+    return manifest
+
+
+def save_manifest_from_stems(song_name, stems, sr, output_dir="separated_wavs"):
+    """Same as save_manifest for {stem: array} still in memory"""
+    curves = {stem: frame_energy(audio) for stem, audio in stems.items()}
+    samples = {stem: audio.shape[-1] for stem, audio in stems.items()}
+    return save_manifest(song_name, curves, sr, samples, output_dir)
+
+
+def load_manifest(song_name, output_dir="separated_wavs"):
+    json_path, _ = manifest_paths(song_name, output_dir)
+    try:
+        with open(json_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def lookup(wav_path):
+    """Manifest entry of separated_wavs/<song>_<stem>.wav, or None if there is no up to date one"""
+    import soundfile as sf
+
+    base = os.path.splitext(os.path.basename(wav_path))[0]
+    if '_' not in base:
+        return None
+    song_name, stem = base.rsplit('_', 1)
+    manifest = load_manifest(song_name, os.path.dirname(wav_path))
+    if manifest is None or stem not in manifest['stems']:
+        return None
+    entry = manifest['stems'][stem]
+    try:
+        # header only: a wav rewritten by another run won't match the manifest anymore
+        info = sf.info(wav_path)
+    except RuntimeError:
+        return None
+    if info.frames != entry['samples'] or info.samplerate != manifest['sr']:
+        return None
+    return entry
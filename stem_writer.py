@@ -0,0 +1,207 @@
+"""Background writer for the separated stems.
+
+separate_instruments used to write the six stems one after the other with
+torchaudio.save (32-bit float WAV), with the separation thread waiting on it.
+StemWriter encodes and writes them on a small thread pool instead, so the
+writes overlap with whatever comes next, usually the separation of the next
+song:
+
+    job = get_writer().write_stems("song", stems, 44100, fmt="flac")   # returns at once
+    job.paths       # separated_wavs/song_<stem>.flac ...
+    job.result()    # a Future: blocks until every file is on disk (raises the first error)
+    written(paths)  # Future of whichever of these paths still have a write pending
+
+Every file is written under a temporary name and renamed once it's complete,
+so a stage listing separated_wavs/ never sees half a stem; stem_files() also
+waits for the pending writes of the song before listing.
+
+Formats (--stem-format or REMIXAI_STEM_FORMAT), with the size of a minute of
+one stereo 44.1 kHz stem:
+
+    float32   32-bit float WAV, as before (default)    21 MB
+    pcm24     24-bit WAV                               16 MB
+    pcm16     16-bit WAV                               11 MB
+    flac      24-bit FLAC, lossless                    less than pcm24, depends on the stem
+
+The integer formats are clipped to [-1, 1]. The copy that stays in the audio
+store (what in-process stages read) is the unquantized stem.
+"""
+import functools
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+import audio_store
+
+# format: (extension, soundfile container, soundfile subtype)
+FORMATS = {
+    'float32': ('.wav', 'WAV', 'FLOAT'),
+    'pcm24': ('.wav', 'WAV', 'PCM_24'),
+    'pcm16': ('.wav', 'WAV', 'PCM_16'),
+    'flac': ('.flac', 'FLAC', 'PCM_24'),
+}
+STEM_EXTENSIONS = ('.wav', '.flac')
+DEFAULT_FORMAT = os.environ.get("REMIXAI_STEM_FORMAT", "float32")
+DEFAULT_WORKERS = int(os.environ.get("REMIXAI_STEM_WRITERS", "2"))
+# files queued at most (about four songs) before submit blocks, so a fast separator can't fill the memory
+MAX_PENDING = 24
+
+# absolute path -> Future of the write in progress
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def check_format(fmt):
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown stem format {fmt!r}, expected one of {', '.join(FORMATS)}")
+    return fmt
+
+
+def stem_path(song_name, stem, output_dir="separated_wavs", fmt=None):
+    """separated_wavs/<song>_<stem>.<extension of fmt>"""
+    return os.path.join(output_dir, f"{song_name}_{stem}{FORMATS[check_format(fmt or DEFAULT_FORMAT)][0]}")
+
+
+def soundfile_args(fmt=None):
+    """format/subtype keyword arguments of soundfile for fmt"""
+    _, container, subtype = FORMATS[check_format(fmt or DEFAULT_FORMAT)]
+    return {'format': container, 'subtype': subtype}
+
+
+def prepare_audio(audio, fmt=None):
+    """float32 audio ready for fmt ([channels, samples] in, [samples, channels] out)"""
+    audio = np.asarray(audio, dtype=np.float32)
+    if FORMATS[check_format(fmt or DEFAULT_FORMAT)][2] != 'FLOAT':
+        # integer samples would wrap around instead of clipping
+        audio = np.clip(audio, -1.0, 1.0)
+    return audio.T
+
+
+def write_stem(path, audio, sr, fmt=None):
+    """Write one stem ([channels, samples]) to path now; returns path"""
+    import soundfile as sf
+
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        sf.write(tmp_path, prepare_audio(audio, fmt), sr, **soundfile_args(fmt))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # the same stem in another format (an earlier run) would be transcribed twice
+    base = os.path.splitext(path)[0]
+    for extension in STEM_EXTENSIONS:
+        if base + extension != path and os.path.exists(base + extension):
+            os.remove(base + extension)
+    # the stem is in memory already, so later stages don't need to decode the file again
+    audio_store.default_store.put(path, audio, sr)
+    return path
+
+
+class StemJob(Future):
+    """Future of several stem files: its result is the list of paths once every one is written"""
+
+    def __init__(self, paths, futures):
+        super().__init__()
+        self.paths = list(paths)
+        self._left = len(futures)
+        self._error = None
+        self._lock = threading.Lock()
+        if not futures:
+            self.set_result(self.paths)
+        for future in futures:
+            future.add_done_callback(self._file_done)
+
+    def _file_done(self, future):
+        with self._lock:
+            if future.exception() is not None and self._error is None:
+                self._error = future.exception()
+            self._left -= 1
+            done = self._left == 0
+        if done:
+            if self._error is not None:
+                self.set_exception(self._error)
+            else:
+                self.set_result(self.paths)
+
+
+class StemWriter:
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_pending=MAX_PENDING):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stem-writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, path, audio, sr, fmt=None):
+        """Write one stem in the background; returns the Future of its path"""
+        check_format(fmt or DEFAULT_FORMAT)
+        self._slots.acquire()
+        key = os.path.abspath(path)
+        with _pending_lock:
+            future = self.executor.submit(write_stem, path, audio, sr, fmt)
+            _pending[key] = future
+        future.add_done_callback(functools.partial(self._done, key))
+        return future
+
+    def _done(self, key, future):
+        self._slots.release()
+        with _pending_lock:
+            if _pending.get(key) is future:
+                del _pending[key]
+
+    def write_stems(self, song_name, stems, sr, output_dir="separated_wavs", fmt=None):
+        """Write {stem: [channels, samples]} to output_dir/<song>_<stem>.<ext> in the background; returns a StemJob"""
+        os.makedirs(output_dir, exist_ok=True)
+        paths, futures = [], []
+        for stem, audio in stems.items():
+            path = stem_path(song_name, stem, output_dir, fmt)
+            paths.append(path)
+            futures.append(self.submit(path, audio, sr, fmt))
+        return StemJob(paths, futures)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def written(paths):
+    """StemJob that completes when none of paths has a write pending any more"""
+    with _pending_lock:
+        futures = [_pending[os.path.abspath(path)] for path in paths if os.path.abspath(path) in _pending]
+    return StemJob(paths, futures)
+
+
+def wait(paths):
+    """Block until the pending writes of paths are done (raises the error of a failed one)"""
+    return written(paths).result()
+
+
+def stem_files(song_name, stems, folder="separated_wavs"):
+    """File names of song_name's stems (<song>_<stem> in any format) in folder, once their pending writes are done
+
+    Only the exact names count: a prefix match on "<song>_" also picked up the
+    stems of any other song whose name starts the same way.
+    """
+    names = [f"{song_name}_{stem}{extension}" for stem in stems for extension in STEM_EXTENSIONS]
+    try:
+        wait([os.path.join(folder, name) for name in names])
+    except Exception as e:
+        # list whatever was written; the job's future has the error too
+        print(f"Could not write a stem of {song_name}: {str(e)}")
+    return sorted(name for name in names if os.path.exists(os.path.join(folder, name)))
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Writer pool shared by the whole process"""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = StemWriter()
+        return _writer
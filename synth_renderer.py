@@ -0,0 +1,183 @@
+"""In-process FluidSynth renderer: the soundfont is loaded once and kept for the whole session.
+
+midi_to_wav used to start the fluidsynth binary through midi2audio for every
+file, which loads GeneralUser-GS.sf2 again each time and renders the whole
+MIDI on one thread. SynthRenderer keeps a few synths (each with the soundfont
+already loaded) and reuses them for every MIDI it renders. A MIDI with several
+instruments is split into one job per instrument; the jobs are rendered in
+parallel (the FluidSynth calls release the GIL) and mixed with NumPy.
+
+    renderer = get_renderer()
+    audio = renderer.render_midi("midi_files/song_combined.mid")   # float32 [2, samples]
+    renderer.render_to_file(table, "final_output/song.wav")
+
+Needs pyfluidsynth and the FluidSynth library (libfluidsynth).
+"""
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from note_table import NoteTable
+
+DEFAULT_SOUNDFONT = "./GeneralUser-GS.sf2"
+SAMPLE_RATE = 44100
+# seconds rendered after the last event so releases and reverb can ring out
+TAIL_SECONDS = 1.0
+DRUM_CHANNEL = 9
+DRUM_BANK = 128
+
+# event kinds, in the order they're sent when they happen at the same sample
+NOTE_OFF, PITCH_BEND, CONTROL_CHANGE, NOTE_ON = range(4)
+
+
+class SynthRenderer:
+
+    def __init__(self, soundfont_path=DEFAULT_SOUNDFONT, sample_rate=SAMPLE_RATE, workers=None, gain=0.2):
+        if not os.path.exists(soundfont_path):
+            raise FileNotFoundError(f"Soundfont not found: {soundfont_path}")
+        self.soundfont_path = soundfont_path
+        self.sample_rate = sample_rate
+        self.gain = gain
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="synth")
+        # idle synths, each with the soundfont loaded; created the first time they're needed
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_synth(self):
+        import fluidsynth
+
+        synth = fluidsynth.Synth(gain=self.gain, samplerate=float(self.sample_rate))
+        sfid = synth.sfload(self.soundfont_path)
+        if sfid < 0:
+            synth.delete()
+            raise RuntimeError(f"FluidSynth could not load {self.soundfont_path}")
+        return synth, sfid
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.workers
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._new_synth()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    def _release(self, synth_and_sfid):
+        self._idle.put(synth_and_sfid)
+
+    def warm_up(self):
+        """Load the soundfont into one synth now instead of on the first render"""
+        self._release(self._acquire())
+
+    def render_instrument(self, table, index, tail=TAIL_SECONDS):
+        """float32 [2, samples] of the notes, bends and control changes of instrument index"""
+        meta = table.instruments[index]
+        notes = table.instrument == index
+        events = _events(table.pitch[notes], table.start[notes], table.end[notes], table.velocity[notes],
+                         meta['pitch_bends'], meta['control_changes'], self.sample_rate)
+        channel = DRUM_CHANNEL if meta['is_drum'] else 0
+        synth_and_sfid = self._acquire()
+        synth, sfid = synth_and_sfid
+        try:
+            synth.program_select(channel, sfid, DRUM_BANK if meta['is_drum'] else 0, meta['program'])
+            blocks, cursor = [], 0
+            for sample, kind, a, b in events:
+                if sample > cursor:
+                    blocks.append(synth.get_samples(sample - cursor))
+                    cursor = sample
+                if kind == NOTE_ON:
+                    synth.noteon(channel, a, b)
+                elif kind == NOTE_OFF:
+                    synth.noteoff(channel, a)
+                elif kind == PITCH_BEND:
+                    synth.pitch_bend(channel, a)
+                else:
+                    synth.cc(channel, a, b)
+            blocks.append(synth.get_samples(int(tail * self.sample_rate)))
+        finally:
+            # leave the synth clean for the next job
+            synth.system_reset()
+            self._release(synth_and_sfid)
+        audio = np.concatenate(blocks).reshape(-1, 2).T
+        return audio.astype(np.float32) / 32768.0
+
+    def render_table(self, table, tail=TAIL_SECONDS):
+        """float32 [2, samples] of every instrument of a NoteTable, rendered in parallel and mixed"""
+        jobs = [index for index, meta in enumerate(table.instruments)
+                if np.any(table.instrument == index) or len(meta['pitch_bends']) or len(meta['control_changes'])]
+        if not jobs:
+            return np.zeros((2, int(tail * self.sample_rate)), dtype=np.float32)
+        parts = list(self.executor.map(lambda index: self.render_instrument(table, index, tail), jobs))
+        mix = np.zeros((2, max(part.shape[1] for part in parts)), dtype=np.float32)
+        for part in parts:
+            mix[:, :part.shape[1]] += part
+        # only scale down if the sum clips
+        peak = np.abs(mix).max()
+        if peak > 1.0:
+            mix /= peak
+        return mix
+
+    def render_midi(self, midi_path, tail=TAIL_SECONDS):
+        return self.render_table(NoteTable.from_midi_file(midi_path), tail)
+
+    def render_to_file(self, midi, wav_path, tail=TAIL_SECONDS):
+        """Render a MIDI path or a NoteTable to wav_path; returns the audio array too"""
+        import soundfile as sf
+
+        table = midi if isinstance(midi, NoteTable) else NoteTable.from_midi_file(midi)
+        audio = self.render_table(table, tail)
+        if os.path.dirname(wav_path):
+            os.makedirs(os.path.dirname(wav_path), exist_ok=True)
+        sf.write(wav_path, audio.T, self.sample_rate, subtype='PCM_16')
+        return audio
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while not self._idle.empty():
+            synth, _ = self._idle.get_nowait()
+            synth.delete()
+
+
+def _events(pitch, start, end, velocity, pitch_bends, control_changes, sample_rate):
+    """[(sample, kind, a, b)] sorted by time, note-offs first and note-ons last at the same sample"""
+    pitch = pitch.astype(np.int64)
+    velocity = velocity.astype(np.int64)
+    columns = [
+        (end, NOTE_OFF, pitch, np.zeros_like(pitch)),
+        (pitch_bends[:, 0], PITCH_BEND, pitch_bends[:, 1], np.zeros(len(pitch_bends))),
+        (control_changes[:, 0], CONTROL_CHANGE, control_changes[:, 1], control_changes[:, 2]),
+        (start, NOTE_ON, pitch, velocity),
+    ]
+    samples = np.concatenate([np.round(np.asarray(t) * sample_rate) for t, _, _, _ in columns]).astype(np.int64)
+    kinds = np.concatenate([np.full(len(t), kind) for t, kind, _, _ in columns])
+    a = np.concatenate([np.asarray(values) for _, _, values, _ in columns]).astype(np.int64)
+    b = np.concatenate([np.asarray(values) for _, _, _, values in columns]).astype(np.int64)
+    order = np.lexsort((kinds, samples))
+    return zip(np.maximum(samples[order], 0).tolist(), kinds[order].tolist(), a[order].tolist(), b[order].tolist())
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer(soundfont_path=DEFAULT_SOUNDFONT, sample_rate=SAMPLE_RATE):
+    """Renderer shared by the whole process (the soundfont stays loaded between calls)"""
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None or (_renderer.soundfont_path, _renderer.sample_rate) != (soundfont_path, sample_rate):
+            _renderer = SynthRenderer(soundfont_path, sample_rate)
+        return _renderer
@@ -0,0 +1,217 @@
+"""Tempo maps: beat grid and local tempo of a song, computed once and cached by audio hash.
+
+get_tempo used to decode the whole mix and beat-track all of it for one BPM
+number. A TempoMap keeps the whole result (global BPM, beat times, local BPM
+per beat) so every consumer (the tempo mark, the MusicXML beat grid, ...)
+shares one analysis. The analysis can be limited to a window of the song, or
+run on an onset envelope that already exists. For example, the drum stem's
+frame energy saved during separation can be used, so nothing is decoded.
+
+    tempo_map = tempo_map_for_file("song.mp3", window_seconds=60)
+    tempo_map.bpm, tempo_map.beats, tempo_map.seconds_to_beats(note_starts)
+
+Results are cached in memory and as JSON under ~/.cache/remixai/tempo
+($REMIXAI_TEMPO_CACHE_DIR), keyed by the audio's content hash and the settings.
+"""
+import hashlib
+import json
+import os
+
+import librosa
+import numpy as np
+from scipy.signal import medfilt
+
+import audio_store
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "REMIXAI_TEMPO_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "remixai", "tempo"))
+ANALYSIS_SR = 22050
+HOP_LENGTH = 512
+START_BPM = 120
+# local tempo is the median of this many beat intervals
+LOCAL_TEMPO_BEATS = 5
+
+_tempo_maps = {}
+
+
+class TempoMap:
+
+    def __init__(self, bpm, beats, local_bpm=None, source=None):
+        self.bpm = float(bpm)
+        self.beats = np.asarray(beats, dtype=np.float64)
+        if local_bpm is None:
+            local_bpm = local_tempo(self.beats, self.bpm)
+        self.local_bpm = np.asarray(local_bpm, dtype=np.float64)
+        self.source = source
+
+    def __repr__(self):
+        return f"TempoMap({self.bpm:.1f} BPM, {len(self.beats)} beats)"
+
+    def tempo_at(self, seconds):
+        """Local BPM at the given times (global BPM outside the beat grid)"""
+        seconds = np.asarray(seconds, dtype=np.float64)
+        if len(self.beats) < 2:
+            return np.full(seconds.shape, self.bpm)
+        index = np.clip(np.searchsorted(self.beats, seconds, side='right') - 1, 0, len(self.beats) - 1)
+        inside = (seconds >= self.beats[0]) & (seconds <= self.beats[-1])
+        return np.where(inside, self.local_bpm[index], self.bpm)
+
+    def seconds_to_beats(self, seconds):
+        """Position in beats of the given times, following the beat grid
+
+        Before the first and after the last detected beat the global tempo is
+        used, so time 0 is beat 0 and the mapping keeps increasing.
+        """
+        seconds = np.asarray(seconds, dtype=np.float64)
+        beats_per_second = self.bpm / 60.0
+        if len(self.beats) < 2:
+            return seconds * beats_per_second
+        first = self.beats[0] * beats_per_second
+        positions = first + np.arange(len(self.beats))
+        inner = np.interp(seconds, self.beats, positions)
+        before = seconds * beats_per_second
+        after = positions[-1] + (seconds - self.beats[-1]) * beats_per_second
+        return np.where(seconds < self.beats[0], before, np.where(seconds > self.beats[-1], after, inner))
+
+    def to_dict(self):
+        return {'bpm': self.bpm, 'beats': self.beats.round(4).tolist(),
+                'local_bpm': self.local_bpm.round(3).tolist(), 'source': self.source}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['bpm'], data['beats'], data['local_bpm'], data.get('source'))
+
+
+def local_tempo(beats, bpm, kernel=LOCAL_TEMPO_BEATS):
+    """BPM around every beat: median of the neighbouring beat intervals"""
+    if len(beats) < 2:
+        return np.full(len(beats), bpm)
+    intervals = np.diff(beats)
+    if len(intervals) >= kernel:
+        intervals = medfilt(intervals, kernel)
+    local = 60.0 / np.maximum(intervals, 1e-3)
+    return np.append(local, local[-1])
+
+
+def analyze_onsets(onset_envelope, sr, hop_length=HOP_LENGTH, offset=0.0, source=None):
+    """TempoMap of an onset strength envelope (frames of hop_length samples, starting at offset seconds)"""
+    onset_envelope = np.asarray(onset_envelope, dtype=np.float32)
+    if len(onset_envelope) == 0 or not onset_envelope.any():
+        return TempoMap(START_BPM, [], source=source)
+    tempo, beats = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=sr, hop_length=hop_length,
+                                           start_bpm=START_BPM, units='time')
+    return TempoMap(float(np.atleast_1d(tempo)[0]), beats + offset, source=source)
+
+
+def analyze_audio(y, sr, offset=0.0, source=None):
+    """TempoMap of an audio array (mono or [channels, samples]) that starts at offset seconds"""
+    y = np.asarray(y, dtype=np.float32)
+    if y.ndim > 1:
+        y = librosa.to_mono(y)
+    onset_envelope = librosa.onset.onset_strength(y=y, sr=sr, hop_length=HOP_LENGTH)
+    return analyze_onsets(onset_envelope, sr, HOP_LENGTH, offset, source)
+
+
+def onsets_from_energy(rms):
+    """Onset envelope out of a frame RMS curve (like stem_energy's): rises of the level in dB"""
+    level = librosa.amplitude_to_db(np.asarray(rms, dtype=np.float32), ref=np.max, top_db=80.0)
+    return np.maximum(0.0, np.diff(level, prepend=level[:1]))
+
+
+def analysis_window(duration, window_seconds):
+    """(offset, length) of the window_seconds in the middle of a song of duration seconds"""
+    if not window_seconds or window_seconds >= duration:
+        return 0.0, None
+    return (duration - window_seconds) / 2, window_seconds
+
+
+class TempoCache:
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        if key in _tempo_maps:
+            return _tempo_maps[key]
+        try:
+            with open(self._path(key)) as f:
+                _tempo_maps[key] = TempoMap.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+        return _tempo_maps[key]
+
+    def put(self, key, tempo_map):
+        _tempo_maps[key] = tempo_map
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = self._path(key) + f".{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(tempo_map.to_dict(), f)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"Could not cache the tempo map: {str(e)}")
+        return tempo_map
+
+
+default_cache = TempoCache()
+
+
+def _key(path, **settings):
+    h = hashlib.sha256(audio_store.hash_file(path).encode())
+    h.update(json.dumps(settings, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def tempo_map_for_file(audio_path, window_seconds=None, cache=None):
+    """TempoMap of an audio file, analysing only the window_seconds in its middle if given"""
+    cache = cache or default_cache
+    key = _key(audio_path, kind='audio', window=window_seconds, sr=ANALYSIS_SR, hop=HOP_LENGTH)
+    tempo_map = cache.get(key)
+    if tempo_map is None:
+        offset, length = analysis_window(librosa.get_duration(path=audio_path), window_seconds)
+        if length is None or audio_store.default_store.holds(audio_path):
+            # the whole song, or the mix is decoded already: through the store, so it's decoded once
+            y, sr = audio_store.load(audio_path, sr=ANALYSIS_SR, mono=True)
+            if length is not None:
+                y = y[int(offset * sr):int((offset + length) * sr)]
+        else:
+            # only the window gets decoded
+            y, sr = librosa.load(audio_path, sr=ANALYSIS_SR, mono=True, offset=offset, duration=length)
+        tempo_map = cache.put(key, analyze_audio(y, sr, offset, source=os.path.basename(audio_path)))
+    return tempo_map
+
+
+def tempo_map_from_energy(song_name, stem="drums", output_dir="separated_wavs", cache=None):
+    """TempoMap from a stem's frame energy saved at separation time (nothing is decoded)
+
+    Returns None when there is no energy manifest for the song or the stem is silent.
+    """
+    import stem_energy
+
+    manifest = stem_energy.load_manifest(song_name, output_dir)
+    _, npz_path = stem_energy.manifest_paths(song_name, output_dir)
+    if manifest is None or stem not in manifest['stems'] or not os.path.exists(npz_path):
+        return None
+    if manifest['stems'][stem]['average_rms'] <= stem_energy.ACTIVE_RMS_THRESHOLD:
+        return None
+    cache = cache or default_cache
+    key = _key(npz_path, kind='energy', stem=stem)
+    tempo_map = cache.get(key)
+    if tempo_map is None:
+        with np.load(npz_path) as curves:
+            rms = curves[stem]
+        tempo_map = cache.put(key, analyze_onsets(onsets_from_energy(rms), manifest['sr'], manifest['hop_length'],
+                                                  source=f"{song_name}_{stem} energy"))
+    return tempo_map
+
+
+def tempo_map_for_song(audio_path, window_seconds=None, output_dir="separated_wavs", cache=None):
+    """Drum-stem energy if the song is already separated, the mix otherwise"""
+    song_name = os.path.splitext(os.path.basename(audio_path))[0]
+    tempo_map = tempo_map_from_energy(song_name, output_dir=output_dir, cache=cache)
+    if tempo_map is None or len(tempo_map.beats) < 2:
+        tempo_map = tempo_map_for_file(audio_path, window_seconds, cache)
+    return tempo_map
@@ -0,0 +1,210 @@
+"""basic_pitch transcription straight from audio arrays.
+
+basic_pitch's own predict()/predict_and_save() only accept file paths and
+decode them again with librosa. These helpers run the same windowing,
+inference and note creation on an array that is already in memory, so the
+separated stems can go from Demucs to MIDI without a WAV round-trip.
+"""
+import librosa
+import numpy as np
+from basic_pitch import ICASSP_2022_MODEL_PATH
+from basic_pitch.constants import AUDIO_N_SAMPLES, AUDIO_SAMPLE_RATE, FFT_HOP
+from basic_pitch.inference import Model, unwrap_output, window_audio_file
+import basic_pitch.note_creation as infer
+
+from note_table import NoteTable
+
+# same overlap basic_pitch.inference.run_inference uses
+N_OVERLAPPING_FRAMES = 30
+OVERLAP_LEN = N_OVERLAPPING_FRAMES * FFT_HOP
+HOP_SIZE = AUDIO_N_SAMPLES - OVERLAP_LEN
+# windows per forward pass in batched mode (~2 s of audio each)
+DEFAULT_BATCH_SIZE = 64
+
+
+def to_model_input(y, sr):
+    """Mono, 22050 Hz float32: what librosa.load(path, sr=22050, mono=True) gives basic_pitch"""
+    y = np.asarray(y, dtype=np.float32)
+    if y.ndim > 1:
+        y = librosa.to_mono(y)
+    if sr != AUDIO_SAMPLE_RATE:
+        y = librosa.resample(y, orig_sr=sr, target_sr=AUDIO_SAMPLE_RATE)
+    return y.astype(np.float32, copy=False)
+
+
+def audio_windows(y, sr):
+    """Model input windows of y: ([n_windows, AUDIO_N_SAMPLES, 1] array, original length in samples)"""
+    audio = to_model_input(y, sr)
+    original_length = audio.shape[0]
+    audio = np.concatenate([np.zeros((OVERLAP_LEN // 2,), dtype=np.float32), audio])
+    windows = [window for window, _ in window_audio_file(audio, HOP_SIZE)]
+    return np.stack(windows).astype(np.float32, copy=False), original_length
+
+
+def run_inference_on_audio(y, sr, model):
+    """basic_pitch.inference.run_inference for an audio array instead of a path"""
+    audio = to_model_input(y, sr)
+    original_length = audio.shape[0]
+    audio = np.concatenate([np.zeros((OVERLAP_LEN // 2,), dtype=np.float32), audio])
+
+    output = {"note": [], "onset": [], "contour": []}
+    for window, _ in window_audio_file(audio, HOP_SIZE):
+        for k, v in model.predict(np.expand_dims(window, axis=0)).items():
+            output[k].append(v)
+    return {k: unwrap_output(np.concatenate(output[k]), original_length, N_OVERLAPPING_FRAMES) for k in output}
+
+
+def run_batched_inference(audios, model, batch_size=DEFAULT_BATCH_SIZE):
+    """run_inference_on_audio for many (y, sr) pairs at once
+
+    The windows of every input are packed back to back into batches of
+    batch_size windows, so each forward pass is as large as possible no matter
+    how short the individual stems are. The outputs are split back per input.
+    """
+    windows, lengths, counts = [], [], []
+    for y, sr in audios:
+        w, original_length = audio_windows(y, sr)
+        windows.append(w)
+        lengths.append(original_length)
+        counts.append(len(w))
+    if not windows:
+        return []
+    windows = np.concatenate(windows)
+
+    output = {"note": [], "onset": [], "contour": []}
+    for start in range(0, len(windows), batch_size):
+        for k, v in model.predict(windows[start:start + batch_size]).items():
+            output[k].append(v)
+    output = {k: np.concatenate(v) for k, v in output.items()}
+
+    results = []
+    offset = 0
+    for count, original_length in zip(counts, lengths):
+        results.append({k: unwrap_output(v[offset:offset + count], original_length, N_OVERLAPPING_FRAMES)
+                        for k, v in output.items()})
+        offset += count
+    return results
+
+
+def output_to_notes(model_output, onset_threshold=0.5, frame_threshold=0.3, minimum_note_length=127.70,
+                    minimum_frequency=None, maximum_frequency=None, multiple_pitch_bends=False,
+                    melodia_trick=True, midi_tempo=120):
+    """Note creation step of basic_pitch.inference.predict: (midi_data, note_events)"""
+    min_note_len = int(np.round(minimum_note_length / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)))
+    return infer.model_output_to_notes(
+        model_output,
+        onset_thresh=onset_threshold,
+        frame_thresh=frame_threshold,
+        min_note_len=min_note_len,
+        min_freq=minimum_frequency,
+        max_freq=maximum_frequency,
+        multiple_pitch_bends=multiple_pitch_bends,
+        melodia_trick=melodia_trick,
+        midi_tempo=midi_tempo,
+    )
+
+
+def predict_audio(y, sr, model=None, onset_threshold=0.5, frame_threshold=0.3, minimum_note_length=127.70,
+                  minimum_frequency=None, maximum_frequency=None, multiple_pitch_bends=False,
+                  melodia_trick=True, midi_tempo=120):
+    """basic_pitch.inference.predict for an audio array (same defaults)
+
+    Returns (model_output, midi_data, note_events), midi_data being a PrettyMIDI.
+    """
+    if model is None:
+        model = ICASSP_2022_MODEL_PATH
+    if not isinstance(model, Model):
+        model = Model(model)
+
+    model_output = run_inference_on_audio(y, sr, model)
+    midi_data, note_events = output_to_notes(
+        model_output, onset_threshold, frame_threshold, minimum_note_length, minimum_frequency,
+        maximum_frequency, multiple_pitch_bends, melodia_trick, midi_tempo)
+    return model_output, midi_data, note_events
+
+
+def merge_regions(pieces):
+    """One single-instrument NoteTable out of [(region_start_s, PrettyMIDI of that region), ...]"""
+    return NoteTable.merge([NoteTable.from_pretty_midi(pm).shift(offset) for offset, pm in pieces],
+                           single_instrument=True)
+
+
+class TranscriptionEngine:
+    """One loaded basic_pitch model that turns audio arrays into note tables
+
+    Loading the model is the expensive part of transcribing a short stem, so an
+    engine is meant to be created once per process and reused for every stem.
+    """
+
+    def __init__(self, model_path=ICASSP_2022_MODEL_PATH, **note_params):
+        self.model = Model(model_path)
+        # extra predict_audio settings (onset_threshold, minimum_note_length, ...)
+        self.note_params = note_params
+
+    def transcribe(self, y, sr, program=0, is_drum=False, note_length_scale=0.5):
+        """Transcribe y and return the finished NoteTable (nothing written to disk)
+
+        Note durations are scaled by note_length_scale (basic_pitch's notes come
+        out too long, half works better) and every instrument gets program/is_drum.
+        """
+        _, pm, _ = predict_audio(y, sr, self.model, **self.note_params)
+        return self._finish(NoteTable.from_pretty_midi(pm), program, is_drum, note_length_scale)
+
+    def transcribe_batch(self, items, batch_size=DEFAULT_BATCH_SIZE, note_length_scale=0.5):
+        """Transcribe many stems (of one or several songs) with shared inference batches
+
+        items: list of dicts with 'y', 'sr' and optionally 'program' / 'is_drum' /
+        'regions'. With regions ([(start_s, end_s), ...]) only those parts of the
+        stem are transcribed and the notes are shifted back onto the stem's timeline.
+        Returns one finished NoteTable per item, in the same order.
+        """
+        # every region becomes its own input so the slices share batches too
+        audios, owners = [], []
+        for index, item in enumerate(items):
+            regions = item.get('regions')
+            if regions is None:
+                audios.append((item['y'], item['sr']))
+                owners.append((index, 0.0))
+                continue
+            for start, end in regions:
+                audios.append((item['y'][..., int(start * item['sr']):int(end * item['sr'])], item['sr']))
+                owners.append((index, start))
+        outputs = run_batched_inference(audios, self.model, batch_size)
+
+        pieces = [[] for _ in items]
+        for (index, offset), model_output in zip(owners, outputs):
+            pm, _ = output_to_notes(model_output, **self.note_params)
+            pieces[index].append((offset, pm))
+
+        tables = []
+        for item, item_pieces in zip(items, pieces):
+            if item.get('regions') is None:
+                table = NoteTable.from_pretty_midi(item_pieces[0][1])
+            else:
+                table = merge_regions(item_pieces)
+            tables.append(self._finish(table, item.get('program', 0), item.get('is_drum', False), note_length_scale))
+        return tables
+
+    def transcribe_regions(self, y, sr, regions, program=0, is_drum=False, note_length_scale=0.5):
+        """transcribe() restricted to the active regions of y (times stay those of y)"""
+        item = {'y': y, 'sr': sr, 'program': program, 'is_drum': is_drum, 'regions': regions}
+        return self.transcribe_batch([item], note_length_scale=note_length_scale)[0]
+
+    def _finish(self, table, program, is_drum, note_length_scale):
+        return table.scale_durations(note_length_scale).set_program(program, is_drum)
+
+    def transcribe_to_file(self, y, sr, midi_path, program=0, is_drum=False, note_length_scale=0.5):
+        table = self.transcribe(y, sr, program, is_drum, note_length_scale)
+        table.write_midi(midi_path)
+        return table
+
+
+_default_engine = None
+
+
+def get_engine():
+    """Process-wide engine, created on first use"""
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = TranscriptionEngine()
+    return _default_engine
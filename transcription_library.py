@@ -0,0 +1,341 @@
+"""Transcription library: the notes of many songs in memory-mapped columns plus a searchable index.
+
+Instead of loose .mid files, every transcribed stem is appended to a few
+column files (one per NoteTable field) and described by one entry of
+index.json: song, stem, program, tempo, key, note count, duration and stem
+energy. Queries only read the index, and a stem's notes are a slice of the
+memory-mapped columns, so nothing is parsed:
+
+    library = TranscriptionLibrary()
+    for entry in library.find(stem="bass", key="A", mode="minor", tempo=(118, 124)):
+        table = library.table(entry)            # NoteTable over the mapped columns
+    combined = library.song_table("trial_ensemble")   # every stem of a song, one instrument each
+
+Layout of the library directory:
+
+    <library>/index.json        one entry per (song, stem)
+    <library>/<column>.bin      pitch, start, end, velocity, bends, controls (append-only)
+    <library>/lock              writers take it, so several processes can share a library
+
+Re-adding a stem replaces its entry; the old rows stay in the columns until
+more than COMPACT_DEAD_FRACTION of the rows are dead, then the writer that
+crossed it rewrites the columns (compact() does it at any time).
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import key_detection
+from note_table import NOTE_DTYPES, NoteTable, instrument_info
+
+DEFAULT_LIBRARY_DIR = os.environ.get("REMIXAI_LIBRARY_DIR", "transcription_library")
+
+# column: (dtype, values per row)
+COLUMNS = {
+    'pitch': (NOTE_DTYPES['pitch'], 1),
+    'start': (NOTE_DTYPES['start'], 1),
+    'end': (NOTE_DTYPES['end'], 1),
+    'velocity': (NOTE_DTYPES['velocity'], 1),
+    'bends': (np.float64, 2),     # (time, bend)
+    'controls': (np.float64, 3),  # (time, number, value)
+}
+# which row range of the entry each column uses
+NOTE_COLUMNS = ('pitch', 'start', 'end', 'velocity')
+# columns are compacted once more than this fraction of the note rows belong to no entry
+COMPACT_DEAD_FRACTION = 0.5
+
+
+class TranscriptionLibrary:
+
+    def __init__(self, path=DEFAULT_LIBRARY_DIR):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._entries = []
+        self._index_mtime = None
+        self._maps = {}  # column -> memmap of the column file as it was last mapped
+        self._lock = threading.Lock()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _writing(self):
+        """Exclusive lock for writers of this process and of others"""
+        with self._lock, open(self._file("lock"), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._entries = self._read_index()
+                self._align()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _align(self):
+        """Cut the note columns to the same number of rows (a writer that died half-way leaves extra ones)"""
+        rows = []
+        for name in NOTE_COLUMNS:
+            path = self._file(f"{name}.bin")
+            rows.append(os.path.getsize(path) // np.dtype(COLUMNS[name][0]).itemsize if os.path.exists(path) else 0)
+        if len(set(rows)) > 1:
+            for name in NOTE_COLUMNS:
+                if os.path.exists(self._file(f"{name}.bin")):
+                    os.truncate(self._file(f"{name}.bin"), min(rows) * np.dtype(COLUMNS[name][0]).itemsize)
+            self._maps.clear()
+
+    def _read_index(self):
+        try:
+            with open(self._file("index.json")) as f:
+                self._index_mtime = os.fstat(f.fileno()).st_mtime_ns
+                return json.load(f)['entries']
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def _write_index(self, entries):
+        tmp_path = self._file(f"index.json.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({'entries': entries}, f, indent=1)
+        os.replace(tmp_path, self._file("index.json"))
+        self._entries = entries
+        self._index_mtime = os.stat(self._file("index.json")).st_mtime_ns
+
+    @property
+    def entries(self):
+        """Every entry of the index (re-read if another process changed it)"""
+        try:
+            mtime = os.stat(self._file("index.json")).st_mtime_ns
+        except OSError:
+            return []
+        if mtime != self._index_mtime:
+            # another process wrote: the columns may have been compacted too
+            self._maps.clear()
+            self._entries = self._read_index()
+        return self._entries
+
+    def _column(self, name, rows):
+        """Memory map of a column covering at least rows rows"""
+        dtype, width = COLUMNS[name]
+        mapped = self._maps.get(name)
+        if mapped is None or len(mapped) < rows:
+            path = self._file(f"{name}.bin")
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            row_bytes = np.dtype(dtype).itemsize * width
+            if size < row_bytes:
+                mapped = np.zeros((0, width) if width > 1 else 0, dtype=dtype)
+            else:
+                shape = (size // row_bytes, width) if width > 1 else (size // row_bytes,)
+                mapped = np.memmap(path, dtype=dtype, mode='r', shape=shape)
+            self._maps[name] = mapped
+        return mapped
+
+    def _slice(self, name, span):
+        offset, count = span
+        return self._column(name, offset + count)[offset:offset + count]
+
+    def _append(self, name, values):
+        """Append values to a column file; returns [offset, count] in rows"""
+        dtype, width = COLUMNS[name]
+        values = np.ascontiguousarray(values, dtype=dtype).reshape((-1, width) if width > 1 else -1)
+        row_bytes = np.dtype(dtype).itemsize * width
+        with open(self._file(f"{name}.bin"), 'ab') as f:
+            offset = f.tell() // row_bytes
+            f.write(values.tobytes())
+        return [int(offset), int(len(values))]
+
+    # writing
+
+    def add(self, song, stem, table, tempo=None, energy=None, source=None):
+        """Add (or replace) the notes of one stem; returns its index entry
+
+        table: NoteTable of the stem (its first instrument gives program and drum flag),
+        tempo: BPM of the song, energy: the stem's stem_energy manifest entry.
+        """
+        return self.add_song(song, {stem: table}, tempo, {stem: energy} if energy else None,
+                             {stem: source} if source else None)[0]
+
+    def add_song(self, song, tables, tempo=None, energies=None, sources=None):
+        """Add the stems of a song at once ({stem: NoteTable}); their rows end up next to each other"""
+        energies = energies or {}
+        sources = sources or {}
+        new_entries = []
+        with self._writing():
+            for stem, table in tables.items():
+                meta = table.instruments[0] if table.instruments else instrument_info()
+                estimate = None if meta['is_drum'] else key_detection.estimate_key(table)
+                energy = energies.get(stem) or {}
+                spans = {name: self._append(name, getattr(table, name)) for name in NOTE_COLUMNS}
+                bends = [meta['pitch_bends'] for meta in table.instruments] or [np.zeros((0, 2))]
+                controls = [meta['control_changes'] for meta in table.instruments] or [np.zeros((0, 3))]
+                new_entries.append({
+                    'song': song,
+                    'stem': stem,
+                    'name': meta['name'],
+                    'program': meta['program'],
+                    'is_drum': meta['is_drum'],
+                    'tempo': None if tempo is None else round(float(tempo), 2),
+                    'tonic': estimate[0] if estimate else None,
+                    'mode': estimate[1] if estimate else None,
+                    'notes': len(table),
+                    'duration': round(float(table.end.max()), 4) if len(table) else 0.0,
+                    'average_rms': energy.get('average_rms'),
+                    'active_fraction': energy.get('active_fraction'),
+                    'source': sources.get(stem),
+                    'added': time.time(),
+                    'rows': spans['pitch'],
+                    'bends': self._append('bends', np.concatenate(bends)),
+                    'controls': self._append('controls', np.concatenate(controls)),
+                })
+            replaced = {(entry['song'], entry['stem']) for entry in new_entries}
+            entries = [entry for entry in self._entries if (entry['song'], entry['stem']) not in replaced]
+            self._write_index(entries + new_entries)
+            self._compact_if_needed()
+        # a compaction moves the rows: the entries as they are in the index now
+        return self._entries[len(self._entries) - len(new_entries):]
+
+    def remove(self, song, stem=None):
+        with self._writing():
+            self._write_index([entry for entry in self._entries
+                               if not (entry['song'] == song and stem in (None, entry['stem']))])
+            self._compact_if_needed()
+
+    def _compact_if_needed(self):
+        """Compact when re-added and removed stems left too many dead rows (the write lock is held)"""
+        path = self._file("pitch.bin")
+        total = os.path.getsize(path) // np.dtype(COLUMNS['pitch'][0]).itemsize if os.path.exists(path) else 0
+        live = sum(entry['rows'][1] for entry in self._entries)
+        if total and total - live > COMPACT_DEAD_FRACTION * total:
+            print(f"Compacting the transcription library: {total - live} of {total} rows are dead")
+            self._compact()
+
+    def compact(self):
+        """Rewrite the columns with only the rows the index still uses"""
+        with self._writing():
+            self._compact()
+
+    def _compact(self):
+        entries = [dict(entry) for entry in self._entries]
+        spans = {'pitch': 'rows', 'bends': 'bends', 'controls': 'controls'}
+        for first_column, field in spans.items():
+            columns = NOTE_COLUMNS if first_column == 'pitch' else (first_column,)
+            for name in columns:
+                kept = [np.array(self._slice(name, entry[field])) for entry in entries]
+                dtype, width = COLUMNS[name]
+                data = np.concatenate(kept) if kept else np.zeros(0, dtype=dtype)
+                tmp_path = self._file(f"{name}.bin.{os.getpid()}.tmp")
+                data.astype(dtype).tofile(tmp_path)
+                self._maps.pop(name, None)
+                os.replace(tmp_path, self._file(f"{name}.bin"))
+            offset = 0
+            for entry in entries:
+                entry[field] = [offset, entry[field][1]]
+                offset += entry[field][1]
+        self._write_index(entries)
+        self._maps.clear()
+
+    # reading
+
+    def find(self, song=None, stem=None, program=None, is_drum=None, key=None, mode=None, tempo=None,
+             min_notes=None, where=None):
+        """Entries matching every given filter
+
+        key: tonic ('A', 'E-'), mode: 'major' / 'minor', tempo: (lowest, highest) BPM,
+        where: any other predicate on the entry dict.
+        """
+        def matches(entry):
+            if song is not None and entry['song'] != song:
+                return False
+            if stem is not None and entry['stem'] != stem:
+                return False
+            if program is not None and entry['program'] != program:
+                return False
+            if is_drum is not None and entry['is_drum'] != is_drum:
+                return False
+            if key is not None and entry['tonic'] != key:
+                return False
+            if mode is not None and entry['mode'] != mode:
+                return False
+            if tempo is not None and (entry['tempo'] is None or not tempo[0] <= entry['tempo'] <= tempo[1]):
+                return False
+            if min_notes is not None and entry['notes'] < min_notes:
+                return False
+            return where is None or where(entry)
+
+        return [entry for entry in self.entries if matches(entry)]
+
+    def songs(self):
+        return sorted({entry['song'] for entry in self.entries})
+
+    def table(self, entry):
+        """NoteTable of one entry, backed by the memory-mapped (read-only) columns
+
+        Transforms replace the columns, so they work on it; .copy() gives a fully
+        independent table.
+        """
+        return self.tables([entry])
+
+    def tables(self, entries):
+        """One NoteTable with an instrument per entry
+
+        Entries whose rows follow each other (like the stems of a song added
+        together) come out of one slice of each column, without copying.
+        """
+        if not entries:
+            return NoteTable()
+        counts = [entry['rows'][1] for entry in entries]
+        contiguous = all(b['rows'][0] == a['rows'][0] + a['rows'][1] for a, b in zip(entries, entries[1:]))
+        if contiguous:
+            span = [entries[0]['rows'][0], sum(counts)]
+            columns = {name: self._slice(name, span) for name in NOTE_COLUMNS}
+        else:
+            columns = {name: np.concatenate([self._slice(name, entry['rows']) for entry in entries])
+                       for name in NOTE_COLUMNS}
+        instruments = [instrument_info(entry['program'], entry['is_drum'], entry['name'],
+                                       self._slice('bends', entry['bends']),
+                                       self._slice('controls', entry['controls'])) for entry in entries]
+        instrument = np.repeat(np.arange(len(entries)), counts)
+        return NoteTable(columns['pitch'], columns['start'], columns['end'], columns['velocity'], instrument,
+                         instruments)
+
+    def song_table(self, song, stems=None):
+        """Every stem of song (or the given ones) merged into one table, an instrument per stem"""
+        entries = self.find(song=song)
+        if stems is not None:
+            entries = [entry for entry in entries if entry['stem'] in stems]
+        return self.tables(entries)
+
+
+_libraries = {}
+
+
+def get_library(path=DEFAULT_LIBRARY_DIR):
+    """Library of path, shared by the whole process"""
+    if path not in _libraries:
+        _libraries[path] = TranscriptionLibrary(path)
+    return _libraries[path]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Search the transcription library")
+    parser.add_argument("--library", default=DEFAULT_LIBRARY_DIR)
+    parser.add_argument("--song", default=None)
+    parser.add_argument("--stem", default=None)
+    parser.add_argument("--program", type=int, default=None)
+    parser.add_argument("--key", default=None, help="tonic, e.g. A or E-")
+    parser.add_argument("--mode", default=None, choices=["major", "minor"])
+    parser.add_argument("--tempo", type=float, nargs=2, default=None, metavar=("LOW", "HIGH"))
+    parser.add_argument("--compact", action="store_true", help="drop the rows of replaced entries")
+    args = parser.parse_args()
+
+    library = TranscriptionLibrary(args.library)
+    if args.compact:
+        library.compact()
+    for entry in library.find(args.song, args.stem, args.program, key=args.key, mode=args.mode, tempo=args.tempo):
+        key = f"{entry['tonic']} {entry['mode']}" if entry['tonic'] else "-"
+        print(f"{entry['song']:<30} {entry['stem']:<8} program {entry['program']:>3}  {entry['tempo']} bpm  "
+              f"{key:<10} {entry['notes']:>6} notes  {entry['duration']:.1f}s")